@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+    homm3atlasbake
+
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    usage: atlasbake.py [data [data/atlas [page size]]]
+
+    packs every frame of data/advmap_tiles and data/advmap_objects into a few
+    atlas pages that MapSet loads instead of the single pngs, rerun it
+    whenever the data changes
+"""
+
+import os
+import sys
+import time
+import pyglet
+pyglet.options['shadow_window'] = False
+from lib import atlasbundle
+
+def main(args):
+    root = args[1] if len(args) > 1 else "data"
+    output = args[2] if len(args) > 2 else os.path.join(root, "atlas")
+    page_size = int(args[3]) if len(args) > 3 else 1024
+    if page_size not in (512, 1024, 2048):
+        print "page size must be 512, 1024 or 2048"
+        return 1
+    start = time.time()
+    frames, usage = atlasbundle.build(os.path.abspath(root), output, page_size)
+    print "packed %d frames into %d pages of %dx%d in %.1fs" % (frames,
+        len(usage), page_size, page_size, time.time() - start)
+    for number, fill in enumerate(usage):
+        print "page %d: %.1f%% used" % (number, fill * 100)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
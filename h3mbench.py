@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+"""
+    homm3hmbench
+
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    usage: h3mbench.py test maps/*.h3m
+           h3mbench.py scale [size...]
+           h3mbench.py index [object density...]
+           h3mbench.py path [queries]
+           h3mbench.py hierarchy [queries]
+           h3mbench.py heroes [heroes [movement points]]
+           h3mbench.py fog [size...]
+           h3mbench.py minimap [size...]
+           h3mbench.py prefetch [pngs]
+"""
+
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import multiprocessing
+import pyglet
+from lib import h3m, h3mwriter, mapgen
+from lib.spatialindex import ChunkIndex
+from lib.passability import Passability
+from lib.pathfinding import Pathfinder, LANDMARKS
+from lib.pathcache import PathCache
+from lib.reachability import DistanceFields
+from lib.fog import FogOfWar
+from lib.minimap import Minimap
+from lib.mapcache import MapCache
+
+ROUNDS = 10
+
+def timeit(function, *args, **kwargs):
+    best = None
+    for i in xrange(ROUNDS):
+        start = time.time()
+        function(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_parse(filename, label=None):
+    label = label or filename
+    if h3m.extract(filename, buffered=False) != h3m.extract(filename):
+        print label, "stream and buffer decoder disagree"
+        return
+    stream = timeit(h3m.extract, filename, buffered=False)
+    buffered = timeit(h3m.extract, filename)
+    print "%s: stream %.1fms buffer %.1fms (%.1fx)" % (label,
+        stream*1000, buffered*1000, stream/buffered)
+    directory = tempfile.mkdtemp()
+    try:
+        cache = MapCache(directory)
+        cache.extract(filename)
+        warm = timeit(cache.extract, filename)
+        print "%s: warm cache %.1fms (%.1fx)" % (label, warm*1000,
+            stream/warm)
+        if h3m.numpy is not None:
+            warm = timeit(cache.extract, filename, arrays=True)
+            print "%s: warm cache with terrain arrays %.1fms (%.1fx)" % (
+                label, warm*1000, stream/warm)
+    finally:
+        shutil.rmtree(directory)
+    header = timeit(h3m.scan_header, filename)
+    print "%s: scan_header %.2fms" % (label, header*1000)
+    if h3m.numpy is not None:
+        arrays = timeit(h3m.extract, filename, arrays=True)
+        print "%s: buffer with terrain arrays %.1fms (%.1fx)" % (label,
+            arrays*1000, stream/arrays)
+    bench_write(filename, label)
+
+def bench_write(filename, label):
+    map_data = h3m.extract(filename)
+    if h3mwriter.encode(map_data) != h3m.load(filename):
+        print label, "writer does not reproduce the map"
+        return
+    encode = timeit(h3mwriter.encode, map_data)
+    fd, written = tempfile.mkstemp(suffix=".h3m")
+    os.close(fd)
+    try:
+        save = timeit(h3mwriter.save, written, map_data)
+    finally:
+        os.remove(written)
+    print "%s: encode %.1fms, save gzipped %.1fms" % (label, encode*1000,
+        save*1000)
+
+def bench_raw(filename):
+    """raw dumps are read through a plain file, so also time a gzipped copy
+    of them the way real maps are stored"""
+    bench_parse(filename)
+    fd, gzipped = tempfile.mkstemp(suffix=".h3m")
+    os.close(fd)
+    try:
+        h3m_file = gzip.open(gzipped, "wb")
+        h3m_file.write(h3m.load(filename))
+        h3m_file.close()
+        bench_parse(gzipped, filename + " (gzipped)")
+    finally:
+        os.remove(gzipped)
+
+def bench_scale(sizes):
+    """parse times of generated two level maps as they grow"""
+    fd, generated = tempfile.mkstemp(suffix=".h3m")
+    os.close(fd)
+    try:
+        for size in sizes:
+            map_data = mapgen.generate(size, underworld=True)
+            h3mwriter.save(generated, map_data)
+            buffered = timeit(h3m.extract, generated)
+            line = "%dx%d, %d objects: buffer %.1fms" % (size, size,
+                len(map_data["tunedobj"]), buffered*1000)
+            if h3m.numpy is not None:
+                arrays = timeit(h3m.extract, generated, arrays=True)
+                line += " with terrain arrays %.1fms" % (arrays*1000)
+            encode = timeit(h3mwriter.encode, map_data)
+            line += " encode %.1fms" % (encode*1000)
+            blocking = timeit(Passability, map_data)
+            print line + " passability %.1fms" % (blocking*1000)
+    finally:
+        os.remove(generated)
+
+def bench_index(densities, size=144, views=1000):
+    """viewport queries of the object index against scanning the anchor
+    tiles around the viewport, sprites get random sizes up to 6x4 tiles"""
+    #25x19 tiles is an 800x600 viewport
+    view_x, view_y = 25, 19
+    for density in densities:
+        map_data = mapgen.generate(size, object_density=density)
+        rng = random.Random(0)
+        index = ChunkIndex()
+        anchors = {}
+        for number, obj in enumerate(map_data["tunedobj"]):
+            width, height = rng.randint(1, 6), rng.randint(1, 4)
+            x, y = obj["x"] + 9, obj["y"] + 8
+            index.insert(obj, x - width + 1, y - height + 1, x, y,
+                         (y, -x, number))
+            anchors.setdefault((x, y), []).append(obj)
+        corners = [(rng.randint(0, size), rng.randint(0, size))
+                   for i in xrange(views)]
+        def query():
+            for x, y in corners:
+                index.query(x, y, x + view_x - 1, y + view_y - 1)
+        def scan():
+            #what get_tiles did before, 5 extra rows and columns
+            for x, y in corners:
+                found = []
+                for tile_y in xrange(y, y + view_y + 5):
+                    for tile_x in xrange(x + view_x + 4, x - 1, -1):
+                        found.extend(anchors.get((tile_x, tile_y), ()))
+        print "%dx%d, %d objects: index %.1fus scan %.1fus per view" % (
+            size, size, len(index), timeit(query) * 1e6 / views,
+            timeit(scan) * 1e6 / views)
+
+def percentiles(times):
+    times = sorted(times)
+    return "median %.3fms p90 %.3fms max %.1fms" % (
+        times[len(times) // 2] * 1000, times[len(times) * 9 // 10] * 1000,
+        times[-1] * 1000)
+
+def bench_path(queries, size=144):
+    """random path queries on a generated two level map, timed apart for
+    pairs with a path and pairs the component check turns down, without
+    and with landmarks"""
+    map_data = mapgen.generate(size, underworld=True)
+    for landmarks in (0, LANDMARKS):
+        start = time.time()
+        pathfinder = Pathfinder(map_data, landmarks=landmarks)
+        for grid in pathfinder.grids:
+            grid.components()
+        print "%dx%d, %d landmarks: cost grids and components in %.1fms" % (
+            size, size, landmarks, (time.time() - start) * 1000)
+        rng = random.Random(0)
+        found = []
+        missing = []
+        expanded = []
+        for i in xrange(queries):
+            z = rng.randint(0, 1)
+            path_start = (rng.randrange(size), rng.randrange(size))
+            path_goal = (rng.randrange(size), rng.randrange(size))
+            start = time.time()
+            path = pathfinder.find_path(path_start, path_goal, z)
+            elapsed = time.time() - start
+            if path is not None:
+                found.append(elapsed)
+                expanded.append(pathfinder.grids[z].expanded)
+            else:
+                missing.append(elapsed)
+        if found:
+            expanded.sort()
+            print "%d with a path: %s, median %d nodes settled" % (
+                len(found), percentiles(found), expanded[len(expanded) // 2])
+        if missing:
+            print "%d without a path: %s" % (len(missing),
+                                             percentiles(missing))
+
+def cache_state(cache):
+    """what a PathCache built, without the empty entries its lookups leave"""
+    return (dict((node, targets) for node, targets in cache.edges.iteritems()
+                 if targets), dict(cache.uses), dict(cache.members),
+            dict((key, nodes) for key, nodes in cache.cluster_nodes.iteritems()
+                 if nodes), cache.portals)
+
+def bench_hierarchy(queries, size=144):
+    """the cluster graph against plain A* on the pairs that have a path"""
+    map_data = mapgen.generate(size, underworld=True)
+    pathfinder = Pathfinder(map_data)
+    cache = PathCache(map_data)
+    rng = random.Random(0)
+    pairs = []
+    while len(pairs) < queries:
+        z = rng.randint(0, 1)
+        start = (rng.randrange(size), rng.randrange(size))
+        goal = (rng.randrange(size), rng.randrange(size))
+        grid = pathfinder.grids[z]
+        if grid.reachable(grid.node(*start), grid.node(*goal)):
+            pairs.append((start + (z, ), goal + (z, )))
+    plain = []
+    for start, goal in pairs:
+        began = time.time()
+        pathfinder.find_path(start[:2], goal[:2], start[2])
+        plain.append(time.time() - began)
+    unrefined = []
+    for start, goal in pairs:
+        began = time.time()
+        cache.find_path(start, goal, refine=False)
+        unrefined.append(time.time() - began)
+    for start, goal in pairs:
+        cache.find_path(start, goal)
+    metrics = cache.metrics()
+    print "%dx%d: %d nodes, %d edges built in %.1fms" % (size, size,
+        metrics["nodes"], metrics["edges"], metrics["build_ms"])
+    print "%d paths, a*: %s" % (len(pairs), percentiles(plain))
+    print "cost only: %s" % percentiles(unrefined)
+    print "refined: median %.3fms p90 %.3fms max %.1fms" % (
+        metrics["query_median_ms"], metrics["query_p90_ms"],
+        metrics["query_max_ms"])
+    updates = []
+    for i in xrange(100):
+        x, y, z = rng.randrange(size), rng.randrange(size), rng.randint(0, 1)
+        grid = cache.grids[z]
+        cache.update_tile(x, y, z, not grid.passable[grid.node(x, y)])
+        updates.append(cache.update_time)
+    print "100 tile updates: %s" % percentiles(updates)
+    incremental = cache_state(cache)
+    cache.rebuild()
+    print "incremental %s rebuild" % ("equals" if incremental ==
+                                      cache_state(cache) else "differs from")
+
+def bench_heroes(count, limit, size=144):
+    """distance fields of many heroes at once, in this process and in a
+    process pool"""
+    map_data = mapgen.generate(size, underworld=True)
+    grids = Pathfinder(map_data).grids
+    rng = random.Random(0)
+    starts = []
+    while len(starts) < count:
+        x, y, z = rng.randrange(size), rng.randrange(size), rng.randint(0, 1)
+        if grids[z].passable[grids[z].node(x, y)]:
+            starts.append((x, y, z))
+    serial = DistanceFields(grids, processes=0)
+    pooled = DistanceFields(grids)
+    try:
+        #the first call allocates the arrays and starts the pool
+        serial.compute(starts, limit)
+        pooled.compute(starts, limit)
+        reached = sum(len(serial.reached(slot)) for slot in xrange(count))
+        print "%d heroes with %d points reach %d tiles" % (count, limit,
+                                                          reached)
+        print "serial %.1fms pool %.1fms" % (
+            timeit(serial.compute, starts, limit) * 1000,
+            timeit(pooled.compute, starts, limit) * 1000)
+    finally:
+        pooled.close()
+
+def bench_fog(sizes, steps=1000):
+    """a hero of every player walking around the map, revealing a tile at a
+    time, and the bytes a view would upload for the dirty rectangles"""
+    for size in sizes:
+        fog = FogOfWar(size, 2)
+        rng = random.Random(0)
+        walks = []
+        for player in xrange(len(fog.bits)):
+            x, y = rng.randrange(size), rng.randrange(size)
+            walk = []
+            for step in xrange(steps):
+                x = min(max(x + rng.randint(-1, 1), 0), size - 1)
+                y = min(max(y + rng.randint(-1, 1), 0), size - 1)
+                walk.append((x, y))
+            walks.append(walk)
+        def walk():
+            uploaded = 0
+            for player, path in enumerate(walks):
+                fog.take_dirty(player, 0)
+                for x, y in path:
+                    fog.reveal(player, x, y, 0, 5)
+                    box = fog.take_dirty(player, 0)
+                    if box is not None:
+                        uploaded += len(fog.rows(player, 0, *box))
+            return uploaded
+        start = time.time()
+        uploaded = walk()
+        elapsed = time.time() - start
+        print "%dx%d: %d bytes per player, %d steps %.1fus each, " \
+              "%d bytes uploaded, %.1fus per step once explored" % (size,
+              size, fog.memory(), steps * len(walks),
+              elapsed * 1000000 / (steps * len(walks)), uploaded,
+              timeit(walk) * 1000000 / (steps * len(walks)))
+
+def bench_minimap(sizes, changes=1000):
+    """full rebuilds of two-level minimaps and single tiles changing"""
+    for size in sizes:
+        map_data = mapgen.generate(size, underworld=True)
+        minimap = Minimap(map_data)
+        def rebuild():
+            minimap.rebuild()
+            for z in xrange(minimap.levels):
+                minimap.pixels(z, *minimap.take_dirty(z))
+        rng = random.Random(0)
+        tiles = [(rng.randrange(size), rng.randrange(size), rng.randint(0, 1),
+                  rng.randrange(10)) for i in xrange(changes)]
+        def change():
+            for x, y, z, terrain_type in tiles:
+                minimap.set_terrain(x, y, z, terrain_type)
+                box = minimap.take_dirty(z)
+                if box is not None:
+                    minimap.pixels(z, *box)
+        print "%dx%d: rebuild %.2fms, changed tile %.1fus" % (size, size,
+              timeit(rebuild) * 1000, timeit(change) * 1000000 / changes)
+
+def bench_prefetch(count):
+    """pngs decoded one after the other, the way MapSet loads them without
+    an ImagePrefetcher, against handing them all to one first, with the
+    time spent in the main process, which is what keeps the progress bar
+    from being drawn"""
+    #the decoders need no window
+    pyglet.options["shadow_window"] = False
+    from lib.mapset import ImagePrefetcher, decode_image
+    directory = tempfile.mkdtemp()
+    try:
+        rng = random.Random(0)
+        files = []
+        for i in xrange(count):
+            #mostly tile sized frames and some larger objects
+            width, height = (96, 64) if i % 4 == 0 else (32, 32)
+            colors = ["".join(chr(rng.randrange(256)) for channel in "RGB") +
+                      "\xff" for color in xrange(16)]
+            data = "".join(colors[rng.randrange(16)] * 4
+                           for pixel in xrange(width * height // 4))
+            files.append("%d.png" % i)
+            pyglet.image.ImageData(width, height, "RGBA", data).save(
+                os.path.join(directory, files[-1]))
+        pyglet.resource.path = [directory]
+        pyglet.resource.reindex()
+        def serial():
+            for file in files:
+                decode_image(file)
+        def prefetched():
+            images = ImagePrefetcher(pool)
+            images.request(files)
+            for file in files:
+                images.get(file)
+        #started once like the load screen does, while the map is parsed
+        pool = multiprocessing.Pool()
+        try:
+            for label, function in (("serial", serial),
+                                    ("prefetched", prefetched)):
+                began = time.clock()
+                elapsed = timeit(function)
+                busy = (time.clock() - began) / ROUNDS
+                print "%d pngs %s: %.1fms, %.1fms in the main process" % (
+                    count, label, elapsed * 1000, busy * 1000)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(directory)
+
+def main(args):
+    if len(args) > 1 and args[1] == "scale":
+        bench_scale([int(arg) for arg in args[2:]] or [36, 72, 108, 144, 256])
+        return
+    if len(args) > 1 and args[1] == "path":
+        bench_path(int(args[2]) if len(args) > 2 else 10000)
+        return
+    if len(args) > 1 and args[1] == "heroes":
+        bench_heroes(int(args[2]) if len(args) > 2 else 48,
+                     int(args[3]) if len(args) > 3 else 1500)
+        return
+    if len(args) > 1 and args[1] == "minimap":
+        bench_minimap([int(arg) for arg in args[2:]] or
+                      [36, 72, 108, 144, 256])
+        return
+    if len(args) > 1 and args[1] == "fog":
+        bench_fog([int(arg) for arg in args[2:]] or [36, 72, 108, 144, 256])
+        return
+    if len(args) > 1 and args[1] == "prefetch":
+        bench_prefetch(int(args[2]) if len(args) > 2 else 400)
+        return
+    if len(args) > 1 and args[1] == "hierarchy":
+        bench_hierarchy(int(args[2]) if len(args) > 2 else 1000)
+        return
+    if len(args) > 1 and args[1] == "index":
+        bench_index([float(arg) for arg in args[2:]] or
+                    [0.02, 0.05, 0.1, 0.2, 0.4])
+        return
+    for arg in args[1:]:
+        with open(arg, "rb") as h3m_file:
+            magic = h3m_file.read(2)
+        if magic == h3m.GZIP_MAGIC:
+            bench_parse(arg)
+        else:
+            bench_raw(arg)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+    homm3hmgen
+
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    usage: h3mgen.py [options] maps/synthetic.h3m
+"""
+
+import optparse
+import sys
+from lib import h3mwriter, mapgen
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog [options] output.h3m")
+    parser.add_option("-s", "--size", type="int", default=144,
+                      help="up to %d, the game offers %s" %
+                      (h3mwriter.MAX_SIZE, ", ".join(str(size) for size in
+                                                     mapgen.MAP_SIZES)))
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("-u", "--underworld", action="store_true",
+                      default=False)
+    parser.add_option("--rivers", type="float", default=0.03,
+                      help="share of tiles with a river")
+    parser.add_option("--roads", type="float", default=0.03,
+                      help="share of tiles with a road")
+    parser.add_option("--objects", type="float", default=0.08,
+                      help="objects per tile")
+    parser.add_option("--raw", action="store_true", default=False,
+                      help="do not gzip the output")
+    options, filenames = parser.parse_args(args[1:])
+    if len(filenames) != 1:
+        parser.error("exactly one output file is needed")
+    if not 1 <= options.size <= h3mwriter.MAX_SIZE:
+        parser.error("maps are 1 to %d tiles wide" % h3mwriter.MAX_SIZE)
+    map_data = mapgen.generate(options.size, options.seed, options.underworld,
+        river_density=options.rivers, road_density=options.roads,
+        object_density=options.objects)
+    h3mwriter.save(filenames[0], map_data, compress=not options.raw)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -16,11 +16,21 @@
 
     You should have received a copy of the GNU General Public License
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    usage: h3mtest.py map.h3m...
+           h3mtest.py catalog catalog.db maps/ [more maps or directories]
+           h3mtest.py objects maps/ [more maps or directories]
 """
 
 import gzip, os
 import struct
 import sys
+import zlib
+import hashlib
+import multiprocessing
+import sqlite3
+import time
+from lib import h3m
 
 def extract(filename):
     h3m_data = gzip.open(filename)
@@ -32,7 +42,132 @@ def extract(filename):
         (size,) = struct.unpack("<I", h3m_data.read(4))
         print filename, size
     
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS maps (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    sha1 TEXT,
+    name TEXT,
+    size INTEGER,
+    levels INTEGER,
+    players INTEGER,
+    objects INTEGER,
+    victory INTEGER
+);
+CREATE INDEX IF NOT EXISTS maps_sha1 ON maps (sha1);
+CREATE INDEX IF NOT EXISTS maps_size ON maps (size, levels);
+"""
+
+def find_maps(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(".h3m"):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def catalog_entry(job):
+    """runs in a worker process: hash a map and summarize it unless the hash
+    is the one already in the catalog"""
+    path, old_sha1 = job
+    mtime = os.path.getmtime(path)
+    with open(path, "rb") as h3m_file:
+        raw = h3m_file.read()
+    sha1 = hashlib.sha1(raw).hexdigest()
+    if sha1 == old_sha1:
+        return path, mtime, sha1, len(raw), None
+    try:
+        map_data = h3m.read_summary(h3m.BufferReader(h3m.inflate(raw)))
+    except (struct.error, NotImplementedError, ValueError, IOError,
+            zlib.error), e:
+        return path, mtime, sha1, len(raw), "%s: %s" % (type(e).__name__, e)
+    players = sum(1 for color in h3m.PLAYER_COLORS
+                  if map_data[color]["is_human"] or
+                     map_data[color]["is_computer"])
+    victory = map_data["victory_conditions"]
+    if isinstance(victory, dict):
+        victory = victory["id"]
+    summary = (map_data["map_name"].decode("latin-1"), map_data["map_size"],
+               2 if map_data["underworld"] else 1, players,
+               map_data["tunedobj_count"], victory)
+    return path, mtime, sha1, len(raw), summary
+
+def catalog(database, paths, processes=None):
+    """add the summary of every map below paths to an sqlite catalog
+    
+    maps whose mtime did not change since the last run are skipped, maps
+    with a new mtime are hashed and only parsed again if the content changed
+    """
+    start = time.time()
+    db = sqlite3.connect(database)
+    db.executescript(CATALOG_SCHEMA)
+    known = dict((path, (mtime, sha1)) for path, mtime, sha1 in
+                 db.execute("SELECT path, mtime, sha1 FROM maps"))
+    jobs = []
+    skipped = 0
+    for path in find_maps(paths):
+        path = os.path.abspath(path)
+        if path in known and known[path][0] == os.path.getmtime(path):
+            skipped += 1
+        else:
+            jobs.append((path, known.get(path, (None, None))[1]))
+    parsed = unchanged = failed = size = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for path, mtime, sha1, length, result in \
+                pool.imap_unordered(catalog_entry, jobs, chunksize=16):
+            size += length
+            if result is None:
+                unchanged += 1
+                db.execute("UPDATE maps SET mtime=? WHERE path=?",
+                           (mtime, path))
+            elif isinstance(result, str):
+                failed += 1
+                print path, result
+            else:
+                parsed += 1
+                db.execute("INSERT OR REPLACE INTO maps VALUES "
+                           "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (path, mtime, sha1) + result)
+    finally:
+        pool.close()
+        pool.join()
+    #forget maps that were deleted
+    for path in known:
+        if not os.path.exists(path):
+            db.execute("DELETE FROM maps WHERE path=?", (path, ))
+    db.commit()
+    db.close()
+    elapsed = time.time() - start
+    print "%d parsed, %d unchanged, %d skipped, %d failed in %.2fs" % (
+        parsed, unchanged, skipped, failed, elapsed)
+    if jobs and elapsed > 0:
+        print "%.1f maps/s, %.1f MB/s" % (len(jobs)/elapsed,
+                                          size/elapsed/1024/1024)
+
+def count_objects(paths):
+    """print how often every object class is placed on the given maps, the
+    objects are streamed so this runs in constant memory"""
+    counts = {}
+    for path in find_maps(paths):
+        try:
+            for template, obj in h3m.iter_tunedobj(path):
+                counts[template["class"]] = \
+                    counts.get(template["class"], 0) + 1
+        except ValueError, e:
+            print "%s: %s" % (path, e)
+    for obj_class, count in sorted(counts.iteritems()):
+        print "%3d %d" % (obj_class, count)
+
 def main(args):
+    if len(args) > 3 and args[1] == "catalog":
+        catalog(args[2], args[3:])
+        return
+    if len(args) > 2 and args[1] == "objects":
+        count_objects(args[2:])
+        return
     for arg in args[1:]:
         extract(arg)
 
@@ -17,35 +17,108 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import multiprocessing
+import optparse
+import sys
+import time
+from multiprocessing.pool import ThreadPool
 import pyglet
 from lib.mapset import *
 from lib.interface import *
 from lib.mapview import *
+from lib.fog import FogOfWar, human_player
+from lib.minimap import Minimap
 from lib.window import Window
 
 class LoadScreen(object):
-    def __init__(self, window):
+    """parses the map on a worker thread and decodes pngs in worker
+    processes while the main thread uploads textures a few at a time and
+    draws the progress, verbose
+    prints what the loaded map takes in memory"""
+    def __init__(self, window, map_name="Deluge", verbose=False):
         self.window = window
+        self.verbose = verbose
         self.label = pyglet.text.Label('',
                 font_name="Linux Libertine",
                 font_size=28,
                 x=self.window.width-10, y=10,
                 anchor_x='right', anchor_y='bottom')
-        self.label.text = "INITIATING MAPSET..."
-        mapset = MapSet("Deluge")
+        self.label.text = "PARSING MAP..."
+        self.done = 0
+        self.total = 0
+        self.mapset = None
+        self.steps = None
+        # the resource index must exist before the workers look files up
+        pyglet.resource._default_loader._require_index()
+        self.pool = ThreadPool(1)
+        self.map_data = self.pool.apply_async(read_map, (map_name, ))
+        self.decoders = multiprocessing.Pool()
+        self.images = ImagePrefetcher(self.decoders)
+        pyglet.clock.schedule_interval(self.load, 1/60.0)
+    
+    def load(self, dt):
+        if self.steps is None:
+            if not self.map_data.ready():
+                return
+            self.mapset, self.steps = MapSet.loading(self.map_data.get(),
+                                                     self.images)
+            self.start = time.time()
+        # upload for at most half a frame so the screen stays responsive
+        end = time.time() + 1/120.0
+        for self.done, self.total in self.steps:
+            if time.time() > end:
+                self.label.text = "LOADING GRAPHICS %d/%d" % (self.done,
+                                                             self.total)
+                if self.done:
+                    eta = (time.time() - self.start) * \
+                          (self.total - self.done) / self.done
+                    self.label.text += ", %ds LEFT" % (eta + 1)
+                return
+        pyglet.clock.unschedule(self.load)
+        self.pool.close()
+        self.decoders.close()
+        if self.verbose:
+            print "animation frames: %d KB, %d KB without sharing" % tuple(
+                size // 1024 for size in self.mapset.frame_memory())
+            usage = self.mapset.atlas_usage()
+            print "%d atlas pages of %dx%d: %s" % (len(usage),
+                self.mapset.page_size, self.mapset.page_size,
+                " ".join("%d%%" % (fill * 100) for fill in usage))
+        map_data = self.map_data.get()
+        fog = FogOfWar(map_data["map_size"], self.mapset.levels)
+        fog.reveal_owned(map_data)
+        if self.verbose:
+            print "fog of war: %d bytes per player" % fog.memory()
         self.label.text = "INITIATING MAPVIEW..."
-        mapview = MapView(mapset, self.window)
+        minimap = Minimap(map_data, self.mapset.passability)
+        mapview = MapView(self.mapset, self.window, fog,
+                          human_player(map_data), minimap)
         interface = Interface(self.window)
         self.window.pop_handlers()
         self.window.push_handlers(mapview)
         self.window.push_handlers(interface)
         self.window.push_handlers(self.window.keys)
-        
+    
+    def on_draw(self):
+        pyglet.gl.glClear(pyglet.gl.GL_COLOR_BUFFER_BIT)
+        if self.total:
+            width = self.window.width - 20
+            pyglet.gl.glColor4f(0.3, 0.3, 0.3, 1)
+            pyglet.gl.glRectf(10, 60, 10 + width, 80)
+            pyglet.gl.glColor4f(1, 1, 1, 1)
+            pyglet.gl.glRectf(10, 60, 10 + width * self.done // self.total,
+                              80)
+        self.label.draw()
+
 if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help="print the memory the loaded map takes")
+    options, args = parser.parse_args(sys.argv[1:])
     pyglet.gl.glBlendFunc(pyglet.gl.GL_SRC_ALPHA,
         pyglet.gl.GL_ONE_MINUS_SRC_ALPHA)
     window = Window()
-    window.push_handlers(LoadScreen(window))
+    window.push_handlers(LoadScreen(window, verbose=options.verbose))
     img = pyglet.resource.image("data/cursors/cradvntr.def/0.png")
     window.set_mouse_cursor(pyglet.window.ImageMouseCursor(img, 0, 40))
     pyglet.app.run()
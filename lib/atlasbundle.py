@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import struct
+import pyglet
+from lib.defmanifest import DEF_DIRECTORIES, find_frames
+from lib.maxrects import MaxRectsAllocator
+
+BUNDLE_MAGIC = "H3AB"
+BUNDLE_VERSION = 1
+#magic, version, page size, page count, def count
+BUNDLE_HEADER = struct.Struct("<4sIHHI")
+#page, x, y, width, height of a frame
+BUNDLE_REGION = struct.Struct("<B4H")
+WORD = struct.Struct("<H")
+MANIFEST = "manifest.bin"
+PAGE = "page%02d.png"
+
+def is_texture(path):
+    """whether a frame is drawn from the atlas, all other frames are only
+    animation data that is copied into the first frame of their def"""
+    directory, name = path.rsplit("/", 1)
+    if name == "0.png":
+        return True
+    #single frame tiles like grastl.def/5.png
+    return directory.endswith(".def") and "/advmap_tiles/" in path
+
+def build(root, output, page_size=1024, directories=DEF_DIRECTORIES):
+    """pack every frame below root into png pages and write the manifest
+
+    frames drawn from the atlas and pure animation frames go onto separate
+    pages so the latter never have to be uploaded to the graphics card,
+    returns the frame count and the fill ratio of every page
+    """
+    base = os.path.dirname(root)
+    defs = find_frames(root, directories)
+    images = {}
+    for name, frames in defs.iteritems():
+        for frame in xrange(frames):
+            path = "%s/%d.png" % (name, frame)
+            images[path] = pyglet.image.load(os.path.join(base, path))
+    regions = {}
+    pages = []
+    allocators = []
+    for textures in (True, False):
+        paths = [path for path in images if is_texture(path) == textures]
+        #the allocator works best with the highest images first
+        paths.sort(key=lambda path: (images[path].height, path), reverse=True)
+        first = len(pages)
+        for path in paths:
+            image = images[path]
+            #every page of the group is tried, not only the last one
+            for number in xrange(first, len(pages)):
+                if allocators[number].find(image.width, image.height):
+                    break
+            else:
+                allocators.append(MaxRectsAllocator(page_size, page_size))
+                pages.append(bytearray(page_size * page_size * 4))
+                number = len(pages) - 1
+            x, y = allocators[number].alloc(image.width, image.height)
+            page = pages[number]
+            pitch = image.width * 4
+            data = image.get_data("RGBA", pitch)
+            for row in xrange(image.height):
+                start = ((y + row) * page_size + x) * 4
+                page[start:start + pitch] = data[row * pitch:(row + 1) * pitch]
+            regions[path] = (number, x, y, image.width, image.height)
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    for number, page in enumerate(pages):
+        pyglet.image.ImageData(page_size, page_size, "RGBA",
+            str(page)).save(os.path.join(output, PAGE % number))
+    manifest = [BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, page_size,
+                                   len(pages), len(defs))]
+    for name in sorted(defs):
+        manifest.append(WORD.pack(len(name)))
+        manifest.append(name)
+        manifest.append(WORD.pack(defs[name]))
+        for frame in xrange(defs[name]):
+            manifest.append(BUNDLE_REGION.pack(
+                *regions["%s/%d.png" % (name, frame)]))
+    with open(os.path.join(output, MANIFEST), "wb") as manifest_file:
+        manifest_file.write("".join(manifest))
+    return len(images), [allocator.get_usage() for allocator in allocators]
+
+class AtlasBundle(object):
+    """frames of all defs prepacked into a few atlas pages
+
+    pages are only read when a frame on them is asked for and only turned
+    into textures when a region on them is asked for
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST), "rb") as manifest_file:
+            data = manifest_file.read()
+        (magic, version, self.page_size, page_count, def_count) = \
+            BUNDLE_HEADER.unpack_from(data)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            raise ValueError("%s is no atlas bundle" % directory)
+        offset = BUNDLE_HEADER.size
+        self.defs = {}
+        for i in xrange(def_count):
+            (length, ) = WORD.unpack_from(data, offset)
+            name = data[offset + 2:offset + 2 + length]
+            (frames, ) = WORD.unpack_from(data, offset + 2 + length)
+            offset += 4 + length
+            self.defs[name] = [BUNDLE_REGION.unpack_from(data,
+                offset + frame * BUNDLE_REGION.size)
+                for frame in xrange(frames)]
+            offset += frames * BUNDLE_REGION.size
+        self.pages = [None] * page_count
+        self.page_data = [None] * page_count
+        self.textures = [None] * page_count
+
+    def __locate(self, path):
+        name, frame = path.rsplit("/", 1)
+        return self.defs[name][int(frame[:-4])]
+
+    def __contains__(self, path):
+        try:
+            self.__locate(path)
+        except (KeyError, IndexError, ValueError):
+            return False
+        return True
+
+    def frames(self, name):
+        """frame count of a def directory, 0 if it is not in the bundle"""
+        return len(self.defs.get(name, ()))
+
+    def size(self, path):
+        """width and height of a frame"""
+        return self.__locate(path)[3:]
+
+    def page(self, number):
+        if self.pages[number] is None:
+            self.pages[number] = pyglet.image.load(
+                os.path.join(self.directory, PAGE % number))
+        return self.pages[number]
+
+    def texture(self, number):
+        if self.textures[number] is None:
+            self.textures[number] = self.page(number).get_texture()
+        return self.textures[number]
+
+    def region(self, path):
+        """texture region of a frame, like TextureAtlas.add() returns"""
+        (page, x, y, width, height) = self.__locate(path)
+        return self.texture(page).get_region(x, y, width, height)
+
+    def image(self, path):
+        """image data of a frame, like pyglet.image.load() returns"""
+        (page, x, y, width, height) = self.__locate(path)
+        if self.page_data[page] is None:
+            self.page_data[page] = self.page(page).get_data("RGBA",
+                self.page_size * 4)
+        data = self.page_data[page]
+        pitch = width * 4
+        starts = [((y + row) * self.page_size + x) * 4
+                  for row in xrange(height)]
+        rows = [data[start:start + pitch] for start in starts]
+        return pyglet.image.ImageData(width, height, "RGBA", "".join(rows))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import struct
+
+#frame counts of all defs and the height of their first frame, one
+#"count height def directory" per line, older manifests have no height
+MANIFEST = "frames.txt"
+#width and height in the IHDR chunk that starts every png
+PNG_SIZE = struct.Struct(">8x8xII")
+
+#the directories below data/ map defs are extracted to
+DEF_DIRECTORIES = ("advmap_tiles", "advmap_objects")
+
+def find_frames(root, directories=DEF_DIRECTORIES):
+    """def directory -> frame count of every directory with numbered pngs,
+    paths are relative to the directory of root like resource names"""
+    base = os.path.dirname(root)
+    defs = {}
+    for directory in directories:
+        for path, dirs, files in os.walk(os.path.join(root, directory)):
+            frames = [int(name[:-4]) for name in files
+                      if name.endswith(".png") and name[:-4].isdigit()]
+            if not frames:
+                continue
+            if sorted(frames) != range(len(frames)):
+                raise ValueError("frames missing in %s" % path)
+            name = os.path.relpath(path, base).replace(os.sep, "/")
+            defs[name] = len(frames)
+    return defs
+
+def png_size(png_file):
+    """width and height of a png from its header, without decoding it"""
+    return PNG_SIZE.unpack(png_file.read(PNG_SIZE.size))
+
+def write(root, filename=None):
+    """scan the data tree below root and write its manifest"""
+    defs = find_frames(root)
+    base = os.path.dirname(root)
+    with open(filename or os.path.join(root, MANIFEST), "w") as manifest:
+        for name in sorted(defs):
+            with open(os.path.join(base, name, "0.png"), "rb") as png_file:
+                width, height = png_size(png_file)
+            manifest.write("%d %d %s\n" % (defs[name], height, name))
+    return defs
+
+def read(filename):
+    """(frame count, height of the first frame or None, def directory) of
+    every line of a manifest"""
+    if not os.path.exists(filename):
+        return
+    with open(filename) as manifest:
+        for line in manifest:
+            fields = line.rstrip("\n").split(" ", 2)
+            if len(fields) == 2 or not fields[1].isdigit():
+                #a manifest without heights, names may contain spaces
+                frames, name = line.rstrip("\n").split(" ", 1)
+                yield int(frames), None, name
+            else:
+                yield int(fields[0]), int(fields[1]), fields[2]
+
+def load(filename):
+    """def directory -> frame count, empty if there is no manifest"""
+    return dict((name, frames) for frames, height, name in read(filename))
+
+def load_heights(filename):
+    """def directory -> height of its first frame, for the defs whose
+    manifest line has one"""
+    return dict((name, height) for frames, height, name in read(filename)
+                if height is not None)
+
+def missing(defs, index):
+    """paths of all frames in defs that index does not contain"""
+    return ["%s/%d.png" % (name, frame)
+            for name, frames in sorted(defs.iteritems())
+            for frame in xrange(frames)
+            if "%s/%d.png" % (name, frame) not in index]
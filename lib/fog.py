@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from lib.h3m import PLAYER_COLORS
+from lib.passability import mask_offsets
+
+#tiles seen around an owned object by class: hero, random hero, random town
+#and town
+SIGHT = {34: 5, 70: 5, 77: 5, 98: 5}
+#owner of objects nobody owns
+NO_OWNER = 255
+
+#bytes of 0xff for filling whole bytes of a row at once
+_FULL = bytearray("\xff" * 256)
+#half widths of the circle of every radius, filled by reveal_mask()
+_masks = {}
+#the eight output bytes of every byte of bits, filled by FogOfWar.rows()
+_byte_tables = {}
+
+def reveal_mask(radius):
+    """half width of every row of the circle of radius, from dy = -radius to
+    radius, a tile is inside when dx*dx + dy*dy <= radius*(radius + 1)"""
+    mask = _masks.get(radius)
+    if mask is None:
+        limit = radius * (radius + 1)
+        mask = []
+        for dy in xrange(-radius, radius + 1):
+            width = 0
+            while (width + 1) ** 2 + dy * dy <= limit:
+                width += 1
+            mask.append(width)
+        mask = _masks[radius] = tuple(mask)
+    return mask
+
+def human_player(map_data):
+    """the first player a human may play, 0 when the map names none"""
+    for player, color in enumerate(PLAYER_COLORS):
+        if map_data.get(color, {}).get("is_human"):
+            return player
+    return 0
+
+class FogOfWar(object):
+    """tiles every player has explored, one bit per tile and level
+
+    a level of a player is a bytearray of size rows of stride bytes, tile
+    x, y is bit 0x80 >> (x & 7) of byte y * stride + x // 8, the leftmost
+    tile is the highest bit as numpy.unpackbits() expects it
+
+    reveal() collects the box of changed tiles per player and level until
+    take_dirty() hands it out, so a view only has to redo that part
+    """
+    def __init__(self, size, levels, players=len(PLAYER_COLORS)):
+        self.size = size
+        self.levels = levels
+        self.stride = (size + 7) // 8
+        self.bits = [[bytearray(self.stride * size) for z in xrange(levels)]
+                     for player in xrange(players)]
+        #everything is new to a view that has not taken anything yet
+        self.dirty = [[(0, 0, size - 1, size - 1) for z in xrange(levels)]
+                      for player in xrange(players)]
+
+    def memory(self):
+        """bytes of bits held for a single player"""
+        return self.stride * self.size * self.levels
+
+    def is_explored(self, player, x, y, z):
+        return bool(self.bits[player][z][y * self.stride + (x >> 3)] &
+                    (0x80 >> (x & 7)))
+
+    def reveal(self, player, x, y, z, radius):
+        """explore the circle of radius around x, y, returns the box of tiles
+        that were not explored before, None when there were none"""
+        bits = self.bits[player][z]
+        size = self.size
+        stride = self.stride
+        mask = reveal_mask(radius)
+        box = None
+        for dy, width in enumerate(mask):
+            row = y + dy - radius
+            if not 0 <= row < size:
+                continue
+            first = max(x - width, 0)
+            last = min(x + width, size - 1)
+            if first > last:
+                continue
+            start = row * stride + (first >> 3)
+            end = row * stride + (last >> 3)
+            low = 0xff >> (first & 7)
+            high = (0xff << (7 - (last & 7))) & 0xff
+            if start == end:
+                low &= high
+                if bits[start] & low == low:
+                    continue
+                bits[start] |= low
+            else:
+                middle = end - start - 1
+                if bits[start] & low == low and bits[end] & high == high and \
+                   bits[start + 1:end] == _FULL[:middle]:
+                    continue
+                bits[start] |= low
+                bits[end] |= high
+                bits[start + 1:end] = _FULL[:middle]
+            if box is None:
+                box = [first, row, last, row]
+            else:
+                box[0] = min(box[0], first)
+                box[2] = max(box[2], last)
+                box[3] = row
+        if box is None:
+            return None
+        box = tuple(box)
+        self.__mark(player, z, box)
+        return box
+
+    def move(self, player, path, z, radius):
+        """explore along the (x, y) tiles of a path a hero walks, returns the
+        box of newly explored tiles like reveal()"""
+        box = None
+        for x, y in path:
+            changed = self.reveal(player, x, y, z, radius)
+            if changed is None:
+                continue
+            if box is None:
+                box = changed
+            else:
+                box = (min(box[0], changed[0]), min(box[1], changed[1]),
+                       max(box[2], changed[2]), max(box[3], changed[3]))
+        return box
+
+    def reveal_owned(self, map_data):
+        """explore what the heroes and towns of every player see at the
+        start, centered on the tile they are entered from"""
+        templates = map_data["objects"]
+        for obj in map_data["tunedobj"]:
+            template = templates[obj["id"]]
+            radius = SIGHT.get(template["class"])
+            owner = obj.get("owner", NO_OWNER)
+            if radius is None or not 0 <= owner < len(self.bits) or \
+               obj["z"] >= self.levels:
+                continue
+            offsets = mask_offsets(template["actions"], 1) or [(0, 0)]
+            dx, dy = offsets[-1]
+            self.reveal(owner, obj["x"] + dx, obj["y"] + dy, obj["z"], radius)
+
+    def __mark(self, player, z, box):
+        dirty = self.dirty[player][z]
+        if dirty is not None:
+            box = (min(box[0], dirty[0]), min(box[1], dirty[1]),
+                   max(box[2], dirty[2]), max(box[3], dirty[3]))
+        self.dirty[player][z] = box
+
+    def take_dirty(self, player, z):
+        """the box (x1, y1, x2, y2) changed since the last call, None if
+        nothing did"""
+        box = self.dirty[player][z]
+        self.dirty[player][z] = None
+        return box
+
+    def rows(self, player, z, x1, y1, x2, y2, seen="\x00", unseen="\xff"):
+        """one byte per tile of the box, rows from y1 to y2, with seen or
+        unseen for explored and unexplored tiles"""
+        table = _byte_tables.get((seen, unseen))
+        if table is None:
+            table = _byte_tables[seen, unseen] = [
+                "".join(seen if byte & (0x80 >> bit) else unseen
+                        for bit in xrange(8)) for byte in xrange(256)]
+        bits = self.bits[player][z]
+        stride = self.stride
+        skip = x1 & 7
+        width = x2 - x1 + 1
+        rows = []
+        for y in xrange(y1, y2 + 1):
+            start = y * stride + (x1 >> 3)
+            row = "".join([table[byte] for byte in
+                           bits[start:y * stride + (x2 >> 3) + 1]])
+            rows.append(row[skip:skip + width])
+        return "".join(rows)
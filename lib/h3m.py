@@ -19,73 +19,227 @@
 
 import gzip
 import struct
+import zlib
 import pyglet
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def extract(filename):
-    h3m_data = gzip.open(filename)
-    map_data = {}
+GZIP_MAGIC = "\x1f\x8b"
+
+#bump whenever extract() returns something different for the same file,
+#cached maps of older parser versions are thrown away
+PARSER_VERSION = 2
+
+PLAYER_COLORS = ("Red", "Blue", "Tan", "Green", "Orange", "Purple", "Teal",
+                 "Pink")
+
+#the seven bytes of a terrain tile, in order
+TERRAIN_FIELDS = ("terrain_type", "terrain_index", "river_type",
+                  "river_index", "road_type", "road_index", "mirror")
+
+#precompiled layouts, every field of the format is little endian
+BYTE = struct.Struct("<B")
+BYTE2 = struct.Struct("<BB")
+BYTE3 = struct.Struct("<BBB")
+BYTE4 = struct.Struct("<4B")
+BYTE6 = struct.Struct("<6B")
+BYTE8 = struct.Struct("<8B")
+BYTE9 = struct.Struct("<9B")
+WORD = struct.Struct("<H")
+WORD7 = struct.Struct("<7H")
+DWORD = struct.Struct("<I")
+DWORD2 = struct.Struct("<II")
+BYTE_DWORD = struct.Struct("<BI")
+DWORD_BYTE2 = struct.Struct("<IBB")
+MAP_INFO = struct.Struct("<BIB")
+PLAYER_INFO = struct.Struct("<BBBBHB")
+TILE = struct.Struct("<7B")
+#landscape, land_edit_groups, class, number, group, isOverlay
+TEMPLATE = struct.Struct("<HHIIBB")
+GUARD = struct.Struct("<HH")
+GUARDS = struct.Struct("<14H")
+POSITION = struct.Struct("<3BI")
+MONSTER = struct.Struct("<IHBB")
+ARTIFACT_SLOTS = struct.Struct("<19H")
+RESOURCES = struct.Struct("<7I")
+RESOURCES_ARTIFACT = struct.Struct("<7IH")
+TOWN_EVENT = struct.Struct("<7I3B2H")
+REWARD = struct.Struct("<IIBBIIIIIIIBBBB")
+
+class BufferReader(object):
+    """walks a completely inflated map with an offset cursor
+    
+    the inflated data is a plain str which already is a read only buffer,
+    so unpack_from works on it directly without another view on top
+    """
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+    
+    def read(self, length):
+        start = self.offset
+        self.offset = start + length
+        return self.data[start:self.offset]
+    
+    def skip(self, length):
+        self.offset += length
+    
+    def unpack(self, layout):
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+    
+    def read_string(self):
+        (length, ) = DWORD.unpack_from(self.data, self.offset)
+        start = self.offset + 4
+        self.offset = start + length
+        return self.data[start:self.offset]
+    
+    def unpack_grid(self, layout, size):
+        """unpack size rows of size records each"""
+        unpack_from = layout.unpack_from
+        data = self.data
+        step = layout.size
+        row_length = step * size
+        start = self.offset
+        self.offset = start + row_length * size
+        return [[unpack_from(data, offset)
+                 for offset in xrange(row, row + row_length, step)]
+                for row in xrange(start, self.offset, row_length)]
+    
+    def read_array(self, shape):
+        """a read only uint8 array of the given shape on top of the data"""
+        count = reduce(lambda a, b: a*b, shape)
+        array = numpy.frombuffer(self.data, numpy.uint8, count, self.offset)
+        self.offset += count
+        return array.reshape(shape)
+
+class StreamReader(object):
+    """reads a map piece by piece from a (gzip) file object"""
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def read(self, length):
+        return self.stream.read(length)
+    
+    def skip(self, length):
+        #gzip streams seek forward in small steps instead of one big read
+        self.stream.seek(length, 1)
+    
+    def unpack(self, layout):
+        return layout.unpack(self.stream.read(layout.size))
+    
+    def read_string(self):
+        (length, ) = DWORD.unpack(self.stream.read(4))
+        return self.stream.read(length)
+    
+    def unpack_grid(self, layout, size):
+        data = self.stream.read(layout.size * size * size)
+        return BufferReader(data).unpack_grid(layout, size)
+    
+    def read_array(self, shape):
+        count = reduce(lambda a, b: a*b, shape)
+        return BufferReader(self.stream.read(count)).read_array(shape)
+
+def inflate(data):
+    """return the raw map data, h3m files are usually gzipped but raw dumps
+    like the one in the repository root work as well"""
+    chunks = []
+    while data[:2] == GZIP_MAGIC:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    if chunks:
+        return "".join(chunks)
+    return data
+
+def load(filename):
+    with open(filename, "rb") as h3m_file:
+        return inflate(h3m_file.read())
+
+def open_stream(filename):
+    with open(filename, "rb") as h3m_file:
+        magic = h3m_file.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(filename)
+    return open(filename, "rb")
+
+def terrain_fields(terrain):
+    """named views on the tile bytes of a terrain array, e.g.
+    terrain_fields(map_data["upper_terrain"])["river_type"]"""
+    return dict((name, terrain[..., i]) for i, name in
+                enumerate(TERRAIN_FIELDS))
+
+def read_header(h3m_data, map_data):
     #read general info
-    (map_data["version"], ) = struct.unpack("<I", h3m_data.read(4))
+    (map_data["version"], ) = h3m_data.unpack(DWORD)
+    #only shadow of death maps are understood
     if map_data["version"] != 0x1C:
-        return
+        raise ValueError("map version 0x%X is not supported" %
+                         map_data["version"])
     (map_data["hero_present"], map_data["map_size"], map_data["underworld"], 
-        ) = struct.unpack("<BIB", h3m_data.read(6))
-    (name_length, ) = struct.unpack("<I", h3m_data.read(4))
+        ) = h3m_data.unpack(MAP_INFO)
+    (name_length, ) = h3m_data.unpack(DWORD)
     map_data["map_name"] = h3m_data.read(name_length)
-    (desc_length, ) = struct.unpack("<I", h3m_data.read(4))
+    (desc_length, ) = h3m_data.unpack(DWORD)
     map_data["map_desc"] = h3m_data.read(desc_length)
     (map_data["difficulty"], map_data["level_limit"], 
-        ) = struct.unpack("<BB", h3m_data.read(2))
-    
+        ) = h3m_data.unpack(BYTE2)
+
+def read_players(h3m_data, map_data):
     #player info
-    for color in ("Red", "Blue", "Tan", "Green", "Orange", "Purple", "Teal", "Pink"):
+    for color in PLAYER_COLORS:
         map_data[color] = {}
         (map_data[color]["is_human"], map_data[color]["is_computer"],
             map_data[color]["behaviour"], map_data[color]["isCityTypesOpt"],
             map_data[color]["cityTypes"], map_data[color]["randomCity"],
-            ) = struct.unpack("<BBBBHB", h3m_data.read(7))
-        (main_city, ) = struct.unpack("<B", h3m_data.read(1))
+            ) = h3m_data.unpack(PLAYER_INFO)
+        (main_city, ) = h3m_data.unpack(BYTE)
         if main_city:
             map_data[color]["main_city"] = {}
             (map_data[color]["main_city"]["generate_hero"],
                 map_data[color]["main_city"]["type"], 
-                ) = struct.unpack("<BB", h3m_data.read(2))
-            map_data[color]["main_city"]["coords"] = struct.unpack("<BBB", h3m_data.read(3))
+                ) = h3m_data.unpack(BYTE2)
+            map_data[color]["main_city"]["coords"] = h3m_data.unpack(BYTE3)
         (map_data[color]["random_hero"], map_data[color]["hero_type"], 
-            ) = struct.unpack("<BB", h3m_data.read(2))
+            ) = h3m_data.unpack(BYTE2)
         if map_data[color]["hero_type"] != 0xFF:
-            (map_data[color]["hero_portrait"], ) = struct.unpack("<B", h3m_data.read(1))
-            (name_length, ) = struct.unpack("<I", h3m_data.read(4))
+            (map_data[color]["hero_portrait"], ) = h3m_data.unpack(BYTE)
+            (name_length, ) = h3m_data.unpack(DWORD)
             map_data[color]["hero_name"] = h3m_data.read(name_length)
-        h3m_data.read(1) #junk
-        (map_data[color]["heroes_count"], ) = struct.unpack("<I", h3m_data.read(4))
+        h3m_data.skip(1) #junk
+        (map_data[color]["heroes_count"], ) = h3m_data.unpack(DWORD)
         if map_data[color]["heroes_count"] > 0:
-            map_data[color]["heroes"] = {}
+            map_data[color]["heroes"] = []
             for i in xrange(map_data[color]["heroes_count"]):
-                (map_data[color]["heroes"]["portrait"], ) = struct.unpack("<B", h3m_data.read(1))
-                (name_length, ) = struct.unpack("<I", h3m_data.read(4))
-                map_data[color]["heroes"]["name"] = h3m_data.read(name_length)
-    
+                (portrait, ) = h3m_data.unpack(BYTE)
+                name = h3m_data.read_string()
+                map_data[color]["heroes"].append({"portrait":portrait,
+                    "name":name})
+
+def read_conditions(h3m_data, map_data):
     #special victory condition
-    (map_data["victory_conditions"], ) = struct.unpack("<B", h3m_data.read(1))
+    (map_data["victory_conditions"], ) = h3m_data.unpack(BYTE)
     if map_data["victory_conditions"] != 0xFF:
         map_data["victory_conditions"] = {"id":map_data["victory_conditions"]}
-        (map_data["victory_conditions"]["canStandardEnd"], ) = struct.unpack("<B", h3m_data.read(1))
-        (map_data["victory_conditions"]["canComputer"], ) = struct.unpack("<B", h3m_data.read(1))
+        (map_data["victory_conditions"]["canStandardEnd"], ) = h3m_data.unpack(BYTE)
+        (map_data["victory_conditions"]["canComputer"], ) = h3m_data.unpack(BYTE)
         if map_data["victory_conditions"]["id"] == 0x00:
-            (map_data["victory_conditions"]["artID"], ) = struct.unpack("<B", h3m_data.read(1))
+            (map_data["victory_conditions"]["artID"], ) = h3m_data.unpack(BYTE)
         elif map_data["victory_conditions"]["id"] == 0x01:
-            (map_data["victory_conditions"]["creatureID"], ) = struct.unpack("<B", h3m_data.read(1))
-            (map_data["victory_conditions"]["creatureCount"], ) = struct.unpack("<H", h3m_data.read(2))
+            (map_data["victory_conditions"]["creatureID"], ) = h3m_data.unpack(BYTE)
+            (map_data["victory_conditions"]["creatureCount"], ) = h3m_data.unpack(WORD)
         elif map_data["victory_conditions"]["id"] == 0x02:
-            (map_data["victory_conditions"]["resID"], ) = struct.unpack("<B", h3m_data.read(1))
-            (map_data["victory_conditions"]["resCount"], ) = struct.unpack("<I", h3m_data.read(4))
+            (map_data["victory_conditions"]["resID"], ) = h3m_data.unpack(BYTE)
+            (map_data["victory_conditions"]["resCount"], ) = h3m_data.unpack(DWORD)
         elif map_data["victory_conditions"]["id"] == 0x03:
             raise NotImplementedError
         elif map_data["victory_conditions"]["id"] in (0x04, 0x05, 0x06, 0x07):
-            (map_data["victory_conditions"]["x"], ) = struct.unpack("<B", h3m_data.read(1))
-            (map_data["victory_conditions"]["y"], ) = struct.unpack("<B", h3m_data.read(1))
-            (map_data["victory_conditions"]["z"], ) = struct.unpack("<B", h3m_data.read(1))
+            (map_data["victory_conditions"]["x"], ) = h3m_data.unpack(BYTE)
+            (map_data["victory_conditions"]["y"], ) = h3m_data.unpack(BYTE)
+            (map_data["victory_conditions"]["z"], ) = h3m_data.unpack(BYTE)
         elif map_data["victory_conditions"]["id"] in (0x08, 0x09):
             pass
         elif map_data["victory_conditions"]["id"] == 0x0A:
@@ -94,503 +248,637 @@ def extract(filename):
             raise NotImplementedError
     
     #special loss condition
-    (map_data["loss_conditions"], ) = struct.unpack("<B", h3m_data.read(1))
+    (map_data["loss_conditions"], ) = h3m_data.unpack(BYTE)
     if map_data["loss_conditions"] != 0xFF:
         map_data["loss_conditions"] = {"id":map_data["loss_conditions"]}
         if map_data["loss_conditions"]["id"] in (0x00, 0x01):
-            (map_data["loss_conditions"]["x"], ) = struct.unpack("<B", h3m_data.read(1))
-            (map_data["loss_conditions"]["y"], ) = struct.unpack("<B", h3m_data.read(1))
-            (map_data["loss_conditions"]["z"], ) = struct.unpack("<B", h3m_data.read(1))
+            (map_data["loss_conditions"]["x"], ) = h3m_data.unpack(BYTE)
+            (map_data["loss_conditions"]["y"], ) = h3m_data.unpack(BYTE)
+            (map_data["loss_conditions"]["z"], ) = h3m_data.unpack(BYTE)
         elif map_data["loss_conditions"]["id"] == 0x02:
-            #to be researched
-            struct.unpack("<B", h3m_data.read(1))
-            struct.unpack("<B", h3m_data.read(1))
+            #to be researched, kept so the map can be written back
+            map_data["loss_conditions"]["unknown"] = h3m_data.unpack(BYTE2)
         elif map_data["loss_conditions"]["id"] == 0x03:
-            (map_data["loss_conditions"]["days"], ) = struct.unpack("<H", h3m_data.read(1))
+            (map_data["loss_conditions"]["days"], ) = h3m_data.unpack(WORD)
         else:
             raise NotImplementedError
     
     #Teams
-    (map_data["commands_count"], ) = struct.unpack("<B", h3m_data.read(1))
+    (map_data["commands_count"], ) = h3m_data.unpack(BYTE)
     if map_data["commands_count"] > 0:
-        map_data["commands"] = struct.unpack("<8B", h3m_data.read(8))
-    
+        map_data["commands"] = h3m_data.unpack(BYTE8)
+
+def read_heroes(h3m_data, map_data):
     #Free Heroes
-    h3m_data.read(20) #free heroes
-    h3m_data.read(4) #junk
-    (map_data["heroes_count"], ) = struct.unpack("<B", h3m_data.read(1))
+    map_data["allowed_heroes"] = h3m_data.read(20) #bitmask
+    h3m_data.skip(4) #junk
+    (map_data["heroes_count"], ) = h3m_data.unpack(BYTE)
     if map_data["heroes_count"] > 0:
         map_data["free_heroes"] = []
         for i in xrange(map_data["heroes_count"]):
-            (hero_id, ) = struct.unpack("<B", h3m_data.read(1))
-            (hero_portrait, ) = struct.unpack("<B", h3m_data.read(1))
-            (name_length, ) = struct.unpack("<I", h3m_data.read(4))
+            (hero_id, ) = h3m_data.unpack(BYTE)
+            (hero_portrait, ) = h3m_data.unpack(BYTE)
+            (name_length, ) = h3m_data.unpack(DWORD)
             hero_name = h3m_data.read(name_length)
-            (hero_players, ) = struct.unpack("<B", h3m_data.read(1))
+            (hero_players, ) = h3m_data.unpack(BYTE)
             map_data["free_heroes"].append({"id": hero_id, "portrait":hero_portrait, "name":hero_name, "players":hero_players})
-    h3m_data.read(31) #junk
-    
-    #artefacts
-    h3m_data.read(18)
+    h3m_data.skip(31) #junk
     
-    #spells
-    h3m_data.read(9)
-    
-    #sec skillz
-    h3m_data.read(4)
+    #artefacts, spells and sec skillz bitmasks
+    map_data["allowed_artifacts"] = h3m_data.read(18)
+    map_data["allowed_spells"] = h3m_data.read(9)
+    map_data["allowed_skills"] = h3m_data.read(4)
     
     #rumors
-    (map_data["rumor_count"], ) = struct.unpack("<I", h3m_data.read(4))
+    (map_data["rumor_count"], ) = h3m_data.unpack(DWORD)
     if map_data["rumor_count"] > 0:
         map_data["rumors"] = []
         for i in xrange(map_data["rumor_count"]):
-            (name_length, ) = struct.unpack("<I", h3m_data.read(4))
+            (name_length, ) = h3m_data.unpack(DWORD)
             rumor_name = h3m_data.read(name_length)
-            (text_length, ) = struct.unpack("<I", h3m_data.read(4))
+            (text_length, ) = h3m_data.unpack(DWORD)
             rumor_text = h3m_data.read(text_length)
             map_data["rumors"].append({"name":rumor_name, "text":rumor_text})
     
-    #hero options
+    #hero options, hero number -> customized settings
+    map_data["hero_options"] = {}
     for i in xrange(156):
-        (hero_enable, ) = struct.unpack("<B", h3m_data.read(1))
+        (hero_enable, ) = h3m_data.unpack(BYTE)
         if hero_enable == 1:
-            (isExp, ) = struct.unpack("<B", h3m_data.read(1))
+            options = map_data["hero_options"][i] = {}
+            (isExp, ) = h3m_data.unpack(BYTE)
             if isExp == 0x01:
-                (exp, ) = struct.unpack("<I", h3m_data.read(4))
-            (isSecSkill, ) = struct.unpack("<B", h3m_data.read(1))
+                (options["exp"], ) = h3m_data.unpack(DWORD)
+            (isSecSkill, ) = h3m_data.unpack(BYTE)
             if isSecSkill == 0x01:
-                (skills_count) = struct.unpack("<I", h3m_data.read(4))
-                for i in xrange(skills_count):
-                    (skill_id, ) = struct.unpack("<B", h3m_data.read(1))
-                    (skill_lvl, ) = struct.unpack("<B", h3m_data.read(1))
-            (isArtifact, ) = struct.unpack("<B", h3m_data.read(1))
+                (skills_count, ) = h3m_data.unpack(DWORD)
+                options["sec_skills"] = [h3m_data.unpack(BYTE2)
+                                         for j in xrange(skills_count)]
+            (isArtifact, ) = h3m_data.unpack(BYTE)
             if isArtifact == 0x01:
                 raise NotImplementedError
-            (isBiography, ) = struct.unpack("<B", h3m_data.read(1))
+            (isBiography, ) = h3m_data.unpack(BYTE)
             if isBiography == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                biography = h3m_data.read(length)
-            (gender, ) = struct.unpack("<B", h3m_data.read(1))
-            (isSpells, ) = struct.unpack("<B", h3m_data.read(1))
+                options["biography"] = h3m_data.read_string()
+            (options["gender"], ) = h3m_data.unpack(BYTE)
+            (isSpells, ) = h3m_data.unpack(BYTE)
             if isSpells == 0x01:
-                spells = struct.unpack("<9B", h3m_data.read(9))
-            (isPrimarySkills, ) = struct.unpack("<B", h3m_data.read(1))
+                options["spells"] = h3m_data.unpack(BYTE9)
+            (isPrimarySkills, ) = h3m_data.unpack(BYTE)
             if isPrimarySkills == 0x01:
-                (attack, defense, power, knowledge) = struct.unpack("<4B", h3m_data.read(4))
-    
-    map_data["upper_terrain"] = [[] for i in xrange(map_data["map_size"])]
+                options["primary_skills"] = h3m_data.unpack(BYTE4)
+
+def read_terrain(h3m_data, map_data, arrays=False):
+    size = map_data["map_size"]
+    if arrays:
+        read_terrain = lambda: h3m_data.read_array((size, size, TILE.size))
+    else:
+        read_terrain = lambda: h3m_data.unpack_grid(TILE, size)
     #read upper world
-    for i in xrange(map_data["map_size"]**2):
-        x = i%map_data["map_size"]
-        y = (i-x)/map_data["map_size"]
-        map_data["upper_terrain"][y].append(struct.unpack("<7B", h3m_data.read(7)))
+    map_data["upper_terrain"] = read_terrain()
     
     #read underworld
     if map_data["underworld"]:
-        map_data["lower_terrain"] = [[] for i in xrange(map_data["map_size"])]
-        for i in xrange(map_data["map_size"]**2):
-            x = i%map_data["map_size"]
-            y = (i-x)/map_data["map_size"]
-            map_data["lower_terrain"][y].append(struct.unpack("<7B", h3m_data.read(7)))
-    
-    (map_data["object_count"], ) = struct.unpack("<I", h3m_data.read(4))
+        map_data["lower_terrain"] = read_terrain()
+
+def skip_terrain(h3m_data, map_data):
+    levels = 2 if map_data["underworld"] else 1
+    h3m_data.skip(TILE.size * map_data["map_size"]**2 * levels)
+
+def read_templates(h3m_data, map_data):
+    (map_data["object_count"], ) = h3m_data.unpack(DWORD)
     map_data["objects"] = []
     for i in xrange(map_data["object_count"]):
-        (length, ) = struct.unpack("<I", h3m_data.read(4))
+        (length, ) = h3m_data.unpack(DWORD)
         filename = h3m_data.read(length)
-        h3m_data.read(6) #passability
-        h3m_data.read(6) #actions
-        h3m_data.read(2) #landscape
-        h3m_data.read(2) #land_edit_groups
-        (obj_class, ) = struct.unpack("<I", h3m_data.read(4)) #class
-        (obj_number, ) = struct.unpack("<I", h3m_data.read(4)) #number
-        (obj_group, ) = struct.unpack("<B", h3m_data.read(1)) #group
-        h3m_data.read(1) #isOverlay
-        h3m_data.read(16) #junk
+        passability = h3m_data.read(6) #bitmasks, one byte per row
+        actions = h3m_data.read(6)
+        (landscape, land_edit_groups, obj_class, obj_number, obj_group,
+            overlay) = h3m_data.unpack(TEMPLATE)
+        h3m_data.skip(16) #junk
+        #filename is lowercased for the resource loader, name keeps the case
+        #the map was saved with
         map_data["objects"].append({"filename":filename.lower(), "class":obj_class,
-            "number":obj_number, "group":obj_group})
-    
-    (map_data["tunedobj_count"], ) = struct.unpack("<I", h3m_data.read(4))
+            "number":obj_number, "group":obj_group, "name":filename,
+            "passability":passability, "actions":actions,
+            "landscape":landscape, "land_edit_groups":land_edit_groups,
+            "overlay":overlay})
+
+#the decoders below fill the tuned object record they are given with the
+#fields that follow the object position, one decoder per object class
+
+def read_guards(h3m_data):
+    guards = h3m_data.unpack(GUARDS)
+    return zip(guards[0::2], guards[1::2])
+
+def read_message(h3m_data, obj):
+    """optional message and guards in front of artifacts, resources etc."""
+    (isText, ) = h3m_data.unpack(BYTE)
+    if isText == 0x01:
+        obj["text"] = h3m_data.read_string()
+        (isGuards, ) = h3m_data.unpack(BYTE)
+        if isGuards == 0x01:
+            obj["guards"] = read_guards(h3m_data)
+        h3m_data.skip(4) #junk
+
+def read_quest(h3m_data, obj):
+    (quest, ) = h3m_data.unpack(BYTE)
+    obj["quest"] = quest
+    if quest == 0x00:
+        pass
+    elif quest == 0x01:
+        (obj["quest_value"], ) = h3m_data.unpack(DWORD) #level
+    elif quest == 0x02:
+        obj["quest_value"] = h3m_data.unpack(BYTE4) #primary skills
+    elif quest in (0x03, 0x04):
+        (obj["quest_value"], ) = h3m_data.unpack(DWORD) #hero or monster id
+    elif quest == 0x05:
+        (art_quantity, ) = h3m_data.unpack(BYTE)
+        obj["quest_value"] = [h3m_data.unpack(WORD)[0]
+                              for i in xrange(art_quantity)]
+    elif quest == 0x06:
+        (creatures_quantity, ) = h3m_data.unpack(BYTE)
+        obj["quest_value"] = [h3m_data.unpack(GUARD)
+                              for i in xrange(creatures_quantity)]
+    elif quest == 0x07:
+        obj["quest_value"] = h3m_data.unpack(RESOURCES)
+    elif quest in (0x08, 0x09):
+        (obj["quest_value"], ) = h3m_data.unpack(BYTE) #hero or player
+    else:
+        raise NotImplementedError
+    (obj["time_limit"], ) = h3m_data.unpack(DWORD)
+    obj["quest_begin"] = h3m_data.read_string()
+    obj["quest_running"] = h3m_data.read_string()
+    obj["quest_end"] = h3m_data.read_string()
+
+def read_reward(h3m_data, obj):
+    (reward, ) = h3m_data.unpack(BYTE)
+    obj["reward"] = reward
+    if reward == 0x00:
+        pass
+    elif reward in (0x01, 0x02):
+        (obj["reward_value"], ) = h3m_data.unpack(DWORD) #exp, spell points
+    elif reward in (0x03, 0x04, 0x09):
+        (obj["reward_value"], ) = h3m_data.unpack(BYTE) #morale, luck, spell
+    elif reward == 0x05:
+        obj["reward_value"] = h3m_data.unpack(BYTE_DWORD) #resource
+    elif reward in (0x06, 0x07):
+        obj["reward_value"] = h3m_data.unpack(BYTE2) #primary, secondary
+    elif reward == 0x08:
+        (obj["reward_value"], ) = h3m_data.unpack(WORD) #artifact
+    elif reward == 0x0A:
+        obj["reward_value"] = h3m_data.unpack(GUARD) #creatures
+    else:
+        raise NotImplementedError
+
+def read_rewards(h3m_data, obj):
+    """what pandora boxes and events hand out"""
+    read_message(h3m_data, obj)
+    rewards = h3m_data.unpack(REWARD)
+    (obj["exp"], obj["spell_points"], obj["morale"], obj["luck"]) = \
+        rewards[:4]
+    obj["resources"] = rewards[4:11]
+    obj["primary_skills"] = rewards[11:15]
+    (secSkills, ) = h3m_data.unpack(BYTE)
+    obj["sec_skills"] = [h3m_data.unpack(BYTE2) for i in xrange(secSkills)]
+    (artefacts, ) = h3m_data.unpack(BYTE)
+    obj["artifacts"] = [h3m_data.unpack(WORD)[0] for i in xrange(artefacts)]
+    (spells, ) = h3m_data.unpack(BYTE)
+    obj["spells"] = [h3m_data.unpack(BYTE)[0] for i in xrange(spells)]
+    (monsters, ) = h3m_data.unpack(BYTE)
+    obj["creatures"] = [h3m_data.unpack(GUARD) for i in xrange(monsters)]
+    h3m_data.skip(8) #junk
+
+def read_owner(h3m_data, obj):
+    (obj["owner"], ) = h3m_data.unpack(DWORD)
+
+def read_resource(h3m_data, obj):
+    read_message(h3m_data, obj)
+    (obj["quantity"], ) = h3m_data.unpack(DWORD)
+    h3m_data.skip(4) #junk
+
+def read_hero(h3m_data, obj):
+    (obj["hero_id"], obj["owner"], obj["hero"]) = \
+        h3m_data.unpack(DWORD_BYTE2)
+    (isName, ) = h3m_data.unpack(BYTE)
+    if isName == 0x01:
+        obj["name"] = h3m_data.read_string()
+    (isExp, ) = h3m_data.unpack(BYTE)
+    if isExp == 0x01:
+        (obj["exp"], ) = h3m_data.unpack(DWORD)
+    (isPortrait, ) = h3m_data.unpack(BYTE)
+    if isPortrait == 0x01:
+        (obj["portrait"], ) = h3m_data.unpack(BYTE)
+    (isSecSkill, ) = h3m_data.unpack(BYTE)
+    if isSecSkill == 0x01:
+        (skills_count, ) = h3m_data.unpack(DWORD)
+        obj["sec_skills"] = [h3m_data.unpack(BYTE2)
+                             for i in xrange(skills_count)]
+    (isCreature, ) = h3m_data.unpack(BYTE)
+    if isCreature == 0x01:
+        obj["guards"] = read_guards(h3m_data)
+    (obj["formation"], ) = h3m_data.unpack(BYTE)
+    (isArtifact, ) = h3m_data.unpack(BYTE)
+    if isArtifact == 0x01:
+        obj["artifacts"] = h3m_data.unpack(ARTIFACT_SLOTS)
+        (knapsack_count, ) = h3m_data.unpack(WORD)
+        obj["knapsack"] = [h3m_data.unpack(WORD)[0]
+                           for i in xrange(knapsack_count)]
+    (obj["zone_radius"], ) = h3m_data.unpack(BYTE)
+    (isBiography, ) = h3m_data.unpack(BYTE)
+    if isBiography == 0x01:
+        obj["biography"] = h3m_data.read_string()
+    (obj["gender"], ) = h3m_data.unpack(BYTE)
+    (isSpells, ) = h3m_data.unpack(BYTE)
+    if isSpells == 0x01:
+        obj["spells"] = h3m_data.unpack(BYTE9)
+    (isPrimarySkills, ) = h3m_data.unpack(BYTE)
+    if isPrimarySkills == 0x01:
+        obj["primary_skills"] = h3m_data.unpack(BYTE4)
+    h3m_data.skip(16) #unknown
+
+def read_spell_scroll(h3m_data, obj):
+    read_message(h3m_data, obj)
+    (obj["spell_id"], ) = h3m_data.unpack(DWORD)
+
+def read_random_dwelling(h3m_data, obj):
+    (obj["owner"], obj["castle_id"]) = h3m_data.unpack(DWORD2)
+    if obj["castle_id"] == 0x00:
+        (obj["towns"], ) = h3m_data.unpack(WORD)
+
+def read_random_dwelling_any(h3m_data, obj):
+    read_random_dwelling(h3m_data, obj)
+    (obj["minlevel"], obj["maxlevel"]) = h3m_data.unpack(BYTE2)
+
+def read_random_dwelling_level(h3m_data, obj):
+    (obj["owner"], obj["minlevel"], obj["maxlevel"]) = \
+        h3m_data.unpack(DWORD_BYTE2)
+
+def read_monster(h3m_data, obj):
+    (obj["monster_id"], obj["count"], obj["mood"], isTreasureOrText) = \
+        h3m_data.unpack(MONSTER)
+    if isTreasureOrText == 0x01:
+        obj["text"] = h3m_data.read_string()
+        treasure = h3m_data.unpack(RESOURCES_ARTIFACT)
+        obj["resources"] = treasure[:7]
+        obj["artifact"] = treasure[7]
+    (obj["never_flees"], obj["no_grow"]) = h3m_data.unpack(BYTE2)
+    h3m_data.skip(2) #junk
+
+def read_town_event(h3m_data):
+    event = {}
+    event["name"] = h3m_data.read_string()
+    event["text"] = h3m_data.read_string()
+    values = h3m_data.unpack(TOWN_EVENT)
+    event["resources"] = values[:7]
+    (event["players_affected"], event["human_affected"],
+        event["ai_affected"], event["day_of_first_event"],
+        event["event_iteration"]) = values[7:]
+    h3m_data.skip(16) #junk
+    event["buildings"] = h3m_data.unpack(BYTE6)
+    event["creatures"] = h3m_data.unpack(WORD7)
+    h3m_data.skip(4) #junk
+    return event
+
+def read_town(h3m_data, obj):
+    (obj["identifier"], ) = h3m_data.unpack(DWORD)
+    (obj["owner"], ) = h3m_data.unpack(BYTE)
+    (isName, ) = h3m_data.unpack(BYTE)
+    if isName == 0x01:
+        obj["name"] = h3m_data.read_string()
+    (isGuard, ) = h3m_data.unpack(BYTE)
+    if isGuard == 0x01:
+        obj["guards"] = read_guards(h3m_data)
+    (obj["formation"], ) = h3m_data.unpack(BYTE)
+    (isBuildings, ) = h3m_data.unpack(BYTE)
+    if isBuildings == 0x01:
+        obj["buildings"] = h3m_data.unpack(BYTE6)
+        obj["active"] = h3m_data.unpack(BYTE6)
+    else:
+        (obj["fort"], ) = h3m_data.unpack(BYTE)
+    obj["must_spells"] = h3m_data.unpack(BYTE9)
+    obj["can_spells"] = h3m_data.unpack(BYTE9)
+    (eventQuantity, ) = h3m_data.unpack(DWORD)
+    obj["events"] = [read_town_event(h3m_data)
+                     for i in xrange(eventQuantity)]
+    (obj["alignment"], ) = h3m_data.unpack(BYTE)
+    h3m_data.skip(3) #junk
+
+def read_garrison(h3m_data, obj):
+    (obj["owner"], ) = h3m_data.unpack(DWORD)
+    obj["guards"] = read_guards(h3m_data)
+    (obj["removable_units"], ) = h3m_data.unpack(BYTE)
+    h3m_data.skip(8) #junk
+
+def read_seer_hut(h3m_data, obj):
+    read_quest(h3m_data, obj)
+    read_reward(h3m_data, obj)
+    h3m_data.skip(2) #junk
+
+def read_sign(h3m_data, obj):
+    obj["text"] = h3m_data.read_string()
+    h3m_data.skip(4) #junk
+
+def read_witch_hut(h3m_data, obj):
+    (obj["skills"], ) = h3m_data.unpack(DWORD)
+
+def read_shrine(h3m_data, obj):
+    (obj["spell_id"], ) = h3m_data.unpack(DWORD)
+
+def read_grail(h3m_data, obj):
+    (obj["radius"], ) = h3m_data.unpack(BYTE)
+    h3m_data.skip(3) #junk
+
+def read_abandoned_mine(h3m_data, obj):
+    (obj["resources"], ) = h3m_data.unpack(BYTE)
+    h3m_data.skip(3) #junk
+
+def read_scholar(h3m_data, obj):
+    (obj["bonus_type"], obj["bonus_id"]) = h3m_data.unpack(BYTE_DWORD)
+    h3m_data.skip(3) #junk
+
+def read_event(h3m_data, obj):
+    read_rewards(h3m_data, obj)
+    (obj["players"], obj["ai_can"], obj["disable_after_first_day"]) = \
+        h3m_data.unpack(BYTE3)
+    h3m_data.skip(4) #junk
+
+#object class -> decoder, classes not listed have no extra fields
+TUNEDOBJ_READERS = {
+    5: read_message, #artifact
+    6: read_rewards, #pandora box
+    17: read_owner, #creature generator
+    20: read_owner, #creature generator
+    26: read_event,
+    33: read_garrison,
+    34: read_hero,
+    36: read_grail,
+    42: read_owner, #lighthouse
+    53: read_owner, #mine
+    54: read_monster,
+    59: read_sign, #bottle
+    62: read_hero, #prison
+    65: read_message, #random artifacts
+    66: read_message,
+    67: read_message,
+    68: read_message,
+    69: read_message,
+    70: read_hero, #random hero
+    71: read_monster, #random monsters
+    72: read_monster,
+    73: read_monster,
+    74: read_monster,
+    75: read_monster,
+    76: read_resource, #random resource
+    77: read_town, #random town
+    79: read_resource,
+    81: read_scholar,
+    83: read_seer_hut,
+    87: read_owner, #shipyard
+    88: read_shrine,
+    89: read_shrine,
+    90: read_shrine,
+    91: read_sign,
+    93: read_spell_scroll,
+    98: read_town,
+    113: read_witch_hut,
+    162: read_monster,
+    163: read_monster,
+    164: read_monster,
+    215: read_quest, #quest guard
+    216: read_random_dwelling_any,
+    217: read_random_dwelling,
+    218: read_random_dwelling_level,
+    219: read_garrison,
+    220: read_abandoned_mine,
+}
+
+def iter_tunedobj_records(h3m_data, templates, count):
+    """decode count tuned objects one by one from the reader"""
+    #look up the decoder once per template instead of once per object
+    readers = [TUNEDOBJ_READERS.get(template["class"])
+               for template in templates]
+    #the first two templates never have extra fields
+    readers[:2] = [None] * len(readers[:2])
     
-    map_data["tunedobj"] = []
-    for i in xrange(map_data["tunedobj_count"]):
-        (x, y, z) = struct.unpack("<3B", h3m_data.read(3))
-        (object_id, ) = struct.unpack("<I", h3m_data.read(4))
-        #print x,y,z,object_id,
+    for i in xrange(count):
+        (x, y, z, object_id) = h3m_data.unpack(POSITION)
         junk = h3m_data.read(5) #junk
         if junk != "\x00\x00\x00\x00\x00":
             for c in junk:
                 print "%02d"%ord(c),
-            break
-        #print i, map_data["objects"][object_id]["filename"],
-        #print map_data["objects"][object_id]["class"]
+            return
         
-        map_data["tunedobj"].append({"id":object_id, "x":x, "y":y, "z":z})
-        
-        if object_id in (0,1):
-            pass
-        elif map_data["objects"][object_id]["class"] == 53:
-            if map_data["objects"][object_id]["number"] == 7:
-                h3m_data.read(4)
-            else:
-                h3m_data.read(4)
-        elif map_data["objects"][object_id]["class"] in (76, 79):
-            (isText, ) = struct.unpack("<B", h3m_data.read(1))
-            if isText == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                text = h3m_data.read(length)
-                (isGuards, ) = struct.unpack("<B", h3m_data.read(1))
-                if isGuards == 0x01:
-                    for i in xrange(7):
-                        (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-                h3m_data.read(4) #junk
-            (quantity, ) = struct.unpack("<I", h3m_data.read(4))
-            h3m_data.read(4) #junk
-        elif map_data["objects"][object_id]["class"] in (34, 70, 62):
-            (hero_id, color, hero) = struct.unpack("<IBB", h3m_data.read(6))
-            (isName, ) = struct.unpack("<B", h3m_data.read(1))
-            if isName == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                name = h3m_data.read(length)
-            (isExp, ) = struct.unpack("<B", h3m_data.read(1))
-            if isExp == 0x01:
-                (exp, ) = struct.unpack("<I", h3m_data.read(4))
-            (isPortrait, ) = struct.unpack("<B", h3m_data.read(1))
-            if isPortrait == 0x01:
-                (portrait, ) = struct.unpack("<B", h3m_data.read(1))
-            (isSecSkill, ) = struct.unpack("<B", h3m_data.read(1))
-            if isSecSkill == 0x01:
-                (skills_count, ) = struct.unpack("<I", h3m_data.read(4))
-                for i in xrange(skills_count):
-                    (skill_id, ) = struct.unpack("<B", h3m_data.read(1))
-                    (skill_lvl, ) = struct.unpack("<B", h3m_data.read(1))
-            (isCreature, ) = struct.unpack("<B", h3m_data.read(1))
-            if isCreature == 0x01:
-                for i in xrange(7):
-                    (guard_id, ) = struct.unpack("<H", h3m_data.read(2))
-                    (guard_count, ) = struct.unpack("<H", h3m_data.read(2))
-            (creaturesFormation, ) = struct.unpack("<B", h3m_data.read(1))
-            (isArtifact, ) = struct.unpack("<B", h3m_data.read(1))
-            if isArtifact == 0x01:
-                (headID, shouldersID, neckID, rightHandID, leftHandID, 
-                trunkID, rightRingID, leftRingID, legsID, misc1ID, misc2ID,
-                misc3ID, misc4ID, machine1ID, machine2ID, machine3ID,
-                machine4ID, magicbook, misc5ID) \
-                    = struct.unpack("<19H", h3m_data.read(38))
-                (knapsack_count, ) = struct.unpack("<H", h3m_data.read(2))
-                if knapsack_count > 0:
-                    for i in xrange(knapsack_count):
-                        (knapsackID, ) = struct.unpack("<H", h3m_data.read(2))
-            (zoneRadius, ) = struct.unpack("<B", h3m_data.read(1))
-            (isBiography, ) = struct.unpack("<B", h3m_data.read(1))
-            if isBiography == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                biography = h3m_data.read(length)
-            (gender, ) = struct.unpack("<B", h3m_data.read(1))
-            (isSpells, ) = struct.unpack("<B", h3m_data.read(1))
-            if isSpells == 0x01:
-                spells = struct.unpack("<9B", h3m_data.read(9))
-            (isPrimarySkills, ) = struct.unpack("<B", h3m_data.read(1))
-            if isPrimarySkills == 0x01:
-                (attack, defense, power, knowledge) = struct.unpack("<4B", h3m_data.read(4))
-            h3m_data.read(16) #unknown
-        elif map_data["objects"][object_id]["class"] in (17, 20, 42):
-            (owner, ) = struct.unpack("<I", h3m_data.read(4))
-        elif map_data["objects"][object_id]["class"] == 93:
-            (isText, ) = struct.unpack("<B", h3m_data.read(1))
-            if isText == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                text = h3m_data.read(length)
-                (isGuards, ) = struct.unpack("<B", h3m_data.read(1))
-                if isGuards == 0x01:
-                    for i in xrange(7):
-                        (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-                h3m_data.read(4) #junk
-            (spell_id, ) = struct.unpack("<I", h3m_data.read(4))
-        elif map_data["objects"][object_id]["class"] == 216:
-            (owner, ) = struct.unpack("<I", h3m_data.read(4))
-            (junk, ) = struct.unpack("<I", h3m_data.read(4))
-            if junk == 0x00:
-                (towns, ) = struct.unpack("<H", h3m_data.read(2))
-            (minlevel, maxlevel, ) = struct.unpack("<2B", h3m_data.read(2))
-        elif map_data["objects"][object_id]["class"] in (54, 71, 72, 73, 74, 75, 162, 163, 164):
-            (monster_id, ) = struct.unpack("<I", h3m_data.read(4))
-            (monster_count, ) = struct.unpack("<H", h3m_data.read(2))
-            (mood, ) = struct.unpack("<B", h3m_data.read(1))
-            (isTreasureOrText, ) = struct.unpack("<B", h3m_data.read(1))
-            if isTreasureOrText == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                text = h3m_data.read(length)
-                (wood, mercury, ore, sulfur, crystal, gem, gold, artefactID) \
-                    = struct.unpack("<7IH", h3m_data.read(30))
-            (mosterNeverRunAway, ) = struct.unpack("<B", h3m_data.read(1))
-            (monsterDontGrowUp, ) = struct.unpack("<B", h3m_data.read(1))
-            h3m_data.read(2) #junk
-        elif map_data["objects"][object_id]["class"] in (98, 77):
-            h3m_data.read(4) #junk
-            (owner, ) = struct.unpack("<B", h3m_data.read(1))
-            (isName, ) = struct.unpack("<B", h3m_data.read(1))
-            if isName == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                name = h3m_data.read(length)
-            (isGuard, ) = struct.unpack("<B", h3m_data.read(1))
-            if isGuard == 0x01:
-                for i in xrange(7):
-                    (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-            (formation, ) = struct.unpack("<B", h3m_data.read(1))
-            (isBuildings, ) = struct.unpack("<B", h3m_data.read(1))
-            if isBuildings == 0x01:
-                build = struct.unpack("6B", h3m_data.read(6))
-                active = struct.unpack("6B", h3m_data.read(6))
-            else:
-                (isFort, ) = struct.unpack("<B", h3m_data.read(1))
-            mustSpells = struct.unpack("<9B", h3m_data.read(9))
-            canSpells = struct.unpack("<9B", h3m_data.read(9))
-            (eventQuantity, ) = struct.unpack("<I", h3m_data.read(4))
-            if eventQuantity > 0:
-                for i in xrange(eventQuantity):
-                    (length, ) = struct.unpack("<I", h3m_data.read(4))
-                    event_name = h3m_data.read(length)
-                    (length, ) = struct.unpack("<I", h3m_data.read(4))
-                    event_text = h3m_data.read(length)
-                    (wood, mercury, ore, sulfur, crystal, gem, gold, 
-                    players_affected, human_affected, ai_affected, 
-                    day_of_first_event, event_iteration) \
-                        = struct.unpack("<7I3B2H", h3m_data.read(35))
-                    h3m_data.read(16) #junk
-                    buildings = struct.unpack("<6B", h3m_data.read(6))
-                    creatures = struct.unpack("<7H", h3m_data.read(14))
-                    h3m_data.read(4) #junk
-            h3m_data.read(4) #junk
-        elif map_data["objects"][object_id]["class"] in (5, 65, 66, 67, 68, 69):
-            (isText, ) = struct.unpack("<B", h3m_data.read(1))
-            if isText == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                text = h3m_data.read(length)
-                (isGuards, ) = struct.unpack("<B", h3m_data.read(1))
-                if isGuards == 0x01:
-                    for i in xrange(7):
-                        (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-                h3m_data.read(4) #junk
-        elif map_data["objects"][object_id]["class"] in (33, 219):
-            (color, ) = struct.unpack("<I", h3m_data.read(4))
-            for i in xrange(7):
-                (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-            (undeleteSoldiers, ) = struct.unpack("<B", h3m_data.read(1))
-            h3m_data.read(8)
-        elif map_data["objects"][object_id]["class"] == 87:
-            (owner, ) = struct.unpack("<I", h3m_data.read(4))
-        elif map_data["objects"][object_id]["class"] == 83:
-            (quest, ) = struct.unpack("<B", h3m_data.read(1))
-            
-            if quest == 0x00:
-                pass
-            elif quest == 0x01:
-                (level, ) = struct.unpack("<I", h3m_data.read(4))
-            elif quest == 0x02:
-                (offence, defence, power, knowledge) = struct.unpack("4B", h3m_data.read(4))
-            elif quest == 0x03:
-                (hero_id, ) = struct.unpack("<I", h3m_data.read(4))
-            elif quest == 0x04:
-                (monster_id, ) = struct.unpack("<I", h3m_data.read(4))
-            elif quest == 0x05:
-                (art_quantity, ) = struct.unpack("<B", h3m_data.read(1))
-                for i in xrange(art_quantity):
-                    (art, ) = struct.unpack("<H", h3m_data.read(2))
-            elif quest == 0x06:
-                (creatures_quantity, ) = struct.unpack("<B", h3m_data.read(1))
-                for i in xrange(creatures_quantity):
-                    (guard_id, ) = struct.unpack("<H", h3m_data.read(2))
-                    (guard_count, ) = struct.unpack("<H", h3m_data.read(2))
-            elif quest == 0x07:
-                resources = struct.unpack("7I", h3m_data.read(28))
-            elif quest == 0x08:
-                (hero_id, ) = struct.unpack("<B", h3m_data.read(1))
-            elif quest == 0x09:
-                (player, ) = struct.unpack("<B", h3m_data.read(1))
-            else:
-                raise NotImplementedError
-            
-            (time_limit, ) = struct.unpack("<I", h3m_data.read(4))
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
-            quest_begin = h3m_data.read(length)
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
-            quest_running = h3m_data.read(length)
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
-            quest_end = h3m_data.read(length)
-            
-            (reward, ) = struct.unpack("<B", h3m_data.read(1))
-            if reward == 0x00:
-                pass
-            elif reward == 0x01:
-                (exp, ) = struct.unpack("<I", h3m_data.read(4))
-            elif reward == 0x02:
-                (spell_points, ) = struct.unpack("<I", h3m_data.read(4))
-            elif reward == 0x03:
-                (morale, ) = struct.unpack("<B", h3m_data.read(1))
-            elif reward == 0x04:
-                (lucky, ) = struct.unpack("<B", h3m_data.read(1))
-            elif reward == 0x05:
-                (resID, ) = struct.unpack("<B", h3m_data.read(1))
-                (res_quantity, ) = struct.unpack("<I", h3m_data.read(4))
-            elif reward == 0x06:
-                (priSkillID, ) = struct.unpack("<B", h3m_data.read(1))
-                (priSkillBonus, ) = struct.unpack("<B", h3m_data.read(1))
-            elif reward == 0x07:
-                (secSkillID, ) = struct.unpack("<B", h3m_data.read(1))
-                (secSkillBonus, ) = struct.unpack("<B", h3m_data.read(1))
-            elif reward == 0x08:
-                (artID, ) = struct.unpack("<H", h3m_data.read(2))
-            elif reward == 0x09:
-                (spellID, ) = struct.unpack("<B", h3m_data.read(1))
-            elif reward == 0x0A:
-                (creatureID, ) = struct.unpack("<H", h3m_data.read(2))
-                (creatureQuantity, ) = struct.unpack("<H", h3m_data.read(2))
-            else:
-                raise NotImplementedError
-            
-            h3m_data.read(2) #junk
-        elif map_data["objects"][object_id]["class"] in (91, 59):
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
-            text = h3m_data.read(length)
-            h3m_data.read(4) #junk
-        elif map_data["objects"][object_id]["class"] == 113:
-            (secSkills, ) = struct.unpack("<I", h3m_data.read(4))
-        elif map_data["objects"][object_id]["class"] in (88, 89, 90):
-            (spellID, ) = struct.unpack("<I", h3m_data.read(4))
-        elif map_data["objects"][object_id]["class"] == 215:
-            (quest, ) = struct.unpack("<B", h3m_data.read(1))
-            
-            if quest == 0x00:
-                pass
-            elif quest == 0x01:
-                (level, ) = struct.unpack("<I", h3m_data.read(4))
-            elif quest == 0x02:
-                (offence, defence, power, knowledge) = struct.unpack("4B", h3m_data.read(4))
-            elif quest == 0x03:
-                (hero_id, ) = struct.unpack("<I", h3m_data.read(4))
-            elif quest == 0x04:
-                (monster_id, ) = struct.unpack("<I", h3m_data.read(4))
-            elif quest == 0x05:
-                (art_quantity, ) = struct.unpack("<B", h3m_data.read(1))
-                for i in xrange(art_quantity):
-                    (art, ) = struct.unpack("<H", h3m_data.read(2))
-            elif quest == 0x06:
-                (creatures_quantity, ) = struct.unpack("<B", h3m_data.read(1))
-                for i in xrange(creatures_quantity):
-                    (guard_id, ) = struct.unpack("<H", h3m_data.read(2))
-                    (guard_count, ) = struct.unpack("<H", h3m_data.read(2))
-            elif quest == 0x07:
-                resources = struct.unpack("7I", h3m_data.read(28))
-            elif quest == 0x08:
-                (hero_id, ) = struct.unpack("<B", h3m_data.read(1))
-            elif quest == 0x09:
-                (player, ) = struct.unpack("<B", h3m_data.read(1))
-            else:
-                raise NotImplementedError
-            
-            (time_limit, ) = struct.unpack("<I", h3m_data.read(4))
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
-            quest_begin = h3m_data.read(length)
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
-            quest_running = h3m_data.read(length)
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
-            quest_end = h3m_data.read(length)
-        elif map_data["objects"][object_id]["class"] == 36:
-            (radius, ) = struct.unpack("<B", h3m_data.read(1))
-            h3m_data.read(3) #junk
-        elif map_data["objects"][object_id]["class"] == 220:
-            (resources, ) = struct.unpack("<B", h3m_data.read(1))
-            h3m_data.read(3) #junk
-        elif map_data["objects"][object_id]["class"] == 217:
-            (owner, towns) = struct.unpack("<II", h3m_data.read(8))
-            if towns==0x00:
-                (towns,) = struct.unpack("<H", h3m_data.read(2))
-        elif map_data["objects"][object_id]["class"] == 218:
-            (owner, minlvl, maxlvl) = struct.unpack("<IBB", h3m_data.read(6))
-        elif map_data["objects"][object_id]["class"] == 81:
-            (bonus_type, primaryID) = struct.unpack("<BI", h3m_data.read(5))
-            h3m_data.read(3) #junk
-        elif map_data["objects"][object_id]["class"] == 6:
-            (isText, ) = struct.unpack("<B", h3m_data.read(1))
-            if isText == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                text = h3m_data.read(length)
-                (isGuards, ) = struct.unpack("<B", h3m_data.read(1))
-                if isGuards == 0x01:
-                    for i in xrange(7):
-                        (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-                h3m_data.read(4) #junk
-            (exp, spell_points, morals, luck, wood, mercury, ore, sulfur,
-            crystal, gem, gold, offence, defence, power, knowledge) = \
-                struct.unpack("<IIBBIIIIIIIBBBB", h3m_data.read(42))
-            (secSkills, ) = struct.unpack("<B", h3m_data.read(1))
-            if secSkills > 0:
-                for i in xrange(secSkills):
-                    (skill_id, skill_lvl) = struct.unpack("<BB", h3m_data.read(2))
-            (artefacts, ) = struct.unpack("<B", h3m_data.read(1))
-            if artefacts > 0:
-                for i in xrange(artefacts):
-                    (artID, ) = struct.unpack("<H", h3m_data.read(2))
-            (spells, ) = struct.unpack("<B", h3m_data.read(1))
-            if spells > 0:
-                for i in xrange(spells):
-                    (spellID, ) = struct.unpack("<B", h3m_data.read(1))
-            (monsters, ) = struct.unpack("<B", h3m_data.read(1))
-            if monsters > 0:
-                for i in xrange(monsters):
-                    (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-            h3m_data.read(8) #junk
-        elif map_data["objects"][object_id]["class"] == 26:
-            (isText, ) = struct.unpack("<B", h3m_data.read(1))
-            if isText == 0x01:
-                (length, ) = struct.unpack("<I", h3m_data.read(4))
-                text = h3m_data.read(length)
-                (isGuards, ) = struct.unpack("<B", h3m_data.read(1))
-                if isGuards == 0x01:
-                    for i in xrange(7):
-                        (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-                h3m_data.read(4) #junk
-            (exp, spell_points, morals, luck, wood, mercury, ore, sulfur,
-            crystal, gem, gold, offence, defence, power, knowledge) = \
-                struct.unpack("<IIBBIIIIIIIBBBB", h3m_data.read(42))
-            (secSkills, ) = struct.unpack("<B", h3m_data.read(1))
-            if secSkills > 0:
-                for i in xrange(secSkills):
-                    (skill_id, skill_lvl) = struct.unpack("<BB", h3m_data.read(2))
-            (artefacts, ) = struct.unpack("<B", h3m_data.read(1))
-            if artefacts > 0:
-                for i in xrange(artefacts):
-                    (artID, ) = struct.unpack("<H", h3m_data.read(2))
-            (spells, ) = struct.unpack("<B", h3m_data.read(1))
-            if spells > 0:
-                for i in xrange(spells):
-                    (spellID, ) = struct.unpack("<B", h3m_data.read(1))
-            (monsters, ) = struct.unpack("<B", h3m_data.read(1))
-            if monsters > 0:
-                for i in xrange(monsters):
-                    (guard_id, guard_count) = struct.unpack("<HH", h3m_data.read(4))
-            h3m_data.read(8) #junk
-            (players, isAICan, disableAfterFirstDay) = struct.unpack("<BBB", h3m_data.read(3))
-            h3m_data.read(4) #junk
-    
+        obj = {"id":object_id, "x":x, "y":y, "z":z}
+        reader = readers[object_id]
+        if reader is not None:
+            reader(h3m_data, obj)
+        yield obj
+
+def read_tunedobj(h3m_data, map_data):
+    (map_data["tunedobj_count"], ) = h3m_data.unpack(DWORD)
+    map_data["tunedobj"] = list(iter_tunedobj_records(h3m_data,
+        map_data["objects"], map_data["tunedobj_count"]))
+
+def read_events(h3m_data, map_data):
+    map_data["events"] = []
     try:
-        (gevents_count, ) = struct.unpack("<I", h3m_data.read(4))
+        (gevents_count, ) = h3m_data.unpack(DWORD)
         for i in xrange(gevents_count):
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
+            (length, ) = h3m_data.unpack(DWORD)
             name = h3m_data.read(length)
-            (length, ) = struct.unpack("<I", h3m_data.read(4))
+            (length, ) = h3m_data.unpack(DWORD)
             text = h3m_data.read(length)
-            h3m_data.read(7*4) #resources
-            (players_affected, ) = struct.unpack("<B", h3m_data.read(1))
-            (human_affected, ) = struct.unpack("<B", h3m_data.read(1))
-            (ai_affected, ) = struct.unpack("<B", h3m_data.read(1))
-            (day_of_first_event,) = struct.unpack("<H", h3m_data.read(2))
-            (event_iteration,) = struct.unpack("<H", h3m_data.read(2))
-            h3m_data.read(16) #junk
+            resources = h3m_data.unpack(RESOURCES)
+            (players_affected, ) = h3m_data.unpack(BYTE)
+            (human_affected, ) = h3m_data.unpack(BYTE)
+            (ai_affected, ) = h3m_data.unpack(BYTE)
+            (day_of_first_event,) = h3m_data.unpack(WORD)
+            (event_iteration,) = h3m_data.unpack(WORD)
+            h3m_data.skip(16) #junk
+            map_data["events"].append({"name":name, "text":text,
+                "resources":resources, "players_affected":players_affected,
+                "human_affected":human_affected, "ai_affected":ai_affected,
+                "day_of_first_event":day_of_first_event,
+                "event_iteration":event_iteration})
     except:
         print "d'ough...'"
     
-    h3m_data.read(124) #junk
+    h3m_data.skip(124) #junk
+
+#(section, reader, keys the reader fills in) in file order
+SECTIONS = (
+    ("header", read_header, ("version", "hero_present", "map_size",
+        "underworld", "map_name", "map_desc", "difficulty", "level_limit")),
+    ("players", read_players, PLAYER_COLORS),
+    ("conditions", read_conditions, ("victory_conditions",
+        "loss_conditions", "commands_count", "commands")),
+    ("heroes", read_heroes, ("allowed_heroes", "heroes_count", "free_heroes",
+        "allowed_artifacts", "allowed_spells", "allowed_skills",
+        "rumor_count", "rumors", "hero_options")),
+    ("terrain", read_terrain, ("upper_terrain", "lower_terrain")),
+    ("templates", read_templates, ("object_count", "objects")),
+    ("tunedobj", read_tunedobj, ("tunedobj_count", "tunedobj")),
+    ("events", read_events, ("events", )),
+)
+
+#sections that can be stepped over without decoding them
+SKIPPERS = {"terrain": skip_terrain}
+
+def decode(h3m_data, arrays=False):
+    map_data = {}
+    read_header(h3m_data, map_data)
+    for section, reader, keys in SECTIONS[1:]:
+        if section == "terrain":
+            reader(h3m_data, map_data, arrays)
+        else:
+            reader(h3m_data, map_data)
+    return map_data
+
+def extract(filename, buffered=True, arrays=False):
+    """parse a map into a dict, ValueError if its version is not supported
+    
+    by default the file is inflated once and decoded from memory, with
+    buffered=False it is decoded straight from the gzip stream instead
+    
+    with arrays=True every terrain level is a read only (size, size, 7)
+    numpy uint8 array instead of rows of 7-tuples, see terrain_fields()
+    """
+    if arrays and numpy is None:
+        raise ImportError("terrain arrays need numpy")
+    if buffered:
+        return decode(BufferReader(load(filename)), arrays)
+    h3m_file = open_stream(filename)
+    try:
+        return decode(StreamReader(h3m_file), arrays)
+    finally:
+        h3m_file.close()
+
+def scan_header(filename):
+    """only read the general map info and the player setup
     
+    this stops inflating the file right after the player section, which is
+    all a map browser needs
+    """
+    h3m_file = open_stream(filename)
+    try:
+        h3m_data = StreamReader(h3m_file)
+        map_data = {}
+        read_header(h3m_data, map_data)
+        read_players(h3m_data, map_data)
+        return map_data
+    finally:
+        h3m_file.close()
+
+def iter_tunedobj(filename):
+    """yield (template, tuned object) for every object placed on a map
+    
+    the map is decoded straight from the gzip stream and no list of objects
+    is built, so memory stays constant no matter how many objects there are
+    """
+    h3m_file = open_stream(filename)
+    try:
+        h3m_data = StreamReader(h3m_file)
+        map_data = {}
+        read_header(h3m_data, map_data)
+        read_players(h3m_data, map_data)
+        read_conditions(h3m_data, map_data)
+        read_heroes(h3m_data, map_data)
+        skip_terrain(h3m_data, map_data)
+        read_templates(h3m_data, map_data)
+        templates = map_data["objects"]
+        (count, ) = h3m_data.unpack(DWORD)
+        for obj in iter_tunedobj_records(h3m_data, templates, count):
+            yield templates[obj["id"]], obj
+    finally:
+        h3m_file.close()
+
+def read_summary(h3m_data):
+    """the header plus the counts a map catalog lists, without decoding the
+    terrain or any of the placed objects"""
+    map_data = {}
+    read_header(h3m_data, map_data)
+    read_players(h3m_data, map_data)
+    read_conditions(h3m_data, map_data)
+    read_heroes(h3m_data, map_data)
+    skip_terrain(h3m_data, map_data)
+    read_templates(h3m_data, map_data)
+    (map_data["tunedobj_count"], ) = h3m_data.unpack(DWORD)
     return map_data
+
+class LazyMap(object):
+    """a map that only decodes a section when one of its keys is first used
+    
+    the byte offset of every section is recorded in offsets as soon as it is
+    known, sections in front of a requested one are skipped where their size
+    can be computed (terrain) and decoded otherwise
+    """
+    def __init__(self, filename, arrays=False):
+        if arrays and numpy is None:
+            raise ImportError("terrain arrays need numpy")
+        self.arrays = arrays
+        self.h3m_data = BufferReader(load(filename))
+        self.map_data = {}
+        self.offsets = {}
+        self.parsed = set()
+        self.__section_of = {}
+        for section, reader, keys in SECTIONS:
+            for key in keys:
+                self.__section_of[key] = section
+        self.__order = [section for section, reader, keys in SECTIONS]
+        self.__readers = dict((section, reader) for section, reader, keys in
+                              SECTIONS)
+        self.offsets["header"] = 0
+        self.parse("header")
+    
+    def __locate(self, section):
+        """return the offset of a section, walking the sections before it"""
+        if section in self.offsets:
+            return self.offsets[section]
+        previous = self.__order[self.__order.index(section) - 1]
+        self.h3m_data.offset = self.__locate(previous)
+        if previous in SKIPPERS:
+            SKIPPERS[previous](self.h3m_data, self.map_data)
+            self.offsets[section] = self.h3m_data.offset
+        else:
+            self.parse(previous)
+        return self.offsets[section]
+    
+    def parse(self, section):
+        if section in self.parsed:
+            return
+        self.h3m_data.offset = self.__locate(section)
+        if section == "terrain":
+            self.__readers[section](self.h3m_data, self.map_data, self.arrays)
+        else:
+            self.__readers[section](self.h3m_data, self.map_data)
+        self.parsed.add(section)
+        index = self.__order.index(section)
+        if index + 1 < len(self.__order):
+            self.offsets[self.__order[index + 1]] = self.h3m_data.offset
+    
+    def parse_all(self):
+        """decode everything and return the same dict extract() would"""
+        for section in self.__order:
+            self.parse(section)
+        return self.map_data
+    
+    def __getitem__(self, key):
+        self.parse(self.__section_of[key])
+        return self.map_data[key]
+    
+    def __setitem__(self, key, value):
+        if key in self.__section_of:
+            self.parse(self.__section_of[key])
+        self.map_data[key] = value
+    
+    def __contains__(self, key):
+        if key in self.__section_of:
+            self.parse(self.__section_of[key])
+        return key in self.map_data
+    
+    def get(self, key, default=None):
+        if key in self:
+            return self.map_data[key]
+        return default
+
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cStringIO
+import gzip
+from lib import h3m
+from lib.h3m import BYTE, BYTE2, BYTE3, BYTE4, BYTE6, BYTE8, BYTE9, WORD, \
+    WORD7, DWORD, DWORD2, BYTE_DWORD, DWORD_BYTE2, MAP_INFO, PLAYER_INFO, \
+    TILE, TEMPLATE, GUARD, GUARDS, POSITION, MONSTER, ARTIFACT_SLOTS, \
+    RESOURCES, RESOURCES_ARTIFACT, TOWN_EVENT, REWARD
+
+#objects store their position in bytes, wider maps cannot be written
+MAX_SIZE = 256
+
+class BufferWriter(object):
+    """collects packed fields and hands them to the stream in large blocks
+
+    gzip streams compress every write() on its own, so writing each field
+    directly would be both slow and compress badly
+    """
+    def __init__(self, stream, buffer_size=64*1024):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def pack(self, layout, *values):
+        self.write(layout.pack(*values))
+
+    def zeros(self, length):
+        self.write("\x00" * length)
+
+    def write_string(self, string):
+        """DWORD length followed by the string"""
+        self.write(DWORD.pack(len(string)))
+        self.write(string)
+
+    def write_grid(self, layout, grid):
+        """counterpart of unpack_grid, also takes numpy arrays"""
+        if h3m.numpy is not None and isinstance(grid, h3m.numpy.ndarray):
+            self.write(grid.astype(h3m.numpy.uint8).tostring())
+        else:
+            self.write("".join([layout.pack(*cell)
+                                for row in grid for cell in row]))
+
+    def flush(self):
+        if self.pending:
+            self.stream.write("".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+def write_flag(h3m_data, obj, key):
+    """the one byte switch in front of an optional field"""
+    present = obj.get(key) is not None
+    h3m_data.pack(BYTE, present)
+    return present
+
+def write_header(h3m_data, map_data):
+    if map_data["version"] != 0x1C:
+        raise ValueError("map version 0x%X cannot be written" %
+                         map_data["version"])
+    if map_data["map_size"] > MAX_SIZE:
+        raise ValueError("maps wider than %d tiles cannot be written" %
+                         MAX_SIZE)
+    h3m_data.pack(DWORD, map_data["version"])
+    h3m_data.pack(MAP_INFO, map_data["hero_present"], map_data["map_size"],
+                  map_data["underworld"])
+    h3m_data.write_string(map_data["map_name"])
+    h3m_data.write_string(map_data["map_desc"])
+    h3m_data.pack(BYTE2, map_data["difficulty"], map_data["level_limit"])
+
+def write_players(h3m_data, map_data):
+    for color in h3m.PLAYER_COLORS:
+        player = map_data[color]
+        h3m_data.pack(PLAYER_INFO, player["is_human"], player["is_computer"],
+                      player["behaviour"], player["isCityTypesOpt"],
+                      player["cityTypes"], player["randomCity"])
+        if write_flag(h3m_data, player, "main_city"):
+            h3m_data.pack(BYTE2, player["main_city"]["generate_hero"],
+                          player["main_city"]["type"])
+            h3m_data.pack(BYTE3, *player["main_city"]["coords"])
+        h3m_data.pack(BYTE2, player["random_hero"], player["hero_type"])
+        if player["hero_type"] != 0xFF:
+            h3m_data.pack(BYTE, player["hero_portrait"])
+            h3m_data.write_string(player["hero_name"])
+        h3m_data.zeros(1) #junk
+        heroes = player.get("heroes", [])
+        h3m_data.pack(DWORD, len(heroes))
+        for hero in heroes:
+            h3m_data.pack(BYTE, hero["portrait"])
+            h3m_data.write_string(hero["name"])
+
+def write_conditions(h3m_data, map_data):
+    #special victory condition
+    victory = map_data["victory_conditions"]
+    if victory == 0xFF:
+        h3m_data.pack(BYTE, 0xFF)
+    else:
+        h3m_data.pack(BYTE3, victory["id"], victory["canStandardEnd"],
+                      victory["canComputer"])
+        if victory["id"] == 0x00:
+            h3m_data.pack(BYTE, victory["artID"])
+        elif victory["id"] == 0x01:
+            h3m_data.pack(BYTE, victory["creatureID"])
+            h3m_data.pack(WORD, victory["creatureCount"])
+        elif victory["id"] == 0x02:
+            h3m_data.pack(BYTE, victory["resID"])
+            h3m_data.pack(DWORD, victory["resCount"])
+        elif victory["id"] in (0x04, 0x05, 0x06, 0x07):
+            h3m_data.pack(BYTE3, victory["x"], victory["y"], victory["z"])
+        elif victory["id"] in (0x08, 0x09):
+            pass
+        else:
+            raise NotImplementedError
+
+    #special loss condition
+    loss = map_data["loss_conditions"]
+    if loss == 0xFF:
+        h3m_data.pack(BYTE, 0xFF)
+    else:
+        h3m_data.pack(BYTE, loss["id"])
+        if loss["id"] in (0x00, 0x01):
+            h3m_data.pack(BYTE3, loss["x"], loss["y"], loss["z"])
+        elif loss["id"] == 0x02:
+            h3m_data.pack(BYTE2, *loss["unknown"])
+        elif loss["id"] == 0x03:
+            h3m_data.pack(WORD, loss["days"])
+        else:
+            raise NotImplementedError
+
+    #Teams
+    h3m_data.pack(BYTE, map_data["commands_count"])
+    if map_data["commands_count"] > 0:
+        h3m_data.pack(BYTE8, *map_data["commands"])
+
+def write_heroes(h3m_data, map_data):
+    #Free Heroes
+    h3m_data.write(map_data["allowed_heroes"])
+    h3m_data.zeros(4) #junk
+    free_heroes = map_data.get("free_heroes", [])
+    h3m_data.pack(BYTE, len(free_heroes))
+    for hero in free_heroes:
+        h3m_data.pack(BYTE2, hero["id"], hero["portrait"])
+        h3m_data.write_string(hero["name"])
+        h3m_data.pack(BYTE, hero["players"])
+    h3m_data.zeros(31) #junk
+
+    h3m_data.write(map_data["allowed_artifacts"])
+    h3m_data.write(map_data["allowed_spells"])
+    h3m_data.write(map_data["allowed_skills"])
+
+    #rumors
+    rumors = map_data.get("rumors", [])
+    h3m_data.pack(DWORD, len(rumors))
+    for rumor in rumors:
+        h3m_data.write_string(rumor["name"])
+        h3m_data.write_string(rumor["text"])
+
+    #hero options
+    for i in xrange(156):
+        options = map_data["hero_options"].get(i)
+        h3m_data.pack(BYTE, options is not None)
+        if options is None:
+            continue
+        if write_flag(h3m_data, options, "exp"):
+            h3m_data.pack(DWORD, options["exp"])
+        if write_flag(h3m_data, options, "sec_skills"):
+            h3m_data.pack(DWORD, len(options["sec_skills"]))
+            for skill in options["sec_skills"]:
+                h3m_data.pack(BYTE2, *skill)
+        h3m_data.pack(BYTE, 0) #isArtifact
+        if write_flag(h3m_data, options, "biography"):
+            h3m_data.write_string(options["biography"])
+        h3m_data.pack(BYTE, options["gender"])
+        if write_flag(h3m_data, options, "spells"):
+            h3m_data.pack(BYTE9, *options["spells"])
+        if write_flag(h3m_data, options, "primary_skills"):
+            h3m_data.pack(BYTE4, *options["primary_skills"])
+
+def write_terrain(h3m_data, map_data):
+    h3m_data.write_grid(TILE, map_data["upper_terrain"])
+    if map_data["underworld"]:
+        h3m_data.write_grid(TILE, map_data["lower_terrain"])
+
+def write_templates(h3m_data, map_data):
+    h3m_data.pack(DWORD, len(map_data["objects"]))
+    for template in map_data["objects"]:
+        h3m_data.write_string(template.get("name", template["filename"]))
+        h3m_data.write(template["passability"])
+        h3m_data.write(template["actions"])
+        h3m_data.pack(TEMPLATE, template["landscape"],
+                      template["land_edit_groups"], template["class"],
+                      template["number"], template["group"],
+                      template["overlay"])
+        h3m_data.zeros(16) #junk
+
+#the encoders below are the counterparts of the decoders in lib/h3m.py and
+#write the fields that follow the object position
+
+def write_guards(h3m_data, guards):
+    h3m_data.pack(GUARDS, *[value for guard in guards for value in guard])
+
+def write_message(h3m_data, obj):
+    if write_flag(h3m_data, obj, "text"):
+        h3m_data.write_string(obj["text"])
+        if write_flag(h3m_data, obj, "guards"):
+            write_guards(h3m_data, obj["guards"])
+        h3m_data.zeros(4) #junk
+
+def write_quest(h3m_data, obj):
+    quest = obj["quest"]
+    h3m_data.pack(BYTE, quest)
+    if quest == 0x00:
+        pass
+    elif quest in (0x01, 0x03, 0x04):
+        h3m_data.pack(DWORD, obj["quest_value"])
+    elif quest == 0x02:
+        h3m_data.pack(BYTE4, *obj["quest_value"])
+    elif quest == 0x05:
+        h3m_data.pack(BYTE, len(obj["quest_value"]))
+        for artifact in obj["quest_value"]:
+            h3m_data.pack(WORD, artifact)
+    elif quest == 0x06:
+        h3m_data.pack(BYTE, len(obj["quest_value"]))
+        for creature in obj["quest_value"]:
+            h3m_data.pack(GUARD, *creature)
+    elif quest == 0x07:
+        h3m_data.pack(RESOURCES, *obj["quest_value"])
+    elif quest in (0x08, 0x09):
+        h3m_data.pack(BYTE, obj["quest_value"])
+    else:
+        raise NotImplementedError
+    h3m_data.pack(DWORD, obj["time_limit"])
+    h3m_data.write_string(obj["quest_begin"])
+    h3m_data.write_string(obj["quest_running"])
+    h3m_data.write_string(obj["quest_end"])
+
+def write_reward(h3m_data, obj):
+    reward = obj["reward"]
+    h3m_data.pack(BYTE, reward)
+    if reward == 0x00:
+        pass
+    elif reward in (0x01, 0x02):
+        h3m_data.pack(DWORD, obj["reward_value"])
+    elif reward in (0x03, 0x04, 0x09):
+        h3m_data.pack(BYTE, obj["reward_value"])
+    elif reward == 0x05:
+        h3m_data.pack(BYTE_DWORD, *obj["reward_value"])
+    elif reward in (0x06, 0x07):
+        h3m_data.pack(BYTE2, *obj["reward_value"])
+    elif reward == 0x08:
+        h3m_data.pack(WORD, obj["reward_value"])
+    elif reward == 0x0A:
+        h3m_data.pack(GUARD, *obj["reward_value"])
+    else:
+        raise NotImplementedError
+
+def write_rewards(h3m_data, obj):
+    write_message(h3m_data, obj)
+    values = (obj["exp"], obj["spell_points"], obj["morale"], obj["luck"]) \
+        + tuple(obj["resources"]) + tuple(obj["primary_skills"])
+    h3m_data.pack(REWARD, *values)
+    h3m_data.pack(BYTE, len(obj["sec_skills"]))
+    for skill in obj["sec_skills"]:
+        h3m_data.pack(BYTE2, *skill)
+    h3m_data.pack(BYTE, len(obj["artifacts"]))
+    for artifact in obj["artifacts"]:
+        h3m_data.pack(WORD, artifact)
+    h3m_data.pack(BYTE, len(obj["spells"]))
+    for spell in obj["spells"]:
+        h3m_data.pack(BYTE, spell)
+    h3m_data.pack(BYTE, len(obj["creatures"]))
+    for creature in obj["creatures"]:
+        h3m_data.pack(GUARD, *creature)
+    h3m_data.zeros(8) #junk
+
+def write_owner(h3m_data, obj):
+    h3m_data.pack(DWORD, obj["owner"])
+
+def write_resource(h3m_data, obj):
+    write_message(h3m_data, obj)
+    h3m_data.pack(DWORD, obj["quantity"])
+    h3m_data.zeros(4) #junk
+
+def write_hero(h3m_data, obj):
+    h3m_data.pack(DWORD_BYTE2, obj["hero_id"], obj["owner"], obj["hero"])
+    if write_flag(h3m_data, obj, "name"):
+        h3m_data.write_string(obj["name"])
+    if write_flag(h3m_data, obj, "exp"):
+        h3m_data.pack(DWORD, obj["exp"])
+    if write_flag(h3m_data, obj, "portrait"):
+        h3m_data.pack(BYTE, obj["portrait"])
+    if write_flag(h3m_data, obj, "sec_skills"):
+        h3m_data.pack(DWORD, len(obj["sec_skills"]))
+        for skill in obj["sec_skills"]:
+            h3m_data.pack(BYTE2, *skill)
+    if write_flag(h3m_data, obj, "guards"):
+        write_guards(h3m_data, obj["guards"])
+    h3m_data.pack(BYTE, obj["formation"])
+    if write_flag(h3m_data, obj, "artifacts"):
+        h3m_data.pack(ARTIFACT_SLOTS, *obj["artifacts"])
+        h3m_data.pack(WORD, len(obj["knapsack"]))
+        for artifact in obj["knapsack"]:
+            h3m_data.pack(WORD, artifact)
+    h3m_data.pack(BYTE, obj["zone_radius"])
+    if write_flag(h3m_data, obj, "biography"):
+        h3m_data.write_string(obj["biography"])
+    h3m_data.pack(BYTE, obj["gender"])
+    if write_flag(h3m_data, obj, "spells"):
+        h3m_data.pack(BYTE9, *obj["spells"])
+    if write_flag(h3m_data, obj, "primary_skills"):
+        h3m_data.pack(BYTE4, *obj["primary_skills"])
+    h3m_data.zeros(16) #unknown
+
+def write_spell_scroll(h3m_data, obj):
+    write_message(h3m_data, obj)
+    h3m_data.pack(DWORD, obj["spell_id"])
+
+def write_random_dwelling(h3m_data, obj):
+    h3m_data.pack(DWORD2, obj["owner"], obj["castle_id"])
+    if obj["castle_id"] == 0x00:
+        h3m_data.pack(WORD, obj["towns"])
+
+def write_random_dwelling_any(h3m_data, obj):
+    write_random_dwelling(h3m_data, obj)
+    h3m_data.pack(BYTE2, obj["minlevel"], obj["maxlevel"])
+
+def write_random_dwelling_level(h3m_data, obj):
+    h3m_data.pack(DWORD_BYTE2, obj["owner"], obj["minlevel"],
+                  obj["maxlevel"])
+
+def write_monster(h3m_data, obj):
+    isTreasureOrText = obj.get("text") is not None
+    h3m_data.pack(MONSTER, obj["monster_id"], obj["count"], obj["mood"],
+                  isTreasureOrText)
+    if isTreasureOrText:
+        h3m_data.write_string(obj["text"])
+        h3m_data.pack(RESOURCES_ARTIFACT,
+                      *(tuple(obj["resources"]) + (obj["artifact"], )))
+    h3m_data.pack(BYTE2, obj["never_flees"], obj["no_grow"])
+    h3m_data.zeros(2) #junk
+
+def write_town_event(h3m_data, event):
+    h3m_data.write_string(event["name"])
+    h3m_data.write_string(event["text"])
+    h3m_data.pack(TOWN_EVENT, *(tuple(event["resources"]) +
+        (event["players_affected"], event["human_affected"],
+         event["ai_affected"], event["day_of_first_event"],
+         event["event_iteration"])))
+    h3m_data.zeros(16) #junk
+    h3m_data.pack(BYTE6, *event["buildings"])
+    h3m_data.pack(WORD7, *event["creatures"])
+    h3m_data.zeros(4) #junk
+
+def write_town(h3m_data, obj):
+    h3m_data.pack(DWORD, obj["identifier"])
+    h3m_data.pack(BYTE, obj["owner"])
+    if write_flag(h3m_data, obj, "name"):
+        h3m_data.write_string(obj["name"])
+    if write_flag(h3m_data, obj, "guards"):
+        write_guards(h3m_data, obj["guards"])
+    h3m_data.pack(BYTE, obj["formation"])
+    if write_flag(h3m_data, obj, "buildings"):
+        h3m_data.pack(BYTE6, *obj["buildings"])
+        h3m_data.pack(BYTE6, *obj["active"])
+    else:
+        h3m_data.pack(BYTE, obj["fort"])
+    h3m_data.pack(BYTE9, *obj["must_spells"])
+    h3m_data.pack(BYTE9, *obj["can_spells"])
+    h3m_data.pack(DWORD, len(obj["events"]))
+    for event in obj["events"]:
+        write_town_event(h3m_data, event)
+    h3m_data.pack(BYTE, obj["alignment"])
+    h3m_data.zeros(3) #junk
+
+def write_garrison(h3m_data, obj):
+    h3m_data.pack(DWORD, obj["owner"])
+    write_guards(h3m_data, obj["guards"])
+    h3m_data.pack(BYTE, obj["removable_units"])
+    h3m_data.zeros(8) #junk
+
+def write_seer_hut(h3m_data, obj):
+    write_quest(h3m_data, obj)
+    write_reward(h3m_data, obj)
+    h3m_data.zeros(2) #junk
+
+def write_sign(h3m_data, obj):
+    h3m_data.write_string(obj["text"])
+    h3m_data.zeros(4) #junk
+
+def write_witch_hut(h3m_data, obj):
+    h3m_data.pack(DWORD, obj["skills"])
+
+def write_shrine(h3m_data, obj):
+    h3m_data.pack(DWORD, obj["spell_id"])
+
+def write_grail(h3m_data, obj):
+    h3m_data.pack(BYTE, obj["radius"])
+    h3m_data.zeros(3) #junk
+
+def write_abandoned_mine(h3m_data, obj):
+    h3m_data.pack(BYTE, obj["resources"])
+    h3m_data.zeros(3) #junk
+
+def write_scholar(h3m_data, obj):
+    h3m_data.pack(BYTE_DWORD, obj["bonus_type"], obj["bonus_id"])
+    h3m_data.zeros(3) #junk
+
+def write_event(h3m_data, obj):
+    write_rewards(h3m_data, obj)
+    h3m_data.pack(BYTE3, obj["players"], obj["ai_can"],
+                  obj["disable_after_first_day"])
+    h3m_data.zeros(4) #junk
+
+#decoder -> encoder, so both directions always agree on the object classes
+ENCODERS = {
+    h3m.read_message: write_message,
+    h3m.read_rewards: write_rewards,
+    h3m.read_owner: write_owner,
+    h3m.read_event: write_event,
+    h3m.read_garrison: write_garrison,
+    h3m.read_hero: write_hero,
+    h3m.read_grail: write_grail,
+    h3m.read_monster: write_monster,
+    h3m.read_sign: write_sign,
+    h3m.read_resource: write_resource,
+    h3m.read_town: write_town,
+    h3m.read_scholar: write_scholar,
+    h3m.read_seer_hut: write_seer_hut,
+    h3m.read_shrine: write_shrine,
+    h3m.read_spell_scroll: write_spell_scroll,
+    h3m.read_witch_hut: write_witch_hut,
+    h3m.read_quest: write_quest,
+    h3m.read_random_dwelling_any: write_random_dwelling_any,
+    h3m.read_random_dwelling: write_random_dwelling,
+    h3m.read_random_dwelling_level: write_random_dwelling_level,
+    h3m.read_abandoned_mine: write_abandoned_mine,
+}
+
+#object class -> encoder
+TUNEDOBJ_WRITERS = dict((obj_class, ENCODERS[reader])
+                        for obj_class, reader in h3m.TUNEDOBJ_READERS.iteritems())
+
+def write_tunedobj(h3m_data, map_data):
+    writers = [TUNEDOBJ_WRITERS.get(template["class"])
+               for template in map_data["objects"]]
+    #the first two templates never have extra fields
+    writers[:2] = [None] * len(writers[:2])
+
+    h3m_data.pack(DWORD, len(map_data["tunedobj"]))
+    for obj in map_data["tunedobj"]:
+        h3m_data.pack(POSITION, obj["x"], obj["y"], obj["z"], obj["id"])
+        h3m_data.zeros(5) #junk
+        writer = writers[obj["id"]]
+        if writer is not None:
+            writer(h3m_data, obj)
+
+def write_events(h3m_data, map_data):
+    events = map_data.get("events", [])
+    h3m_data.pack(DWORD, len(events))
+    for event in events:
+        h3m_data.write_string(event["name"])
+        h3m_data.write_string(event["text"])
+        h3m_data.pack(RESOURCES, *event["resources"])
+        h3m_data.pack(BYTE3, event["players_affected"],
+                      event["human_affected"], event["ai_affected"])
+        h3m_data.pack(WORD, event["day_of_first_event"])
+        h3m_data.pack(WORD, event["event_iteration"])
+        h3m_data.zeros(16) #junk
+
+    h3m_data.zeros(124) #junk
+
+#section writers in file order, the counterpart of h3m.SECTIONS
+SECTIONS = (
+    ("header", write_header),
+    ("players", write_players),
+    ("conditions", write_conditions),
+    ("heroes", write_heroes),
+    ("terrain", write_terrain),
+    ("templates", write_templates),
+    ("tunedobj", write_tunedobj),
+    ("events", write_events),
+)
+
+def write_map(stream, map_data):
+    h3m_data = BufferWriter(stream)
+    for section, writer in SECTIONS:
+        writer(h3m_data, map_data)
+    h3m_data.flush()
+
+def encode(map_data):
+    """the uncompressed map as a string"""
+    stream = cStringIO.StringIO()
+    write_map(stream, map_data)
+    return stream.getvalue()
+
+def save(filename, map_data, compress=True):
+    """write a map as returned by h3m.extract(), gzipped like the original
+    maps unless compress=False"""
+    if compress:
+        h3m_file = gzip.open(filename, "wb")
+    else:
+        h3m_file = open(filename, "wb")
+    try:
+        write_map(h3m_file, map_data)
+    finally:
+        h3m_file.close()
@@ -22,6 +22,9 @@ import pyglet
 IF_BOTTOM = 48
 IF_RIGHT = 200
 IF_TOP = IF_LEFT = 8
+# largest edge of the minimap in the right sidebar, smaller maps get the
+# biggest whole number of pixels per tile that fits
+MINIMAP_SIZE = 144
 
 class Interface(object):
     def __init__(self, window):
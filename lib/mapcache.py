@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cPickle
+import hashlib
+import os
+import struct
+import tempfile
+import time
+from lib import h3m
+
+CACHE_MAGIC = "H3MD"
+#magic, parser version, map size, levels, length of the pickled part and
+#sha1 of everything after the header
+CACHE_HEADER = struct.Struct("<4sIIBI20s")
+CACHE_SUFFIX = ".h3mc"
+#temporary files of a store() older than this many seconds were left by an
+#interrupted one
+STALE_TEMP = 600
+
+class MapCache(object):
+    """parsed maps stored on disk, keyed by a hash of the map file
+
+    a cache file is the header, the pickled map without its terrain and then
+    the raw terrain bytes of all levels, which are memory mapped when numpy
+    arrays are asked for, a file whose digest does not match is a miss
+    """
+    def __init__(self, directory, max_size=64*1024*1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, digest):
+        return os.path.join(self.directory, "%s-%d%s" % (digest,
+                            h3m.PARSER_VERSION, CACHE_SUFFIX))
+
+    def extract(self, filename, arrays=False):
+        """the same as h3m.extract() but only parses a map the first time"""
+        if arrays and h3m.numpy is None:
+            raise ImportError("terrain arrays need numpy")
+        with open(filename, "rb") as h3m_file:
+            raw = h3m_file.read()
+        path = self.path(hashlib.sha1(raw).hexdigest())
+        if os.path.exists(path):
+            map_data = self.load(path, arrays)
+            if map_data is not None:
+                self.hits += 1
+                #keep recently used maps from being evicted
+                os.utime(path, None)
+                return map_data
+            #stale or corrupt, parse the map again
+            os.remove(path)
+        self.misses += 1
+        map_data = h3m.decode(h3m.BufferReader(h3m.inflate(raw)), arrays)
+        self.store(path, map_data)
+        self.evict(keep=path)
+        return map_data
+
+    def load(self, path, arrays=False):
+        """the map stored in a cache file, None if it is of another parser
+        version, truncated or corrupt"""
+        #whatever goes wrong, parsing the map again gives the right data
+        try:
+            return self.__load(path, arrays)
+        except Exception:
+            return None
+
+    def __load(self, path, arrays):
+        with open(path, "rb") as cache_file:
+            header = cache_file.read(CACHE_HEADER.size)
+            if len(header) != CACHE_HEADER.size:
+                return
+            (magic, version, size, levels, length, digest) = \
+                CACHE_HEADER.unpack(header)
+            if magic != CACHE_MAGIC or version != h3m.PARSER_VERSION:
+                return
+            offset = CACHE_HEADER.size + length
+            level_size = size * size * h3m.TILE.size
+            #the terrain of a file of the wrong length cannot be trusted
+            if os.fstat(cache_file.fileno()).st_size != \
+               offset + levels * level_size:
+                return
+            pickled = cache_file.read(length)
+            terrain = cache_file.read()
+            if hashlib.sha1(pickled + terrain).digest() != digest:
+                return
+            map_data = cPickle.loads(pickled)
+            if not isinstance(map_data, dict):
+                return
+            terrain = h3m.BufferReader(terrain)
+        keys = ("upper_terrain", "lower_terrain")[:levels]
+        for level, key in enumerate(keys):
+            if arrays:
+                map_data[key] = h3m.numpy.memmap(path, h3m.numpy.uint8, "r",
+                    offset + level * level_size, (size, size, h3m.TILE.size))
+            else:
+                map_data[key] = terrain.unpack_grid(h3m.TILE, size)
+        return map_data
+
+    def store(self, path, map_data):
+        levels = [map_data[key] for key in ("upper_terrain", "lower_terrain")
+                  if key in map_data]
+        rest = dict((key, value) for key, value in map_data.iteritems()
+                    if key not in ("upper_terrain", "lower_terrain"))
+        pickled = cPickle.dumps(rest, cPickle.HIGHEST_PROTOCOL)
+        terrain = []
+        for level in levels:
+            if h3m.numpy is not None and isinstance(level, h3m.numpy.ndarray):
+                terrain.append(level.tostring())
+            else:
+                terrain.append("".join(h3m.TILE.pack(*tile)
+                                       for row in level for tile in row))
+        terrain = "".join(terrain)
+        digest = hashlib.sha1(pickled + terrain).digest()
+        fd, temp = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as cache_file:
+            cache_file.write(CACHE_HEADER.pack(CACHE_MAGIC, h3m.PARSER_VERSION,
+                             map_data["map_size"], len(levels), len(pickled),
+                             digest))
+            cache_file.write(pickled)
+            cache_file.write(terrain)
+        #rename is atomic, so a concurrent reader never sees half a file
+        os.rename(temp, path)
+
+    def entries(self):
+        """(last use, size, path) of all cache files, oldest first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(CACHE_SUFFIX):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """drop maps of other parser versions, files left by interrupted
+        stores and the least recently used maps until the cache fits into
+        max_size, keep is never dropped"""
+        stale = time.time() - STALE_TEMP
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp") and os.stat(path).st_mtime < stale:
+                os.remove(path)
+        suffix = "-%d%s" % (h3m.PARSER_VERSION, CACHE_SUFFIX)
+        entries = []
+        for entry in self.entries():
+            if not entry[2].endswith(suffix):
+                os.remove(entry[2])
+            else:
+                entries.append(entry)
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
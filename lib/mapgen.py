@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import random
+from lib import h3m
+
+#terrain type -> range of tile indices that are plain ground without any
+#transition to a neighbouring terrain
+TERRAIN_INTERIORS = {
+    0: (21, 28), #dirt
+    1: (0, 23), #sand
+    2: (49, 72), #grass
+    3: (49, 72), #snow
+    4: (49, 72), #swamp
+    5: (49, 72), #rough
+    6: (49, 72), #subterranean
+    7: (49, 72), #lava
+    8: (21, 32), #water
+    9: (0, 7), #rock
+}
+
+#terrain type -> weight, the share of the map each type gets
+SURFACE_MIX = {0: 2, 1: 1, 2: 4, 3: 1, 4: 1, 5: 1, 7: 1, 8: 3, 9: 1}
+UNDERWORLD_MIX = {6: 6, 7: 1, 8: 1, 9: 2}
+
+RIVER_TYPES = 4
+RIVER_TILES = 13
+ROAD_TYPES = 3
+ROAD_TILES = 17
+
+#map sizes the game offers, larger maps can be generated but only those up
+#to h3mwriter.MAX_SIZE can be written
+MAP_SIZES = (36, 72, 108, 144, 180, 252)
+
+#size of the square blocks terrain is laid out in
+REGION_SIZE = 8
+
+def template(name, obj_class, number, group, passability, actions,
+             landscape=511, land_edit_groups=255, overlay=0):
+    """a template entry the way h3m.read_templates() returns it"""
+    return {"filename":name.lower(), "class":obj_class, "number":number,
+            "group":group, "name":name, "passability":passability,
+            "actions":actions, "landscape":landscape,
+            "land_edit_groups":land_edit_groups, "overlay":overlay}
+
+#the first two templates of every map are the same and have no objects
+FIRST_TEMPLATES = [
+    template("AVWmrnd0.def", 71, 0, 2, "\xff\xff\xff\xff\xff\x7f",
+             "\x00\x00\x00\x00\x00\x80", 255, 1),
+    template("AVLholg0.def", 124, 0, 0, "\xff" * 6, "\x00" * 6, 4, 4, 1),
+]
+
+OBSTACLES = [
+    template("AVLdead1.def", 119, 0, 0, "\xff\xff\xff\xff\xff\x7f",
+             "\x00" * 6, 511, 208),
+    template("AVLdead4.def", 119, 0, 0, "\xff\xff\xff\xff\x9f?",
+             "\x00" * 6, 511, 208),
+    template("AVLmtvo3.def", 134, 0, 0, "\xff\xff\xff\xff\x1f?",
+             "\x00" * 6, 511, 128),
+    template("AVLvol20.def", 158, 0, 0, "\xff\xff\xff\xff\xff?",
+             "\x00" * 6, 511, 128),
+    template("AVXrk2.def", 231, 0, 0, "\xff" * 6, "\x00" * 6, 511, 255, 1),
+]
+
+MONSTERS = [
+    template("AVWmon6.def", 163, 0, 2, "\xff\xff\xff\xff\xff\x7f",
+             "\x00\x00\x00\x00\x00\x80", 511, 1),
+]
+
+def weighted_choice(rand, weights):
+    total = sum(weights.itervalues())
+    pick = rand.uniform(0, total)
+    for key, weight in sorted(weights.iteritems()):
+        pick -= weight
+        if pick <= 0:
+            return key
+    return key
+
+def generate_terrain(rand, size, mix):
+    """blocks of REGION_SIZE tiles of one terrain type each, every row is
+    shifted a bit so the blocks do not line up"""
+    regions = size // REGION_SIZE + 2
+    types = [[weighted_choice(rand, mix) for x in xrange(regions)]
+             for y in xrange(regions)]
+    terrain = []
+    for y in xrange(size):
+        shift = rand.randint(0, REGION_SIZE - 1)
+        region_row = types[y // REGION_SIZE]
+        row = []
+        for x in xrange(size):
+            terrain_type = region_row[(x + shift) // REGION_SIZE]
+            first, last = TERRAIN_INTERIORS[terrain_type]
+            row.append([terrain_type, rand.randint(first, last), 0, 0, 0, 0,
+                        rand.randint(0, 3)])
+        terrain.append(row)
+    return terrain
+
+def lay_paths(rand, terrain, density, kinds, tiles, field, mirror_shift):
+    """random walks until density of all land tiles carry a river or road,
+    field is the offset of the type in the tile, the index follows it"""
+    size = len(terrain)
+    wanted = int(density * size * size)
+    laid = 0
+    attempts = 0
+    while laid < wanted and attempts < wanted * 4:
+        attempts += 1
+        kind = rand.randint(1, kinds)
+        x, y = rand.randrange(size), rand.randrange(size)
+        for step in xrange(rand.randint(8, 32)):
+            tile = terrain[y][x]
+            if tile[0] != 8 and tile[field] == 0:
+                tile[field] = kind
+                tile[field + 1] = rand.randrange(tiles)
+                tile[6] |= rand.randint(0, 3) << mirror_shift
+                laid += 1
+            dx, dy = rand.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+            x, y = x + dx, y + dy
+            if not (0 <= x < size and 0 <= y < size):
+                break
+
+def generate_level(rand, size, mix, river_density, road_density):
+    terrain = generate_terrain(rand, size, mix)
+    lay_paths(rand, terrain, river_density, RIVER_TYPES, RIVER_TILES, 2, 2)
+    lay_paths(rand, terrain, road_density, ROAD_TYPES, ROAD_TILES, 4, 4)
+    return [[tuple(tile) for tile in row] for row in terrain]
+
+def generate_objects(rand, size, levels, density, obstacles, monsters):
+    """tuned objects and the templates they use, obstacles have no extra
+    fields while monsters go through the tuned object decoders"""
+    templates = FIRST_TEMPLATES + obstacles + monsters
+    first_monster = len(FIRST_TEMPLATES) + len(obstacles)
+    tunedobj = []
+    for i in xrange(int(density * size * size * levels)):
+        object_id = rand.randrange(len(FIRST_TEMPLATES), len(templates))
+        obj = {"id":object_id, "x":rand.randrange(size),
+               "y":rand.randrange(size), "z":rand.randrange(levels)}
+        if object_id >= first_monster:
+            obj.update({"monster_id":rand.randint(0, 0xFFFFFFFF),
+                        "count":rand.randint(0, 50), "mood":rand.randint(0, 4),
+                        "never_flees":0, "no_grow":0})
+        tunedobj.append(obj)
+    return templates, tunedobj
+
+def generate(size=36, seed=0, underworld=False, surface_mix=None,
+             underworld_mix=None, river_density=0.03, road_density=0.03,
+             object_density=0.08, obstacles=OBSTACLES, monsters=MONSTERS,
+             arrays=False):
+    """a random map, equal to what h3m.extract() returns for it once it is
+    written with lib.h3mwriter
+
+    the same arguments always give the same map, densities are the share of
+    tiles that get a river, a road or an object; terrain mixes map terrain
+    types to weights, see SURFACE_MIX
+    """
+    rand = random.Random(seed)
+    map_data = {"version":0x1C, "hero_present":1, "map_size":size,
+        "underworld":int(bool(underworld)),
+        "map_name":"Synthetic %dx%d seed %d" % (size, size, seed),
+        "map_desc":"generated by lib/mapgen.py", "difficulty":1,
+        "level_limit":0}
+    for color in h3m.PLAYER_COLORS:
+        map_data[color] = {"is_human":0, "is_computer":0, "behaviour":0,
+            "isCityTypesOpt":0, "cityTypes":0, "randomCity":0,
+            "random_hero":0, "hero_type":0xFF, "heroes_count":0}
+    map_data.update({"victory_conditions":0xFF, "loss_conditions":0xFF,
+        "commands_count":0, "allowed_heroes":"\xff" * 20, "heroes_count":0,
+        "allowed_artifacts":"\x00" * 18, "allowed_spells":"\x00" * 9,
+        "allowed_skills":"\x00" * 4, "rumor_count":0, "hero_options":{}})
+
+    map_data["upper_terrain"] = generate_level(rand, size,
+        surface_mix or SURFACE_MIX, river_density, road_density)
+    if underworld:
+        map_data["lower_terrain"] = generate_level(rand, size,
+            underworld_mix or UNDERWORLD_MIX, river_density, road_density)
+    if arrays:
+        if h3m.numpy is None:
+            raise ImportError("terrain arrays need numpy")
+        for key in ("upper_terrain", "lower_terrain"):
+            if key in map_data:
+                map_data[key] = h3m.numpy.array(map_data[key], h3m.numpy.uint8)
+
+    templates, tunedobj = generate_objects(rand, size, 2 if underworld else 1,
+        object_density, obstacles, monsters)
+    map_data.update({"object_count":len(templates), "objects":templates,
+        "tunedobj_count":len(tunedobj), "tunedobj":tunedobj, "events":[]})
+    return map_data
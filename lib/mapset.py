@@ -18,9 +18,16 @@
 """
 
 import pyglet
-from ctypes import create_string_buffer, memmove
-from lib import h3m
+from lib import atlasbundle, defmanifest
+from lib.mapcache import MapCache
+from lib.maxrects import TextureAtlas
+from lib.spatialindex import ChunkIndex
+from lib.passability import Passability
 import os
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class OrderedTextureGroup(pyglet.graphics.Group):
     def __init__(self, order, texture, parent=None):
@@ -35,19 +42,22 @@ class OrderedTextureGroup(pyglet.graphics.Group):
     def unset_state(self):
         pyglet.gl.glDisable(self.texture.target)
 
+    @property
+    def key(self):
+        """what tells groups apart, MapSet registers one group per key"""
+        return (self.order, self.texture.target, self.texture.id, self.parent)
+
     def __hash__(self):
-        return hash((self.order, self.texture.target, self.texture.id,
-               self.parent))
+        return hash(self.key)
 
     def __eq__(self, other):
-        return (self.__class__ is other.__class__ and
-            self.order == other.order and
-            self.texture.target == other.texture.target and
-            self.texture.id == other.texture.id and
-            self.parent == self.parent)
+        return self.__class__ is other.__class__ and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
 
     def __repr__(self):
-        return '%s(id=%d)' % (self.__class__.__name__, self.order,
+        return '%s(order=%d, id=%d)' % (self.__class__.__name__, self.order,
                self.texture.id)
         
     def __cmp__(self, other):
@@ -55,6 +65,22 @@ class OrderedTextureGroup(pyglet.graphics.Group):
             return cmp(self.order, other.order)
         return -1
 
+class FrameStore(object):
+    """the frames of one animated sprite as RGBA rows from the bottom up, the
+    way glTexSubImage2D wants them
+    
+    all flipped variants of a sprite draw the same atlas region, flipping
+    is done by their texture coordinates, so they share one store
+    """
+    def __init__(self, frames):
+        self.frames = [img.get_data("RGBA", img.width * 4) for img in frames]
+        self.size = sum(len(frame) for frame in self.frames)
+        self.__animation = 0
+    
+    def next_frame(self):
+        self.__animation = (self.__animation + 1) % len(self.frames)
+        return self.frames[self.__animation]
+
 class Animation(object):
     def __init__(self, tex_region, frames, flip_x=False, flip_y=False):
         self.texgroup = tex_region.group
@@ -62,24 +88,15 @@ class Animation(object):
             self.tex = tex_region.get_transform(flip_x=flip_x, flip_y=flip_y)
         else:    
             self.tex = tex_region
-        self.__frames = []
-        for img in frames:
-            data_pitch = abs(img._current_pitch)
-            buf = create_string_buffer(len(img._current_data))
-            memmove(buf, img._current_data, len(img._current_data))
-            data = buf.raw
-            rows = [data[i:i + abs(data_pitch)] for i in
-                   xrange(len(img._current_data)-abs(data_pitch),
-                   -1, -abs(data_pitch))]
-            self.__frames.append(''.join(rows))
-        self.__animation = 0
+        if not isinstance(frames, FrameStore):
+            frames = FrameStore(frames)
+        self.store = frames
         self.width = self.tex.width
         self.height = self.tex.height
-        self.__hash = hash(self.__frames[0])
+        self.__hash = hash(self.store)
     
     def next_frame(self):
-        self.__animation = (self.__animation + 1) % len(self.__frames)
-        return self.__frames[self.__animation]
+        return self.store.next_frame()
     
     @property
     def tex_coords(self):
@@ -93,290 +110,483 @@ class Animation(object):
         return self.__hash
 
     def __eq__(self, other):
-        return self.__hash == other.__hash
+        return self.store is other.store
+
+def pad_terrain(terrain):
+    """surround the map with 9 tiles of edge on the left and right and 8 on
+    the top and bottom, edge tiles have a terrain type of -1"""
+    if numpy is not None and isinstance(terrain, numpy.ndarray):
+        return _pad_terrain_array(terrain)
+    edge_map = [[] for i in xrange(len(terrain)+16)]
+    for num in xrange(len(edge_map)):
+        if num < 7 or num > len(edge_map)-8:
+            line = []
+            line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(len(terrain[0])+18)])
+        elif num == 7:
+            line = []
+            line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
+            line.append([-1, 16, 0, 0, 0, 0, 0])
+            line.extend([[-1, 20+i%4, 0, 0, 0, 0, 0] for i in xrange(len(terrain[0]))])
+            line.append([-1, 17, 0, 0, 0, 0, 0])
+            line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
+        elif num == len(edge_map)-8:
+            line = []
+            line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
+            line.append([-1, 19, 0, 0, 0, 0, 0])
+            line.extend([[-1, 28+i%4, 0, 0, 0, 0, 0] for i in xrange(len(terrain[0]))])
+            line.append([-1, 18, 0, 0, 0, 0, 0])
+            line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
+        else:
+            line = []
+            line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
+            line.append([-1, 32+num%4, 0, 0, 0, 0, 0])
+            line.extend(terrain[num-8])
+            line.append([-1, 24+num%4, 0, 0, 0, 0, 0])
+            line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
+        edge_map[num] = line
+    return edge_map
+
+def _pad_terrain_array(terrain):
+    size = len(terrain)
+    height, width = size + 16, size + 18
+    rows = numpy.arange(height)[:, None]
+    cols = numpy.arange(width)[None, :]
+    edge_map = numpy.zeros((height, width, 7), numpy.int16)
+    edge_map[..., 0] = -1
+    edge_map[..., 1] = (cols - 1) % 4 + 4 * (rows % 4)
+    # the pattern starts over right of the map border
+    edge_map[7:height-7, size+10:, 1] = \
+        (cols[:, size+10:] - size - 11) % 4 + 4 * (rows[7:height-7] % 4)
+    border = numpy.arange(size) % 4
+    edge_map[7, 8, 1] = 16
+    edge_map[7, 9:size+9, 1] = 20 + border
+    edge_map[7, size+9, 1] = 17
+    edge_map[height-8, 8, 1] = 19
+    edge_map[height-8, 9:size+9, 1] = 28 + border
+    edge_map[height-8, size+9, 1] = 18
+    edge_map[8:height-8, 8, 1] = 32 + rows[8:height-8, 0] % 4
+    edge_map[8:height-8, size+9, 1] = 24 + rows[8:height-8, 0] % 4
+    edge_map[8:height-8, 9:size+9] = terrain
+    return edge_map
+
+#width and height of the atlas pages sprites are packed into
+PAGE_SIZE = 1024
+
+#type -> def name, frames, animation frames (0 if not animated), draw order
+#and whether the mirror bits of the tile are applied
+TERRAIN_DEFS = {
+    -1: ("edg", 36, 0, 100, False),
+    0: ("dirttl", 46, 0, 0, True),
+    1: ("sandtl", 24, 0, 0, False),
+    2: ("grastl", 79, 0, 0, True),
+    3: ("snowtl", 79, 0, 0, True),
+    4: ("swmptl", 79, 0, 0, True),
+    5: ("rougtl", 79, 0, 0, True),
+    6: ("subbtl", 79, 0, 0, True),
+    7: ("lavatl", 79, 0, 0, True),
+    8: ("watrtl", 33, 12, 0, True),
+    9: ("rocktl", 48, 0, 0, False),
+}
+RIVER_DEFS = {
+    1: ("clrrvr", 13, 12, 1, True),
+    2: ("icyrvr", 13, 0, 1, True),
+    3: ("mudrvr", 13, 12, 1, True),
+    4: ("lavrvr", 13, 9, 1, True),
+}
+ROAD_DEFS = {
+    1: ("dirtrd", 17, 0, 1, True),
+    2: ("gravrd", 17, 0, 1, True),
+    3: ("cobbrd", 17, 0, 1, True),
+}
+
+#layers of a tile from bottom to top: field of the type (the index follows
+#it), shift of the two mirror bits, type that means nothing to draw, defs
+TILE_LAYERS = (
+    (0, 0, None, TERRAIN_DEFS),
+    (2, 2, 0, RIVER_DEFS),
+    (4, 4, 0, ROAD_DEFS),
+)
+
+#type field -> type that means nothing to draw, defs
+LAYER_DEFS = dict((type_field, (empty, defs))
+                  for type_field, shift, empty, defs in TILE_LAYERS)
+
+def used_tiles(terrain):
+    """(type field, type, index) of every terrain, river and road frame a
+    padded level shows, empty rivers and roads included"""
+    if numpy is not None and isinstance(terrain, numpy.ndarray):
+        used = set()
+        for type_field in LAYER_DEFS:
+            keys = numpy.unique(terrain[..., type_field].astype(numpy.int32) *
+                                256 + terrain[..., type_field + 1])
+            used.update((type_field, ) + divmod(int(key), 256) for key in keys)
+        return used
+    return set((type_field, tile[type_field], tile[type_field + 1])
+               for line in terrain for tile in line
+               for type_field in LAYER_DEFS)
+
+def tile_files(defs, tile_type, index):
+    """the pngs of a tile frame, the first one goes into the atlas and the
+    others are the rest of its animation"""
+    name, frames, animation, order, mirrored = defs[tile_type]
+    if animation:
+        return ['data/advmap_tiles/%s.def/%d/%d.png' % (name, index, j)
+                for j in xrange(animation)]
+    return ['data/advmap_tiles/%s.def/%d.png' % (name, index)]
+
+def decode_image(file):
+    return pyglet.image.load(None, file=pyglet.resource.file(file))
+
+def decode_rgba(file):
+    """width, height and RGBA bytes of a png, what a decoding process sends
+    back instead of the image"""
+    image = decode_image(file)
+    return image.width, image.height, image.get_data("RGBA", image.width * 4)
+
+def read_map(map_name):
+    """parse a map from maps/ through the cache and pad its levels, this
+    does not touch OpenGL so it may run on another thread"""
+    script_home = pyglet.resource._default_loader._script_home
+    cache = MapCache(os.path.join(script_home, "cache"))
+    h3m_data = cache.extract(os.path.join(script_home, "maps",
+                             "%s.h3m" % map_name), arrays=numpy is not None)
+    h3m_data["upper_terrain"] = pad_terrain(h3m_data["upper_terrain"])
+    if h3m_data["underworld"]:
+        h3m_data["lower_terrain"] = pad_terrain(h3m_data["lower_terrain"])
+    return h3m_data
+
+class ImagePrefetcher(object):
+    """decodes pngs in a multiprocessing.Pool ahead of MapSet asking for
+    them, the png decoder holds the GIL so threads would not run it beside
+    the main thread"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = {}
+    
+    def request(self, files):
+        """queue files for decoding, in the order they are needed"""
+        for file in files:
+            if file not in self.pending:
+                self.pending[file] = self.pool.apply_async(decode_rgba,
+                                                           (file, ))
+    
+    def ready(self, file, timeout=0):
+        """whether get() returns at once, waits up to timeout seconds"""
+        result = self.pending.get(file)
+        if result is None:
+            return True
+        result.wait(timeout)
+        return result.ready()
+    
+    def get(self, file):
+        result = self.pending.pop(file, None)
+        if result is None:
+            return decode_image(file)
+        width, height, data = result.get()
+        return pyglet.image.ImageData(width, height, "RGBA", data)
 
 class MapSet(object):
-    def load_map_object(self, file, order=0):
-        image = pyglet.image.load(None, file=pyglet.resource.file(file))
+    def load_image(self, file):
+        if self.bundle is not None and file in self.bundle:
+            return self.bundle.image(file)
+        if self.images is not None:
+            return self.images.get(file)
+        return decode_image(file)
+
+    def frame_height(self, name):
+        """height of the first frame of a def directory, from the bundle or
+        the manifest and else from the png header"""
+        path = name + "/0.png"
+        if self.bundle is not None and path in self.bundle:
+            return self.bundle.size(path)[1]
+        if name in self.def_heights:
+            return self.def_heights[name]
+        png_file = pyglet.resource.file(path)
         try:
-            texture_region = self.current_atlas.add(image)
-        except pyglet.image.atlas.AllocatorException:
-            self.current_atlas = pyglet.image.atlas.TextureAtlas(1024, 1024)
-            texture_region = self.current_atlas.add(image)
-        group = OrderedTextureGroup(order, self.current_atlas.texture)
-        
-        if group not in self.groups:
-            self.groups.append(group)
-        
-        texture_region.group = self.groups.index(group)
+            return defmanifest.png_size(png_file)[1]
+        finally:
+            png_file.close()
+
+    def __waiting(self, files):
+        """whether the prefetcher still decodes any of files"""
+        if self.images is None:
+            return False
+        #block a little so a caller that keeps asking does not spin
+        return not all(self.images.ready(file, 0.002) for file in files)
+
+    def frame_count(self, name):
+        """number of frames of a def directory"""
+        if self.bundle is not None and self.bundle.frames(name):
+            return self.bundle.frames(name)
+        if name in self.def_frames:
+            return self.def_frames[name]
+        #not in the manifest, probe the resource index
+        index = pyglet.resource._default_loader._index
+        i = 1
+        while name + "/%d.png" % i in index:
+            i += 1
+        return i
+
+    def load_map_object(self, file, order=0, image=None):
+        """texture region of file, taken from the prebaked pages if there are
+        any or else added to the first atlas page it fits on"""
+        if self.bundle is not None and file in self.bundle:
+            texture_region = self.bundle.region(file)
+        else:
+            if image is None:
+                image = self.load_image(file)
+            #every page is tried, a small sprite often still fits on an
+            #older one
+            for atlas in self.atlases:
+                try:
+                    texture_region = atlas.add(image)
+                    break
+                except pyglet.image.atlas.AllocatorException:
+                    pass
+            else:
+                atlas = TextureAtlas(self.page_size, self.page_size)
+                self.atlases.append(atlas)
+                texture_region = atlas.add(image)
+        texture_region.group = self.group_id(order, texture_region.owner)
         return texture_region
+    
+    def group_id(self, order, texture):
+        """stable index into self.groups of the group drawing texture at
+        order, so there is one group per atlas page and order"""
+        group = OrderedTextureGroup(order, texture)
+        try:
+            return self.group_ids[group.key]
+        except KeyError:
+            self.group_ids[group.key] = len(self.groups)
+            self.groups.append(group)
+            return self.group_ids[group.key]
 
-    def __init__(self, map_name):
-        h3m_data = h3m.extract(os.path.join(pyglet.resource._default_loader._script_home,"maps","%s.h3m" % map_name))
-        edge_map = [[] for i in xrange(len(h3m_data["upper_terrain"])+16)]
-        for num in xrange(len(edge_map)):
-            if num < 7 or num > len(edge_map)-8:
-                line = []
-                line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(len(h3m_data["upper_terrain"][0])+18)])
-            elif num == 7:
-                line = []
-                line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
-                line.append([-1, 16, 0, 0, 0, 0, 0])
-                line.extend([[-1, 20+i%4, 0, 0, 0, 0, 0] for i in xrange(len(h3m_data["upper_terrain"][0]))])
-                line.append([-1, 17, 0, 0, 0, 0, 0])
-                line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
-            elif num == len(edge_map)-8:
-                line = []
-                line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
-                line.append([-1, 19, 0, 0, 0, 0, 0])
-                line.extend([[-1, 28+i%4, 0, 0, 0, 0, 0] for i in xrange(len(h3m_data["upper_terrain"][0]))])
-                line.append([-1, 18, 0, 0, 0, 0, 0])
-                line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
+    def __tile_texture(self, defs, tile_type, index):
+        """region of a single tile frame, loaded the first time any tile
+        shows it, for animated tiles the frame store is loaded with it"""
+        try:
+            name, frames, animation, order, mirrored = defs[tile_type]
+        except KeyError:
+            raise NotImplementedError, tile_type
+        if not 0 <= index < frames:
+            raise IndexError("%s has no frame %d" % (name, index))
+        key = (name, index)
+        if key not in self.__tile_textures:
+            files = tile_files(defs, tile_type, index)
+            if animation:
+                images = [self.load_image(file) for file in files]
+                self.__tile_frames[key] = FrameStore(images)
+                self.__tile_textures[key] = self.load_map_object(files[0],
+                    order, images[0])
             else:
-                line = []
-                line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
-                line.append([-1, 32+num%4, 0, 0, 0, 0, 0])
-                line.extend(h3m_data["upper_terrain"][num-8])
-                line.append([-1, 24+num%4, 0, 0, 0, 0, 0])
-                line.extend([[-1, 0+(i-1)%4+4*(num%4), 0, 0, 0, 0, 0] for i in xrange(8)])
-            edge_map[num] = line
-        h3m_data["upper_terrain"] = edge_map
+                self.__tile_textures[key] = self.load_map_object(files[0],
+                    order)
+        return self.__tile_textures[key]
+
+    def __resolve(self, defs, tile_type, index, mirror):
+        texture = self.__tile_texture(defs, tile_type, index)
+        name, frames, animation, order, mirrored = defs[tile_type]
+        if not mirrored:
+            mirror = 0
+        flip_x = bool(mirror & 1)
+        flip_y = bool(mirror & 2)
+        if animation:
+            return Animation(texture, self.__tile_frames[name, index],
+                             flip_x=flip_x, flip_y=flip_y)
+        if flip_x or flip_y:
+            new = texture.get_transform(flip_x=flip_x, flip_y=flip_y)
+            new.group = texture.group
+            return new
+        return texture
+
+    def __load_terrain(self, terrain):
+        """tile dict of one level, regions are cached per (type, index,
+        mirror) and shared by both levels"""
+        if numpy is not None and isinstance(terrain, numpy.ndarray):
+            terrain = terrain.tolist()
+        regions = self.__regions
+        tiles = {}
+        for y, line in enumerate(terrain):
+            for x, tile in enumerate(line):
+                layers = []
+                for type_field, shift, empty, defs in TILE_LAYERS:
+                    tile_type = tile[type_field]
+                    if tile_type == empty:
+                        continue
+                    key = (type_field, tile_type, tile[type_field + 1],
+                           (tile[6] >> shift) & 3)
+                    region = regions.get(key)
+                    if region is None:
+                        region = regions[key] = self.__resolve(defs, *key[1:])
+                    layers.append(region)
+                tiles[x, y] = layers
+        return tiles
+
+    def __init__(self, map_name, images=None, page_size=PAGE_SIZE):
+        for progress in self.load(read_map(map_name), images, page_size):
+            pass
+    
+    @classmethod
+    def loading(cls, h3m_data, images=None, page_size=PAGE_SIZE):
+        """an empty MapSet and the generator that fills it, see load()"""
+        mapset = cls.__new__(cls)
+        return mapset, mapset.load(h3m_data, images, page_size)
+    
+    def load(self, h3m_data, images=None, page_size=PAGE_SIZE):
+        """build the mapset from a map returned by read_map()
+        
+        this is a generator that yields (frames uploaded, frames to upload)
+        after every texture upload and while waiting for a png so the caller
+        can keep drawing, images is an ImagePrefetcher that decodes the pngs
+        ahead in other processes
+        """
+        script_home = pyglet.resource._default_loader._script_home
+        self.images = images
         
         self.width = len(h3m_data["upper_terrain"][0])
         self.height = len(h3m_data["upper_terrain"])
         
-        self.current_atlas = pyglet.image.atlas.TextureAtlas(1024, 1024)
+        self.page_size = page_size
+        self.atlases = []
+        
+        #pages prebaked by atlasbake.py, loading single pngs is the fallback
+        bundle = os.path.join(script_home, "data", "atlas")
+        if os.path.exists(os.path.join(bundle, atlasbundle.MANIFEST)):
+            self.bundle = atlasbundle.AtlasBundle(bundle)
+        else:
+            self.bundle = None
+        
+        #frame counts written by mkdefmanifest.py, also used to find out early
+        #if frames are missing from the data directory
+        manifest = os.path.join(script_home, "data", defmanifest.MANIFEST)
+        self.def_frames = defmanifest.load(manifest)
+        self.def_heights = defmanifest.load_heights(manifest)
+        pyglet.resource._default_loader._require_index()
+        missing = defmanifest.missing(self.def_frames, self.bundle or
+                                      pyglet.resource._default_loader._index)
+        if missing:
+            raise IOError("%d frames missing from the data directory: %s" %
+                          (len(missing), ", ".join(missing[:5])))
         
         self.groups = []
+        self.group_ids = {}
         
-        self.__tiles = {}
-        tile_textures = {}
-        for y, line in enumerate(h3m_data["upper_terrain"]):
-            for x, tile in enumerate(line):
-                if tile[0] == -1: #edge
-                    if "edg" not in tile_textures.keys():
-                        tile_textures["edg"] = [self.load_map_object('data/advmap_tiles/edg.def/%d.png'%i, 100) for i in xrange(36)]
-                    self.__tiles[x,y] = [tile_textures["edg"][tile[1]]]
-                elif tile[0] == 0: #dirt
-                    if "dirttl" not in tile_textures.keys():
-                        tile_textures["dirttl"] = [self.load_map_object('data/advmap_tiles/dirttl.def/%d.png'%i, 0) for i in xrange(46)]
-                    flip_x = bool(tile[6] & 1)
-                    flip_y = bool(tile[6] & 2)
-                    if flip_x or flip_y:
-                        new = tile_textures["dirttl"][tile[1]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["dirttl"][tile[1]].group
-                        self.__tiles[x,y] = [new]
-                    else:
-                        self.__tiles[x,y] = [tile_textures["dirttl"][tile[1]]]
-                elif tile[0] == 1: #sand
-                    if "sandtl" not in tile_textures.keys():
-                        tile_textures["sandtl"] = [self.load_map_object('data/advmap_tiles/sandtl.def/%d.png'%i, 0) for i in xrange(24)]
-                    self.__tiles[x,y] = [tile_textures["sandtl"][tile[1]]]
-                elif tile[0] == 2: #grass
-                    if "grastl" not in tile_textures.keys():
-                        tile_textures["grastl"] = [self.load_map_object('data/advmap_tiles/grastl.def/%d.png'%i, 0) for i in xrange(79)]
-                    flip_x = bool(tile[6] & 1)
-                    flip_y = bool(tile[6] & 2)
-                    if flip_x or flip_y:
-                        new = tile_textures["grastl"][tile[1]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["grastl"][tile[1]].group
-                        self.__tiles[x,y] = [new]
-                    else:
-                        self.__tiles[x,y] = [tile_textures["grastl"][tile[1]]]
-                elif tile[0] == 3: #snow
-                    if "snowtl" not in tile_textures.keys():
-                        tile_textures["snowtl"] = [self.load_map_object('data/advmap_tiles/snowtl.def/%d.png'%i, 0) for i in xrange(79)]
-                    flip_x = bool(tile[6] & 1)
-                    flip_y = bool(tile[6] & 2)
-                    if flip_x or flip_y:
-                        new = tile_textures["snowtl"][tile[1]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["snowtl"][tile[1]].group
-                        self.__tiles[x,y] = [new]
-                    else:
-                        self.__tiles[x,y] = [tile_textures["snowtl"][tile[1]]]
-                elif tile[0] == 4: #swamp
-                    if "swmptl" not in tile_textures.keys():
-                        tile_textures["swmptl"] = [self.load_map_object('data/advmap_tiles/swmptl.def/%d.png'%i, 0) for i in xrange(79)]
-                    flip_x = bool(tile[6] & 1)
-                    flip_y = bool(tile[6] & 2)
-                    if flip_x or flip_y:
-                        new = tile_textures["swmptl"][tile[1]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["swmptl"][tile[1]].group
-                        self.__tiles[x,y] = [new]
-                    else:
-                        self.__tiles[x,y] = [tile_textures["swmptl"][tile[1]]]
-                elif tile[0] == 5: #rough
-                    if "rougtl" not in tile_textures.keys():
-                        tile_textures["rougtl"] = [self.load_map_object('data/advmap_tiles/rougtl.def/%d.png'%i, 0) for i in xrange(79)]
-                    flip_x = bool(tile[6] & 1)
-                    flip_y = bool(tile[6] & 2)
-                    if flip_x or flip_y:
-                        new = tile_textures["rougtl"][tile[1]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["rougtl"][tile[1]].group
-                        self.__tiles[x,y] = [new]
-                    else:
-                        self.__tiles[x,y] = [tile_textures["rougtl"][tile[1]]]
-                elif tile[0] == 7: #lava
-                    if "lavatl" not in tile_textures.keys():
-                        tile_textures["lavatl"] = [self.load_map_object('data/advmap_tiles/lavatl.def/%d.png'%i, 0) for i in xrange(79)]
-                    flip_x = bool(tile[6] & 1)
-                    flip_y = bool(tile[6] & 2)
-                    if flip_x or flip_y:
-                        new = tile_textures["lavatl"][tile[1]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["lavatl"][tile[1]].group
-                        self.__tiles[x,y] = [new]
-                    else:
-                        self.__tiles[x,y] = [tile_textures["lavatl"][tile[1]]]
-                elif tile[0] == 8: #water 12 anims
-                    if "watrtl" not in tile_textures.keys():
-                        textures = [self.load_map_object('data/advmap_tiles/watrtl.def/%d/0.png'%i, 0) for i in xrange(33)]
-                        images = [[pyglet.image.load(None, file=pyglet.resource.file('data/advmap_tiles/watrtl.def/%d/%d.png'%(i,j))) for j in xrange(12)] for i in xrange(33)]
-                        tile_textures["watrtl"] = {
-                            (0,0):[Animation(texture, images[i]) for i, texture in enumerate(textures)],
-                            (1,0):[Animation(texture, images[i], flip_x=True) for i, texture in enumerate(textures)],
-                            (0,1):[Animation(texture, images[i], flip_y=True) for i, texture in enumerate(textures)],
-                            (1,1):[Animation(texture, images[i], flip_x=True, flip_y=True) for i, texture in enumerate(textures)],
-                        }
-                    flip_x = (tile[6]>>0)&1
-                    flip_y = (tile[6]>>1)&1
-                    self.__tiles[x,y] = [tile_textures["watrtl"][flip_x, flip_y][tile[1]]]
-                elif tile[0] == 9: #rock
-                    if "rocktl" not in tile_textures.keys():
-                        tile_textures["rocktl"] = [self.load_map_object('data/advmap_tiles/rocktl.def/%d.png'%i, 0) for i in xrange(48)]
-                    self.__tiles[x,y] = [tile_textures["rocktl"][tile[1]]]
-                else:
-                    raise NotImplementedError
-                
-                if tile[2] == 0: #no river
-                    pass
-                elif tile[2] == 1: #clrrvr 12 anims
-                    if "clrrvr" not in tile_textures.keys():
-                        textures = [self.load_map_object('data/advmap_tiles/clrrvr.def/%d/0.png'%i, 1) for i in xrange(13)]
-                        images = [[pyglet.image.load(None, file=pyglet.resource.file('data/advmap_tiles/clrrvr.def/%d/%d.png'%(i,j))) for j in xrange(12)] for i in xrange(13)]
-                        tile_textures["clrrvr"] = {
-                            (0,0):[Animation(texture, images[i]) for i, texture in enumerate(textures)],
-                            (1,0):[Animation(texture, images[i], flip_x=True) for i, texture in enumerate(textures)],
-                            (0,1):[Animation(texture, images[i], flip_y=True) for i, texture in enumerate(textures)],
-                            (1,1):[Animation(texture, images[i], flip_x=True, flip_y=True) for i, texture in enumerate(textures)],
-                        }
-                    flip_x = (tile[6]>>2)&1
-                    flip_y = (tile[6]>>3)&1
-                    self.__tiles[x,y].append(tile_textures["clrrvr"][flip_x, flip_y][tile[3]])
-                elif tile[2] == 2: #icyrvr
-                    if "icyrvr" not in tile_textures.keys():
-                        tile_textures["icyrvr"] = [self.load_map_object('data/advmap_tiles/icyrvr.def/%d.png'%i, 1) for i in xrange(13)]
-                    flip_x = bool(tile[6] & 4)
-                    flip_y = bool(tile[6] & 8)
-                    if flip_x or flip_y:
-                        new = tile_textures["icyrvr"][tile[3]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["icyrvr"][tile[3]].group
-                        self.__tiles[x, y].append(new)
-                    else:
-                        self.__tiles[x, y].append(tile_textures["icyrvr"][tile[3]])
-                elif tile[2] == 3: #mudrvr
-                    if "mudrvr" not in tile_textures.keys():
-                        textures = [self.load_map_object('data/advmap_tiles/mudrvr.def/%d/0.png'%i, 1) for i in xrange(13)]
-                        images = [[pyglet.image.load(None, file=pyglet.resource.file('data/advmap_tiles/clrrvr.def/%d/%d.png'%(i,j))) for j in xrange(12)] for i in xrange(13)]
-                        tile_textures["mudrvr"] = {
-                            (0,0):[Animation(texture, images[i]) for i, texture in enumerate(textures)],
-                            (1,0):[Animation(texture, images[i], flip_x=True) for i, texture in enumerate(textures)],
-                            (0,1):[Animation(texture, images[i], flip_y=True) for i, texture in enumerate(textures)],
-                            (1,1):[Animation(texture, images[i], flip_x=True, flip_y=True) for i, texture in enumerate(textures)],
-                        }
-                    flip_x = (tile[6]>>2)&1
-                    flip_y = (tile[6]>>3)&1
-                    self.__tiles[x,y].append(tile_textures["mudrvr"][flip_x, flip_y][tile[3]])
-                elif tile[2] == 4: #lavrvr
-                    if "lavrvr" not in tile_textures.keys():
-                        textures = [self.load_map_object('data/advmap_tiles/lavrvr.def/%d/0.png'%i, 1) for i in xrange(13)]
-                        images = [[pyglet.image.load(None, file=pyglet.resource.file('data/advmap_tiles/clrrvr.def/%d/%d.png'%(i,j))) for j in xrange(9)] for i in xrange(13)]
-                        tile_textures["lavrvr"] = {
-                            (0,0):[Animation(texture, images[i]) for i, texture in enumerate(textures)],
-                            (1,0):[Animation(texture, images[i], flip_x=True) for i, texture in enumerate(textures)],
-                            (0,1):[Animation(texture, images[i], flip_y=True) for i, texture in enumerate(textures)],
-                            (1,1):[Animation(texture, images[i], flip_x=True, flip_y=True) for i, texture in enumerate(textures)],
-                        }
-                    flip_x = (tile[6]>>2)&1
-                    flip_y = (tile[6]>>3)&1
-                    self.__tiles[x,y].append(tile_textures["lavrvr"][flip_x, flip_y][tile[3]])
-                else:
-                    raise NotImplementedError, tile[2]
-                
-                if tile[4] == 0: #no road
-                    pass
-                elif tile[4] == 1: #dirtrd
-                    if "dirtrd" not in tile_textures.keys():
-                        tile_textures["dirtrd"] = [self.load_map_object('data/advmap_tiles/dirtrd.def/%d.png'%i, 1) for i in xrange(17)]
-                    flip_x = bool(tile[6] & 16)
-                    flip_y = bool(tile[6] & 32)
-                    if flip_x or flip_y:
-                        new = tile_textures["dirtrd"][tile[5]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["dirtrd"][tile[5]].group
-                        self.__tiles[x, y].append(new)
-                    else:
-                        self.__tiles[x, y].append(tile_textures["dirtrd"][tile[5]])
-                elif tile[4] == 2: #gravrd
-                    if "gravrd" not in tile_textures.keys():
-                        tile_textures["gravrd"] = [self.load_map_object('data/advmap_tiles/gravrd.def/%d.png'%i, 1) for i in xrange(17)]
-                    flip_x = bool(tile[6] & 16)
-                    flip_y = bool(tile[6] & 32)
-                    if flip_x or flip_y:
-                        new = tile_textures["gravrd"][tile[5]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["gravrd"][tile[5]].group
-                        self.__tiles[x, y].append(new)
-                    else:
-                        self.__tiles[x, y].append(tile_textures["gravrd"][tile[5]])
-                elif tile[4] == 3: #cobbrd
-                    if "cobbrd" not in tile_textures.keys():
-                        tile_textures["cobbrd"] = [self.load_map_object('data/advmap_tiles/cobbrd.def/%d.png'%i, 1) for i in xrange(17)]
-                    flip_x = bool(tile[6] & 16)
-                    flip_y = bool(tile[6] & 32)
-                    if flip_x or flip_y:
-                        new = tile_textures["cobbrd"][tile[5]].get_transform(flip_x=flip_x, flip_y=flip_y)
-                        new.group = tile_textures["cobbrd"][tile[5]].group
-                        self.__tiles[x, y].append(new)
-                    else:
-                        self.__tiles[x, y].append(tile_textures["cobbrd"][tile[5]])
-                else:
-                    raise NotImplementedError, tile[4]
+        self.__tile_textures = {}
+        self.__tile_frames = {}
+        self.__regions = {}
+        used = used_tiles(h3m_data["upper_terrain"])
+        if h3m_data["underworld"]:
+            used |= used_tiles(h3m_data["lower_terrain"])
+        used = [(LAYER_DEFS[type_field][1], tile_type, index)
+                for type_field, tile_type, index in sorted(used)
+                if tile_type != LAYER_DEFS[type_field][0]]
+        object_defs = ["data/advmap_objects/" + obj["filename"]
+                       for obj in h3m_data["objects"]]
+        object_files = [[name + "/%d.png" % i
+                         for i in xrange(self.frame_count(name))]
+                        for name in object_defs]
+        #objects go first and tallest first, the 32x32 tiles fill the gaps,
+        #the heights are known without decoding anything
+        heights = [self.frame_height(name) for name in object_defs]
+        tallest = sorted(xrange(len(object_defs)), key=heights.__getitem__,
+                         reverse=True)
         
-        images = []
-        for order, obj in enumerate(h3m_data["objects"]):
-            imgs = []
-            i = 0
-            while 1:
-                imgs.append(pyglet.image.load(None, file=pyglet.resource.file("data/advmap_objects/" + obj["filename"] + "/%d.png"%i)))
-                i += 1
-                if "data/advmap_objects/" + obj["filename"] + "/%d.png" % i not in pyglet.resource._default_loader._index.keys():
-                    break;
-            images.append((imgs, order))
+        if images is not None:
+            paths = [path for order in tallest for path in object_files[order]]
+            paths.extend(path for key in used for path in tile_files(*key))
+            images.request([path for path in paths
+                            if self.bundle is None or path not in self.bundle])
         
-        self.objects = []
-        for imgs in sorted(images, key=lambda i:i[0][0].height, reverse=True):
-            try:
-                texture = self.current_atlas.add(imgs[0][0])
-            except pyglet.image.atlas.AllocatorException:
-                self.current_atlas = pyglet.image.atlas.TextureAtlas(1024, 1024)
-                texture = self.current_atlas.add(imgs[0][0])
-            group = OrderedTextureGroup(2, self.current_atlas.texture)
-            if group not in self.groups:
-                self.groups.append(group)
-            group = self.groups.index(group)
-            texture.group = group
-            self.objects.append((Animation(texture, imgs[0]), imgs[1]))
+        total = len(used) + len(object_defs)
+        self.objects = [None] * len(object_defs)
+        for done, order in enumerate(tallest):
+            files = object_files[order]
+            while self.__waiting(files):
+                yield done, total
+            frames = [self.load_image(file) for file in files]
+            texture = self.load_map_object(files[0], 2, frames[0])
+            self.objects[order] = Animation(texture, frames)
+            yield done + 1, total
         
-        self.objects = [i[0] for i in sorted(self.objects, key=lambda i:i[1])]
+        for done, key in enumerate(used, len(object_defs)):
+            while self.__waiting(tile_files(*key)):
+                yield done, total
+            self.__tile_texture(*key)
+            yield done + 1, total
+        self.__levels = [self.__load_terrain(h3m_data["upper_terrain"])]
+        if h3m_data["underworld"]:
+            self.__levels.append(self.__load_terrain(h3m_data["lower_terrain"]))
         
         self.tunedobj = {}
-        for obj in [i for i in h3m_data["tunedobj"] if i["z"]==0]:
-            self.__tiles[obj["x"] + 9,obj["y"] + 8].append(self.objects[obj["id"]])
+        self.__object_levels = [ChunkIndex() for level in self.__levels]
+        for number, obj in enumerate(h3m_data["tunedobj"]):
+            self.place_object(self.objects[obj["id"]], obj["x"] + 9,
+                              obj["y"] + 8, obj["z"], number)
+        self.set_level(0)
+        #blocked and visitable tiles in map coordinates, without the padding
+        self.passability = Passability(h3m_data)
+    
+    def place_object(self, obj, x, y, z, number=None):
+        """file an object under the tiles its sprite covers, x and y are the
+        bottom right tile the sprite is anchored at, number breaks ties
+        between objects on the same tile and defaults to the last place"""
+        index = self.__object_levels[z]
+        width = (obj.width + 31) // 32
+        height = (obj.height + 31) // 32
+        if number is None:
+            number = len(index)
+        #rows are drawn from the top down and right to left in each row
+        return index.insert(obj, x - width + 1, y - height + 1, x, y,
+                            (y, -x, number))
+    
+    def objects_in(self, x1, y1, x2, y2):
+        """objects of the current level whose sprites overlap the tile
+        rectangle, in drawing order"""
+        return self.__objects.query(x1, y1, x2, y2)
+    
+    def objects_at(self, x, y):
+        """objects whose sprites cover a tile, the topmost last"""
+        return self.__objects.at(x, y)
+    
+    def atlas_usage(self):
+        """fill ratio of every atlas page, prebaked pages are not included"""
+        return [atlas.allocator.get_usage() for atlas in self.atlases]
+    
+    def frame_memory(self):
+        """bytes of animation frames held in memory and the bytes they would
+        take if every flipped variant had its own copy"""
+        animations = [region for region in self.__regions.itervalues()
+                      if isinstance(region, Animation)] + self.objects
+        stores = set(animation.store for animation in animations)
+        return (sum(store.size for store in stores),
+                sum(animation.store.size for animation in animations))
+    
+    @property
+    def levels(self):
+        return len(self.__levels)
+    
+    def set_level(self, level):
+        """make get_tiles() return the tiles of another level, all levels are
+        built on load so this only swaps the tile dict and object index"""
+        self.level = level
+        self.__tiles = self.__levels[level]
+        self.__objects = self.__object_levels[level]
     
     def get_tiles(self, tiles_x, tiles_y, div_x, div_y):
-        for y in xrange(tiles_y - 1, -6, -1):
+        for y in xrange(tiles_y - 1, -1, -1):
             y1 = y * 32
-            for x in xrange(tiles_x + 5 - 1, -1, -1):
+            for x in xrange(tiles_x - 1, -1, -1):
                 for obj in self.__tiles.get((x - div_x, div_y - y), []):
-                    x1 = x * 32 - obj.width + 32
-                    x2 = x1 + obj.width
-                    y2 = y1 + obj.height
-                    yield obj, [x1, y1, x2, y1, x2, y2, x1, y2]
+                    x1 = x * 32
+                    yield obj, [x1, y1, x1 + 32, y1, x1 + 32, y1 + 32,
+                                x1, y1 + 32]
+        #objects reaching into the viewport from any side, not only the
+        #ones anchored on it
+        for entry in self.__objects.query_entries(-div_x, div_y - tiles_y + 1,
+                                                  tiles_x - 1 - div_x, div_y):
+            obj = entry[6]
+            x2 = (entry[4] + div_x + 1) * 32
+            y1 = (div_y - entry[5]) * 32
+            x1 = x2 - obj.width
+            y2 = y1 + obj.height
+            yield obj, [x1, y1, x2, y1, x2, y2, x1, y2]
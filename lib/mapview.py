@@ -17,14 +17,22 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
 import pyglet
 from lib.interface import *
 from lib.mapset import *
 
 class MapView(object):
-    def __init__(self, mapset, window):
+    def __init__(self, mapset, window, fog=None, player=0, minimap=None):
         self.window = window
         self.mapset = mapset
+        # explored tiles of the player whose view this is, None shows all
+        self.fog = fog
+        self.player = player
+        self._init_fog()
+        # drawn into the right sidebar when given
+        self.minimap = minimap
+        self._init_minimap()
         self._first_time_init()
         self._init_view()
         # mouse position
@@ -51,10 +59,70 @@ class MapView(object):
         self.mouse_x = self.mouse_dx = 0
         self.mouse_y = self.mouse_dy = 0
     
+    def _init_fog(self):
+        # one texel per map tile and level, its alpha darkens the unexplored
+        # tiles, the texture rows go from the top of the map down
+        self.fog_textures = []
+        if self.fog is None:
+            return
+        for z in xrange(self.fog.levels):
+            self.fog_textures.append(pyglet.image.Texture.create(
+                self.fog.size, self.fog.size, pyglet.gl.GL_ALPHA,
+                min_filter=pyglet.gl.GL_NEAREST,
+                mag_filter=pyglet.gl.GL_NEAREST))
+        # the first update uploads everything, the fog starts out dirty
+        self.upload_fog()
+    
+    def _init_minimap(self):
+        # one RGB texel per map tile and level, rows from the top down
+        self.minimap_textures = []
+        if self.minimap is None:
+            return
+        for z in xrange(self.minimap.levels):
+            self.minimap_textures.append(pyglet.image.Texture.create(
+                self.minimap.size, self.minimap.size, pyglet.gl.GL_RGB,
+                min_filter=pyglet.gl.GL_NEAREST,
+                mag_filter=pyglet.gl.GL_NEAREST))
+        self.upload_minimap()
+    
+    def _upload_box(self, texture, box, format, data):
+        # replace the texels of an x1, y1, x2, y2 box of map tiles
+        x1, y1, x2, y2 = box
+        pyglet.gl.glBindTexture(texture.target, texture.id)
+        pyglet.gl.glPushClientAttrib(pyglet.gl.GL_CLIENT_PIXEL_STORE_BIT)
+        pyglet.gl.glPixelStorei(pyglet.gl.GL_UNPACK_ALIGNMENT, 1)
+        pyglet.gl.glTexSubImage2D(texture.target, texture.level,
+                texture.x + x1, texture.y + y1, x2 - x1 + 1, y2 - y1 + 1,
+                format, pyglet.gl.GL_UNSIGNED_BYTE, data)
+        pyglet.gl.glPopClientAttrib()
+    
+    def upload_fog(self):
+        """copy the rectangles of the fog that changed since the last frame
+        into the fog textures"""
+        if self.fog is None:
+            return
+        for z, texture in enumerate(self.fog_textures):
+            box = self.fog.take_dirty(self.player, z)
+            if box is not None:
+                self._upload_box(texture, box, pyglet.gl.GL_ALPHA,
+                                 self.fog.rows(self.player, z, *box))
+    
+    def upload_minimap(self):
+        """copy the tiles the minimap recolored since the last frame into
+        the minimap textures"""
+        if self.minimap is None:
+            return
+        for z, texture in enumerate(self.minimap_textures):
+            box = self.minimap.take_dirty(z)
+            if box is not None:
+                self._upload_box(texture, box, pyglet.gl.GL_RGB,
+                                 self.minimap.pixels(z, *box))
+    
     def _init_view(self):
         # initiate new batch
         self.batch = pyglet.graphics.Batch()
-        # initiate new vertex list
+        # initiate new vertex list, groups loaded later get theirs in
+        # update_vertex_lists()
         self.vl_objects = [None for value in self.mapset.groups]
         # size of the viewport
         self.vp_width = self.window.width - IF_RIGHT - IF_LEFT
@@ -133,6 +201,9 @@ class MapView(object):
         pyglet.gl.glTranslatef(self.view_x+IF_LEFT, self.view_y+IF_BOTTOM, 0)
         pyglet.gl.glScalef(self.tile_size/32.0, self.tile_size/32.0, 0.0)
         self.batch.draw()
+        if self.fog is not None:
+            self._draw_map_texture(self.fog_textures[self.mapset.level],
+                                   self.fog_vertices, (0, 0, 0, 1))
         pyglet.gl.glPopMatrix()
         pyglet.gl.glLoadIdentity()
         pyglet.gl.glEnable(pyglet.gl.GL_BLEND)
@@ -141,8 +212,39 @@ class MapView(object):
         pyglet.gl.glRectf(self.window.width-IF_RIGHT, 0, self.window.width, self.window.height)
         pyglet.gl.glRectf(0, self.window.height-IF_TOP, self.window.width, self.window.height)
         pyglet.gl.glRectf(0, 0, IF_LEFT, self.window.height)
+        if self.minimap is not None:
+            self.draw_minimap()
         self.label.draw()
     
+    def _draw_map_texture(self, texture, vertices, color):
+        # the top of the texture is the bottom of the map on screen
+        coords = texture.tex_coords
+        tex_coords = coords[9:12] + coords[6:9] + coords[3:6] + coords[0:3]
+        pyglet.gl.glEnable(pyglet.gl.GL_BLEND)
+        pyglet.gl.glEnable(texture.target)
+        pyglet.gl.glBindTexture(texture.target, texture.id)
+        pyglet.gl.glColor4f(*color)
+        pyglet.graphics.draw(4, pyglet.gl.GL_QUADS,
+                             ('v2i', vertices),
+                             ('t3f', tex_coords))
+        pyglet.gl.glColor4f(1, 1, 1, 1)
+        pyglet.gl.glDisable(texture.target)
+    
+    def draw_minimap(self):
+        # a block of whole pixels per tile, centered at the top of the sidebar
+        side = self.minimap.size * (MINIMAP_SIZE // self.minimap.size) or \
+               MINIMAP_SIZE
+        margin = (IF_RIGHT - side) // 2
+        x1 = self.window.width - IF_RIGHT + margin
+        y2 = self.window.height - IF_TOP - margin
+        vertices = [x1, y2 - side, x1 + side, y2 - side, x1 + side, y2,
+                    x1, y2]
+        self._draw_map_texture(self.minimap_textures[self.mapset.level],
+                               vertices, (1, 1, 1, 1))
+        if self.fog is not None:
+            self._draw_map_texture(self.fog_textures[self.mapset.level],
+                                   vertices, (0, 0, 0, 1))
+    
     def _move(self, dx, dy):
         # new map position
         new_x = self.x - dx
@@ -218,12 +320,12 @@ class MapView(object):
             self.y = new_y
     
     def update_vertex_lists(self):
-        # initiate lists of vertex lists, vertices, texture coords, vertices
-        # counts and map objects for each group
-        vertices = [[] for value in self.mapset.groups]
-        tex_coords = [[] for value in self.mapset.groups]
-        count = [0 for value in self.mapset.groups]
-        self.cur_objects = [[] for value in self.mapset.groups]
+        # initiate vertices, texture coords, vertices counts and map objects
+        # by group, tiles loaded while gathering them can add new groups
+        vertices = collections.defaultdict(list)
+        tex_coords = collections.defaultdict(list)
+        count = collections.defaultdict(int)
+        cur_objects = collections.defaultdict(list)
         # for each tile in the viewport, update the list of the specific group
         for obj, coords in self.mapset.get_tiles(self.tiles_x, self.tiles_y,
                                                  self.div_x, self.div_y):
@@ -231,7 +333,11 @@ class MapView(object):
             vertices[obj.group].extend(coords)
             count[obj.group]+=4
             if isinstance(obj, Animation):
-                self.cur_objects[obj.group].append(obj)
+                cur_objects[obj.group].append(obj)
+        # new groups start without a vertex list
+        self.vl_objects.extend([None] * (len(self.mapset.groups) -
+                                         len(self.vl_objects)))
+        self.cur_objects = [[] for value in self.mapset.groups]
         for i, group in enumerate(self.mapset.groups):
             if count[i] == 0:
                 if self.vl_objects[i] is None:
@@ -257,7 +363,15 @@ class MapView(object):
                     self.vl_objects[i].vertices = vertices[i]
                     self.vl_objects[i].colors = (255,255,255,255)*count[i]
             # make object list unique
-            self.cur_objects[i] = list(set(self.cur_objects[i]))
+            self.cur_objects[i] = list(set(cur_objects[i]))
+        # the fog covers the map without its padding of 9 tiles left and
+        # right and 8 tiles at the top and bottom
+        if self.fog is not None:
+            x1 = (9 + self.div_x) * 32
+            y2 = (self.div_y - 8 + 1) * 32
+            x2 = x1 + self.fog.size * 32
+            y1 = y2 - self.fog.size * 32
+            self.fog_vertices = [x1, y1, x2, y1, x2, y2, x1, y2]
     
     def update(self, dt):
         try:
@@ -296,6 +410,10 @@ class MapView(object):
             self._move(self.dx, self.dy)
             self.dx = 0
             self.dy = 0
+        # heroes that moved since the last frame explored new tiles, objects
+        # changed hands or the terrain changed
+        self.upload_fog()
+        self.upload_minimap()
         # mouse position:
         if self.mouse_x != self.mouse_dx or self.mouse_y != self.mouse_dy:
             self.mouse_x = self.mouse_dx
@@ -320,9 +438,17 @@ class MapView(object):
     
     def on_resize(self, width, height):
         self._init_view()
+
+    def on_key_press(self, symbol, modifiers):
+        if symbol == pyglet.window.key.U and self.mapset.levels > 1:
+            # switch between surface and underworld, both are already
+            # loaded so only the vertex lists have to be refilled
+            self.mapset.set_level((self.mapset.level + 1) % self.mapset.levels)
+            self.update_vertex_lists()
+            return pyglet.event.EVENT_HANDLED
     
     def animate_water(self, dt):
-        for i, group in enumerate(self.mapset.groups):
+        for i in xrange(len(self.cur_objects)):
             if len(self.cur_objects[i]) > 0:
                 pyglet.gl.glBindTexture(self.cur_objects[i][0].tex.target,
                                         self.cur_objects[i][0].tex.id)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import pyglet
+from pyglet.image.atlas import AllocatorException
+
+class MaxRectsAllocator(object):
+    """drop-in replacement for pyglet.image.atlas.Allocator
+
+    keeps every maximal free rectangle instead of pyglet's horizontal strips
+    and puts a box where it leaves the shortest side over, so boxes of
+    mixed heights do not waste the space above the lower ones
+    """
+    def __init__(self, width, height):
+        assert width > 0 and height > 0
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+        self.used_area = 0
+
+    def find(self, width, height):
+        """bottom left corner the box would get or None if it does not fit"""
+        best = None
+        best_fit = None
+        for x, y, free_width, free_height in self.free:
+            if free_width >= width and free_height >= height:
+                left_x = free_width - width
+                left_y = free_height - height
+                fit = (min(left_x, left_y), max(left_x, left_y))
+                if best_fit is None or fit < best_fit:
+                    best, best_fit = (x, y), fit
+        return best
+
+    def alloc(self, width, height):
+        position = self.find(width, height)
+        if position is None:
+            raise AllocatorException('No more space in %r for box %dx%d' % (
+                    self, width, height))
+        self.place(position[0], position[1], width, height)
+        self.used_area += width * height
+        return position
+
+    def place(self, x, y, width, height):
+        x2 = x + width
+        y2 = y + height
+        free = []
+        for rect in self.free:
+            fx, fy, fw, fh = rect
+            fx2 = fx + fw
+            fy2 = fy + fh
+            if x >= fx2 or x2 <= fx or y >= fy2 or y2 <= fy:
+                free.append(rect)
+                continue
+            #split what is left of the free rectangle around the box
+            if x > fx:
+                free.append((fx, fy, x - fx, fh))
+            if x2 < fx2:
+                free.append((x2, fy, fx2 - x2, fh))
+            if y > fy:
+                free.append((fx, fy, fw, y - fy))
+            if y2 < fy2:
+                free.append((fx, y2, fw, fy2 - y2))
+        #drop rectangles that lie within others
+        free.sort(key=lambda rect: rect[2] * rect[3], reverse=True)
+        self.free = []
+        for rect in free:
+            fx, fy, fw, fh = rect
+            for ox, oy, ow, oh in self.free:
+                if fx >= ox and fy >= oy and fx + fw <= ox + ow and \
+                   fy + fh <= oy + oh:
+                    break
+            else:
+                self.free.append(rect)
+
+    def get_usage(self):
+        return self.used_area / float(self.width * self.height)
+
+class TextureAtlas(pyglet.image.atlas.TextureAtlas):
+    """pyglet's TextureAtlas packed by a MaxRectsAllocator"""
+    def __init__(self, width=1024, height=1024):
+        super(TextureAtlas, self).__init__(width, height)
+        self.allocator = MaxRectsAllocator(width, height)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from lib.passability import Passability, mask_offsets
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#minimap colors of the terrain types, passable and blocked
+TERRAIN_COLORS = (
+    ((82, 56, 8), (57, 40, 8)), #dirt
+    ((222, 207, 140), (165, 158, 107)), #sand
+    ((0, 65, 0), (0, 48, 0)), #grass
+    ((181, 199, 198), (140, 158, 156)), #snow
+    ((74, 134, 107), (33, 89, 66)), #swamp
+    ((132, 113, 49), (99, 81, 33)), #rough
+    ((132, 48, 0), (90, 8, 0)), #subterranean
+    ((74, 73, 74), (41, 40, 41)), #lava
+    ((8, 81, 148), (8, 81, 148)), #water
+    ((0, 0, 0), (0, 0, 0)), #rock
+)
+#colors of the objects of every player in the order of h3m.PLAYER_COLORS,
+#the last one is for objects that could be owned but are not
+OWNER_COLORS = ((255, 0, 0), (49, 82, 255), (156, 115, 82), (66, 148, 41),
+                (255, 132, 0), (140, 41, 165), (8, 156, 165), (198, 123, 140),
+                (132, 132, 132))
+NEUTRAL = len(OWNER_COLORS) - 1
+#owner of tiles without an object that can be owned
+NO_OWNER = 255
+
+#palette entries: passable terrain, blocked terrain, then the owners
+BLOCKED = len(TERRAIN_COLORS)
+OWNED = 2 * len(TERRAIN_COLORS)
+PALETTE = [colors[0] for colors in TERRAIN_COLORS] + \
+          [colors[1] for colors in TERRAIN_COLORS] + list(OWNER_COLORS)
+#the pixel of every palette entry as a string
+_PIXELS = ["".join(chr(value) for value in color) for color in PALETTE]
+if numpy is not None:
+    _PALETTE_ARRAY = numpy.array(PALETTE, numpy.uint8)
+
+class Minimap(object):
+    """one RGB pixel per tile and level of a map, colored by terrain and by
+    the owner of the object on it
+
+    index holds a palette entry per tile of every level as a bytearray
+    indexed y * size + x, terrain, blocked and owners hold what it is made
+    from in the same layout, the setters recolor only the tiles they touch
+    and collect their box until take_dirty() hands it out
+    """
+    def __init__(self, map_data, passability=None):
+        self.size = size = map_data["map_size"]
+        self.levels = levels = 2 if map_data["underworld"] else 1
+        if passability is None:
+            passability = Passability(map_data)
+        self.terrain = [self.__terrain_types(map_data["lower_terrain" if z
+                                                      else "upper_terrain"])
+                        for z in xrange(levels)]
+        self.blocked = [passability.flat(passability.blocked, z)
+                        for z in xrange(levels)]
+        self.owners = [bytearray([NO_OWNER]) * (size * size)
+                       for z in xrange(levels)]
+        #tiles colored by every object that has an owner, by object number
+        self.footprints = {}
+        templates = map_data["objects"]
+        offsets = {}
+        for number, obj in enumerate(map_data["tunedobj"]):
+            if "owner" not in obj or obj["z"] >= levels:
+                continue
+            if obj["id"] not in offsets:
+                offsets[obj["id"]] = mask_offsets(
+                    templates[obj["id"]]["passability"], 0)
+            tiles = []
+            for dx, dy in offsets[obj["id"]]:
+                x = obj["x"] + dx
+                y = obj["y"] + dy
+                if 0 <= x < size and 0 <= y < size:
+                    tiles.append(y * size + x)
+            self.footprints[number] = (obj["z"], tiles)
+            self.__own(obj["z"], tiles, obj["owner"])
+        self.rebuild()
+
+    def __terrain_types(self, terrain):
+        #the type of every tile as a bytearray, without the edge read_map()
+        #pads the map with, unknown types are drawn as rock
+        size = self.size
+        left = (len(terrain[0]) - size) // 2
+        top = (len(terrain) - size) // 2
+        if numpy is not None and isinstance(terrain, numpy.ndarray):
+            types = terrain[top:top + size, left:left + size, 0]
+            types = numpy.where((types >= 0) & (types < BLOCKED), types,
+                                BLOCKED - 1)
+            return bytearray(types.astype(numpy.uint8).tostring())
+        return bytearray(tile[0] if 0 <= tile[0] < BLOCKED else BLOCKED - 1
+                         for line in terrain[top:top + size]
+                         for tile in line[left:left + size])
+
+    def __own(self, z, tiles, owner):
+        owners = self.owners[z]
+        owner = owner if owner < NEUTRAL else NEUTRAL
+        for tile in tiles:
+            owners[tile] = owner
+
+    def rebuild(self):
+        """recolor every tile of every level"""
+        size = self.size
+        if numpy is not None:
+            self.index = []
+            for z in xrange(self.levels):
+                terrain = numpy.frombuffer(self.terrain[z], numpy.uint8)
+                blocked = numpy.frombuffer(self.blocked[z], numpy.uint8)
+                owners = numpy.frombuffer(self.owners[z], numpy.uint8)
+                index = numpy.where(owners != NO_OWNER, OWNED + owners,
+                                    terrain + BLOCKED * blocked)
+                self.index.append(bytearray(index.astype(numpy.uint8)
+                                            .tostring()))
+        else:
+            self.index = [bytearray(OWNED + owner if owner != NO_OWNER else
+                                    terrain + BLOCKED * blocked
+                                    for terrain, blocked, owner in
+                                    zip(self.terrain[z], self.blocked[z],
+                                        self.owners[z]))
+                          for z in xrange(self.levels)]
+        self.dirty = [(0, 0, size - 1, size - 1) for z in xrange(self.levels)]
+
+    def __recolor(self, z, tiles):
+        size = self.size
+        terrain = self.terrain[z]
+        blocked = self.blocked[z]
+        owners = self.owners[z]
+        index = self.index[z]
+        box = self.dirty[z]
+        for tile in tiles:
+            owner = owners[tile]
+            if owner != NO_OWNER:
+                color = OWNED + owner
+            else:
+                color = terrain[tile] + BLOCKED * blocked[tile]
+            if index[tile] == color:
+                continue
+            index[tile] = color
+            y, x = divmod(tile, size)
+            if box is None:
+                box = (x, y, x, y)
+            else:
+                box = (min(box[0], x), min(box[1], y),
+                       max(box[2], x), max(box[3], y))
+        self.dirty[z] = box
+
+    def set_terrain(self, x, y, z, terrain_type):
+        #unknown types are drawn as rock like in __terrain_types()
+        if not 0 <= terrain_type < BLOCKED:
+            terrain_type = BLOCKED - 1
+        tile = y * self.size + x
+        self.terrain[z][tile] = terrain_type
+        self.__recolor(z, (tile, ))
+
+    def set_blocked(self, x, y, z, blocked):
+        tile = y * self.size + x
+        self.blocked[z][tile] = bool(blocked)
+        self.__recolor(z, (tile, ))
+
+    def set_owner(self, number, owner):
+        """give the object with a number of map_data["tunedobj"] to a
+        player, NO_OWNER makes it neutral"""
+        z, tiles = self.footprints[number]
+        self.__own(z, tiles, owner)
+        self.__recolor(z, tiles)
+
+    def take_dirty(self, z):
+        """the box (x1, y1, x2, y2) recolored since the last call, None if
+        nothing was"""
+        box = self.dirty[z]
+        self.dirty[z] = None
+        return box
+
+    def pixels(self, z, x1, y1, x2, y2):
+        """RGB bytes of the tiles of a box, rows from y1 to y2"""
+        size = self.size
+        index = self.index[z]
+        if numpy is not None:
+            index = numpy.frombuffer(index, numpy.uint8).reshape(size, size)
+            return _PALETTE_ARRAY[index[y1:y2 + 1, x1:x2 + 1]].tostring()
+        pixels = _PIXELS
+        return "".join(["".join([pixels[color] for color in
+                                 index[y * size + x1:y * size + x2 + 1]])
+                        for y in xrange(y1, y2 + 1)])
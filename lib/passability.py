@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import operator
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#template masks cover 8x6 tiles ending at the tile an object is placed at,
+#one byte per row from the top, the lowest bit is the leftmost column and
+#the highest the column of that tile
+MASK_WIDTH = 8
+MASK_HEIGHT = 6
+
+def mask_offsets(mask, bit):
+    """(dx, dy) relative to the anchor of every tile whose bit is set to
+    bit, passability marks blocked tiles with 0 and actions visitable
+    ones with 1"""
+    offsets = []
+    for row, byte in enumerate(bytearray(mask)):
+        for column in xrange(MASK_WIDTH):
+            if (byte >> column) & 1 == bit:
+                offsets.append((column - MASK_WIDTH + 1,
+                                row - MASK_HEIGHT + 1))
+    return offsets
+
+def template_masks(templates, key, bit):
+    """(templates, 6, 8) bool array of the tiles every template marks"""
+    data = numpy.frombuffer("".join(template[key] for template in templates),
+                            numpy.uint8).reshape(len(templates), MASK_HEIGHT)
+    #unpackbits starts with the highest bit
+    return numpy.unpackbits(data[..., None], axis=2)[..., ::-1] == bit
+
+class Passability(object):
+    """blocked and visitable tiles of every level
+
+    with numpy blocked and visitable are (levels, size, size) bool arrays
+    indexed [z, y, x], otherwise one bytearray of size*size per level
+    indexed y*size + x
+    """
+    def __init__(self, map_data):
+        self.size = map_data["map_size"]
+        self.levels = 2 if map_data["underworld"] else 1
+        templates = map_data["objects"]
+        objects = map_data["tunedobj"]
+        if numpy is not None:
+            #id, x, y and z of all objects as four arrays
+            placement = numpy.fromiter(itertools.chain.from_iterable(
+                itertools.imap(operator.itemgetter("id", "x", "y", "z"),
+                               objects)), numpy.int32, len(objects) * 4)
+            placement = placement.reshape(len(objects), 4).T
+            self.blocked = self.__rasterize(templates, placement,
+                                            "passability", 0)
+            self.visitable = self.__rasterize(templates, placement,
+                                              "actions", 1)
+        else:
+            self.blocked = self.__rasterize_lists(templates, objects,
+                                                  "passability", 0)
+            self.visitable = self.__rasterize_lists(templates, objects,
+                                                    "actions", 1)
+
+    def __rasterize(self, templates, placement, key, bit):
+        size = self.size
+        grid = numpy.zeros((self.levels, size, size), numpy.bool_)
+        if not placement.size:
+            return grid
+        masks = template_masks(templates, key, bit)
+        ids, x, y, z = placement
+        #every marked mask tile of every object in one go
+        number, row, column = numpy.nonzero(masks[ids])
+        tile_x = x[number] + column - (MASK_WIDTH - 1)
+        tile_y = y[number] + row - (MASK_HEIGHT - 1)
+        inside = ((tile_x >= 0) & (tile_x < size) & (tile_y >= 0) &
+                  (tile_y < size) & (z[number] < self.levels))
+        grid[z[number][inside], tile_y[inside], tile_x[inside]] = True
+        return grid
+
+    def __rasterize_lists(self, templates, objects, key, bit):
+        size = self.size
+        grids = [bytearray(size * size) for level in xrange(self.levels)]
+        offsets = [mask_offsets(template[key], bit) for template in templates]
+        for obj in objects:
+            if obj["z"] >= self.levels:
+                continue
+            grid = grids[obj["z"]]
+            for dx, dy in offsets[obj["id"]]:
+                x = obj["x"] + dx
+                y = obj["y"] + dy
+                if 0 <= x < size and 0 <= y < size:
+                    grid[y * size + x] = 1
+        return grids
+
+    def __tile(self, grids, x, y, z):
+        if numpy is not None and isinstance(grids, numpy.ndarray):
+            return bool(grids[z, y, x])
+        return bool(grids[z][y * self.size + x])
+
+    def is_blocked(self, x, y, z):
+        return self.__tile(self.blocked, x, y, z)
+
+    def is_visitable(self, x, y, z):
+        return self.__tile(self.visitable, x, y, z)
+
+    def flat(self, grids, z):
+        """one level of blocked or visitable as a bytearray of 0 and 1,
+        indexed y*size + x"""
+        if numpy is not None and isinstance(grids, numpy.ndarray):
+            return bytearray(grids[z].tostring())
+        return bytearray(grids[z])
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import heapq
+import time
+from array import array
+from lib.passability import Passability, mask_offsets
+from lib.pathfinding import DIAGONAL, PathGrid
+
+#edge length in tiles of the clusters a level is cut into
+CLUSTER_SIZE = 16
+#runs of open border tiles at least this long get a transition at each end
+LONG_ENTRANCE = 6
+#object classes that move a hero somewhere else
+MONOLITH_ENTRANCE = 43
+MONOLITH_EXIT = 44
+MONOLITH_TWO_WAY = 45
+SUBTERRANEAN_GATE = 103
+#marks the abstract node a hero leaves a portal tile from
+EXIT = 1
+#query latencies kept for the metrics
+LATENCIES = 1000
+
+def portals(map_data, grids):
+    """(object, template, tiles) of every gate and monolith, tiles are the
+    (z, node) of its visitable tiles"""
+    found = []
+    for obj in map_data["tunedobj"]:
+        template = map_data["objects"][obj["id"]]
+        if template["class"] not in (MONOLITH_ENTRANCE, MONOLITH_EXIT,
+                                     MONOLITH_TWO_WAY, SUBTERRANEAN_GATE):
+            continue
+        if obj["z"] >= len(grids):
+            continue
+        grid = grids[obj["z"]]
+        tiles = [(obj["x"] + dx, obj["y"] + dy)
+                 for dx, dy in mask_offsets(template["actions"], 1)]
+        found.append((obj, template,
+                      [(obj["z"], grid.node(x, y)) for x, y in tiles
+                       if 0 <= x < grid.size and 0 <= y < grid.size]))
+    return found
+
+def portal_links(map_data, grids, found=None):
+    """(entry, exit) abstract nodes of every gate and monolith connection,
+    an entry is (z, node of the visitable tile) and only leads through the
+    portal, an exit is (z, node, EXIT) and only leads away from the tile,
+    found is what portals() returned"""
+    entrances = collections.defaultdict(list)
+    exits = collections.defaultdict(list)
+    gates = [[], []]
+    if found is None:
+        found = portals(map_data, grids)
+    for obj, template, tiles in found:
+        tiles = [(z, node) for z, node in tiles if grids[z].goal[node]]
+        if not tiles:
+            continue
+        if template["class"] == SUBTERRANEAN_GATE:
+            gates[obj["z"]].append((obj["x"], obj["y"], tiles[0]))
+            continue
+        number = template["number"]
+        if template["class"] in (MONOLITH_ENTRANCE, MONOLITH_TWO_WAY):
+            entrances[template["class"], number].append(tiles[0])
+        if template["class"] in (MONOLITH_EXIT, MONOLITH_TWO_WAY):
+            exits[template["class"], number].append(tiles[0])
+    links = []
+    for (obj_class, number), sources in entrances.iteritems():
+        if obj_class == MONOLITH_ENTRANCE:
+            targets = exits[MONOLITH_EXIT, number]
+        else:
+            targets = exits[MONOLITH_TWO_WAY, number]
+        links.extend((source, target + (EXIT, )) for source in sources
+                     for target in targets if source != target)
+    #a gate leads to the closest gate on the other level
+    for level, others in ((0, 1), (1, 0)):
+        for x, y, node in gates[level]:
+            if gates[others]:
+                closest = min(gates[others], key=lambda gate:
+                              (gate[0] - x) ** 2 + (gate[1] - y) ** 2)
+                links.append((node, closest[2] + (EXIT, )))
+    return links
+
+class PathCache(object):
+    """hierarchical path search over every level of a map
+
+    levels are cut into clusters, the open tiles on both sides of a cluster
+    border become transitions and the cheapest paths between the
+    transitions of a cluster are searched once, queries only search this
+    graph plus the clusters of start and goal and then refine the result
+    """
+    def __init__(self, map_data, passability=None, cluster_size=CLUSTER_SIZE):
+        if passability is None:
+            passability = Passability(map_data)
+        self.cluster_size = cluster_size
+        self.grids = [PathGrid(map_data, z, passability)
+                      for z in xrange(passability.levels)]
+        size = self.grids[0].size
+        self.clusters_x = (size + cluster_size - 1) // cluster_size
+        #cluster of every node, -1 on the border
+        self.areas = []
+        for grid in self.grids:
+            area = array("l", [-1]) * len(grid.passable)
+            for y in xrange(size):
+                for x in xrange(size):
+                    area[grid.node(x, y)] = self.cluster(x, y)
+            self.areas.append(area)
+        self.__portals = portals(map_data, self.grids)
+        #tiles whose changes can add or remove portal links
+        self.portal_tiles = set(tile for obj, template, tiles in
+                                self.__portals for tile in tiles)
+        self.map_data = map_data
+        self.updates = 0
+        self.update_time = 0.0
+        self.latencies = collections.deque(maxlen=LATENCIES)
+        self.queries = 0
+        self.rebuild()
+
+    def rebuild(self):
+        """build the cluster graph from scratch"""
+        start = time.time()
+        self.portals = set(portal_links(self.map_data, self.grids,
+                                        self.__portals))
+        #abstract node -> {abstract node: cost}
+        self.edges = collections.defaultdict(dict)
+        #(z, cluster) -> abstract nodes in it
+        self.cluster_nodes = collections.defaultdict(set)
+        #(z, cluster, cluster) -> transitions as (node, node) pairs
+        self.borders = {}
+        #abstract node -> number of transitions and portals using it
+        self.uses = collections.defaultdict(int)
+        #abstract node -> the clusters it was filed under
+        self.members = {}
+        for source, target in self.portals:
+            self.__use(source)
+            self.__use(target)
+            self.edges[source][target] = 0
+        for z in xrange(len(self.grids)):
+            for border in self.__borders(z):
+                self.__connect(border)
+        for key in list(self.cluster_nodes):
+            self.__link_cluster(key)
+        self.__refined = {}
+        self.build_time = time.time() - start
+
+    def cluster(self, x, y):
+        return (y // self.cluster_size) * self.clusters_x + \
+               x // self.cluster_size
+
+    def clusters_of(self, abstract):
+        """(z, cluster) of every cluster an abstract node is part of, tiles
+        that only end paths also belong to the clusters they are entered
+        from"""
+        z, node = abstract[:2]
+        area = self.areas[z]
+        grid = self.grids[z]
+        clusters = set([(z, area[node])])
+        if not grid.passable[node]:
+            clusters.update((z, area[neighbour]) for neighbour, through in
+                            grid.neighbours(node) if through)
+        return clusters
+
+    def __members(self, abstract):
+        if abstract in self.members:
+            return self.members[abstract]
+        return self.clusters_of(abstract)
+
+    def __use(self, abstract):
+        self.uses[abstract] += 1
+        if abstract not in self.members:
+            self.members[abstract] = self.clusters_of(abstract)
+            for key in self.members[abstract]:
+                self.cluster_nodes[key].add(abstract)
+
+    def __release(self, abstract):
+        self.uses[abstract] -= 1
+        if self.uses[abstract]:
+            return
+        del self.uses[abstract]
+        self.edges.pop(abstract, None)
+        for key in self.members.pop(abstract):
+            self.cluster_nodes[key].discard(abstract)
+            for other in self.cluster_nodes[key]:
+                self.edges[other].pop(abstract, None)
+
+    def __borders(self, z, clusters=None):
+        """(z, cluster, cluster) of every border, only those around clusters
+        if given"""
+        size = self.grids[z].size
+        clusters_y = (size + self.cluster_size - 1) // self.cluster_size
+        for cluster_y in xrange(clusters_y):
+            for cluster_x in xrange(self.clusters_x):
+                first = cluster_y * self.clusters_x + cluster_x
+                if cluster_x + 1 < self.clusters_x:
+                    if clusters is None or first in clusters or \
+                       first + 1 in clusters:
+                        yield z, first, first + 1
+                if cluster_y + 1 < clusters_y:
+                    if clusters is None or first in clusters or \
+                       first + self.clusters_x in clusters:
+                        yield z, first, first + self.clusters_x
+
+    def __connect(self, border):
+        """find the transitions across a border and add their edges"""
+        z, first, second = border
+        grid = self.grids[z]
+        size = grid.size
+        step = self.cluster_size
+        cluster_x = first % self.clusters_x
+        cluster_y = first // self.clusters_x
+        if second == first + 1:
+            x = (cluster_x + 1) * step - 1
+            pairs = [((x, y), (x + 1, y)) for y in
+                     xrange(cluster_y * step, min(size, (cluster_y + 1) * step))]
+        else:
+            y = (cluster_y + 1) * step - 1
+            pairs = [((x, y), (x, y + 1)) for x in
+                     xrange(cluster_x * step, min(size, (cluster_x + 1) * step))]
+        runs = []
+        run = []
+        for inside, outside in pairs:
+            inside = grid.node(*inside)
+            outside = grid.node(*outside)
+            if grid.passable[inside] and grid.passable[outside]:
+                run.append((inside, outside))
+            elif run:
+                runs.append(run)
+                run = []
+        if run:
+            runs.append(run)
+        transitions = []
+        for run in runs:
+            if len(run) < LONG_ENTRANCE:
+                transitions.append(run[len(run) // 2])
+            else:
+                transitions.extend((run[0], run[-1]))
+        for inside, outside in transitions:
+            inside = (z, inside)
+            outside = (z, outside)
+            self.__use(inside)
+            self.__use(outside)
+            self.edges[inside][outside] = grid.step_cost(inside[1], outside[1])
+            self.edges[outside][inside] = grid.step_cost(outside[1], inside[1])
+        self.borders[border] = transitions
+
+    def __disconnect(self, border):
+        z = border[0]
+        for inside, outside in self.borders.pop(border, ()):
+            self.edges[z, inside].pop((z, outside), None)
+            self.edges[z, outside].pop((z, inside), None)
+            self.__release((z, inside))
+            self.__release((z, outside))
+
+    def __link_cluster(self, key):
+        """search the cheapest paths between all abstract nodes of a
+        cluster"""
+        z, cluster = key
+        grid = self.grids[z]
+        nodes = self.cluster_nodes[key]
+        #walking onto a portal tile always goes through the portal and
+        #walking away from one starts at its exit
+        sources = [node for node in nodes
+                   if len(node) > 2 or grid.passable[node[1]]]
+        targets = [node for node in nodes if len(node) == 2]
+        for source in sources:
+            edges = self.edges[source]
+            for target in targets:
+                if target in edges:
+                    del edges[target]
+            settled = set(grid.search(source[1], -1, self.areas[z], cluster))
+            for target in targets:
+                if target[1] != source[1] and target[1] in settled:
+                    cost = grid.cost_to(target[1])
+                    if edges.get(target, cost + 1) > cost:
+                        edges[target] = cost
+
+    def update_tile(self, x, y, z, passable, goal=None):
+        """change a tile like PathGrid.set_tile() does and redo only the
+        borders, portals and clusters around it"""
+        start = time.time()
+        grid = self.grids[z]
+        grid.set_tile(x, y, passable, goal)
+        node = grid.node(x, y)
+        cluster = self.cluster(x, y)
+        borders = []
+        #transitions only change when the tile is on the edge of its cluster
+        if x % self.cluster_size in (0, self.cluster_size - 1) or \
+           y % self.cluster_size in (0, self.cluster_size - 1):
+            borders = list(self.__borders(z, set([cluster])))
+        touched = set([(z, cluster)])
+        for border in borders:
+            self.__disconnect(border)
+            touched.update((z, other) for other in border[1:])
+        for border in borders:
+            self.__connect(border)
+        if (z, node) in self.portal_tiles:
+            touched.update(self.__relink_portals())
+        #tiles that only end paths belong to the clusters they are entered
+        #from, which changes with the tiles around them
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                around = node + dy * grid.stride + dx
+                for abstract in ((z, around), (z, around, EXIT)):
+                    if abstract in self.members:
+                        touched.update(self.__refile(abstract))
+        for key in touched:
+            self.__link_cluster(key)
+        self.__refined = {}
+        self.updates += 1
+        self.update_time = time.time() - start
+
+    def __relink_portals(self):
+        """redo the portal links after a portal tile changed, returns the
+        clusters whose nodes changed"""
+        links = set(portal_links(self.map_data, self.grids, self.__portals))
+        touched = set()
+        for source, target in self.portals - links:
+            touched.update(self.members[source] | self.members[target])
+            self.edges[source].pop(target, None)
+            self.__release(source)
+            self.__release(target)
+        for source, target in links - self.portals:
+            self.__use(source)
+            self.__use(target)
+            self.edges[source][target] = 0
+            touched.update(self.members[source] | self.members[target])
+        self.portals = links
+        return touched
+
+    def __refile(self, abstract):
+        """file an abstract node under the clusters it is part of now,
+        returns the clusters to relink"""
+        old = self.members[abstract]
+        new = self.clusters_of(abstract)
+        if new == old:
+            return set()
+        for key in old - new:
+            self.cluster_nodes[key].discard(abstract)
+            #paths through a cluster the node left, portals stay
+            for other in self.cluster_nodes[key]:
+                if (abstract, other) not in self.portals:
+                    self.edges[abstract].pop(other, None)
+                if (other, abstract) not in self.portals:
+                    self.edges[other].pop(abstract, None)
+        for key in new - old:
+            self.cluster_nodes[key].add(abstract)
+        self.members[abstract] = new
+        return old | new
+
+    def __local(self, source, target, cluster):
+        """cost and nodes of the cheapest path within a cluster, None if
+        there is none"""
+        z, node = source[:2]
+        grid = self.grids[z]
+        if not grid.search(node, target[1], self.areas[z], cluster):
+            return None
+        return grid.cost_to(target[1]), grid.path_to(target[1])
+
+    def find_path(self, start, goal, refine=True):
+        """cheapest path from one (x, y, z) to another through the cluster
+        graph, a list of (x, y, z) and its cost or None
+
+        without refine only the cost and the abstract nodes are returned,
+        which is all a lot of AI decisions need
+        """
+        began = time.time()
+        try:
+            return self.__find_path(start, goal, refine)
+        finally:
+            self.queries += 1
+            self.latencies.append(time.time() - began)
+
+    def __find_path(self, start, goal, refine):
+        start = (start[2], self.grids[start[2]].node(start[0], start[1]))
+        goal = (goal[2], self.grids[goal[2]].node(goal[0], goal[1]))
+        if not self.grids[start[0]].goal[start[1]] or \
+           not self.grids[goal[0]].goal[goal[1]]:
+            return None
+        if start == goal:
+            return ([self.__tile(start)] if refine else [start]), 0
+        #a hero leaves its tile like a portal exit unless it is a transition
+        if start not in self.uses or not self.grids[start[0]].passable[start[1]]:
+            start += (EXIT, )
+        extra = collections.defaultdict(dict)
+        #hook start and goal into the abstract graph for this query only
+        if start not in self.uses:
+            z, node = start[:2]
+            grid = self.grids[z]
+            for key in self.clusters_of(start):
+                settled = set(grid.search(node, -1, self.areas[z], key[1]))
+                for target in list(self.cluster_nodes[key]) + [goal]:
+                    if len(target) == 2 and target[0] == z and \
+                       target[1] in settled and target[1] != node:
+                        cost = grid.cost_to(target[1])
+                        if extra[start].get(target, cost + 1) > cost:
+                            extra[start][target] = cost
+        if goal not in self.uses:
+            z, node = goal
+            grid = self.grids[z]
+            for key in self.clusters_of(goal):
+                settled = set(grid.search_back(node, self.areas[z], key[1]))
+                for source in self.cluster_nodes[key]:
+                    if len(source) == 2 and not grid.passable[source[1]]:
+                        continue
+                    if source[1] in settled:
+                        cost = grid.cost_to(source[1])
+                        if extra[source].get(goal, cost + 1) > cost:
+                            extra[source][goal] = cost
+        edges = self.edges
+        #portals make distances on the map useless as a lower bound
+        if self.portals:
+            heuristic = lambda node: 0
+        else:
+            grid = self.grids[goal[0]]
+            goal_x, goal_y = grid.tile(goal[1])
+            #every diagonal step is rounded down on its own
+            min_diagonal = grid.min_cost * DIAGONAL // 100
+            def heuristic(node):
+                x, y = grid.tile(node[1])
+                dx = abs(x - goal_x)
+                dy = abs(y - goal_y)
+                if dx < dy:
+                    dx, dy = dy, dx
+                return grid.min_cost * (dx - dy) + min_diagonal * dy
+        g = {start: 0}
+        parent = {start: None}
+        heap = [(0, start)]
+        done = set()
+        while heap:
+            f, node = heapq.heappop(heap)
+            if node in done:
+                continue
+            done.add(node)
+            if node == goal:
+                break
+            cost = g[node]
+            for neighbours in (edges.get(node, ()), extra.get(node, ())):
+                for neighbour in neighbours:
+                    new_g = cost + neighbours[neighbour]
+                    if new_g < g.get(neighbour, new_g + 1):
+                        g[neighbour] = new_g
+                        parent[neighbour] = node
+                        heapq.heappush(heap,
+                                       (new_g + heuristic(neighbour), neighbour))
+        else:
+            return None
+        route = []
+        node = goal
+        while node is not None:
+            route.append(node)
+            node = parent[node]
+        route.reverse()
+        if not refine:
+            return route, g[goal]
+        path = self.refine(route)
+        if path is None:
+            return None
+        return path, g[goal]
+
+    def refine(self, route):
+        """tiles of an abstract route as (x, y, z), None if a step has no
+        path within its clusters"""
+        path = [self.__tile(route[0])]
+        for source, target in zip(route, route[1:]):
+            clusters = self.__members(source) & self.__members(target)
+            #portals and steps across a border
+            if (source, target) in self.portals or not clusters:
+                path.append(self.__tile(target))
+                continue
+            key = (source, target)
+            nodes = self.__refined.get(key)
+            if nodes is None:
+                found = [local for local in
+                         (self.__local(source, target, cluster)
+                          for z, cluster in clusters) if local]
+                if not found:
+                    return None
+                nodes = min(found)[1][1:]
+                #start and goal of a single query are not worth keeping
+                if source in self.uses and target in self.uses:
+                    self.__refined[key] = nodes
+            grid = self.grids[target[0]]
+            path.extend(grid.tile(node) + (target[0], ) for node in nodes)
+        return path
+
+    def __tile(self, abstract):
+        return self.grids[abstract[0]].tile(abstract[1]) + (abstract[0], )
+
+    def metrics(self):
+        """size of the cluster graph, build and update time and the query
+        latencies, times in milliseconds"""
+        latencies = sorted(self.latencies)
+        metrics = {
+            "nodes": len(self.uses),
+            "edges": sum(len(edges) for edges in self.edges.itervalues()),
+            "portals": len(self.portals),
+            "build_ms": self.build_time * 1000,
+            "updates": self.updates,
+            "last_update_ms": self.update_time * 1000,
+            "queries": self.queries,
+        }
+        if latencies:
+            metrics["query_median_ms"] = latencies[len(latencies) // 2] * 1000
+            metrics["query_p90_ms"] = \
+                latencies[len(latencies) * 9 // 10] * 1000
+            metrics["query_max_ms"] = latencies[-1] * 1000
+        return metrics
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import heapq
+from array import array
+from lib.passability import Passability
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#movement points spent leaving a tile of a terrain type, 0 is impassable
+TERRAIN_COSTS = {
+    0: 100, #dirt
+    1: 150, #sand
+    2: 100, #grass
+    3: 150, #snow
+    4: 175, #swamp
+    5: 125, #rough
+    6: 100, #subterranean
+    7: 100, #lava
+    8: 0, #water, boats are not handled
+    9: 0, #rock
+}
+#road types, a road only counts when both tiles of a step have one
+ROAD_COSTS = {1: 75, 2: 65, 3: 50}
+#a diagonal step costs 141/100 of a straight one
+DIAGONAL = 141
+#landmarks searched by PathGrid.add_landmarks() and how many of them the
+#heuristic of a single search looks at
+LANDMARKS = 12
+ACTIVE_LANDMARKS = 4
+#cost from a landmark to a tile it does not reach, the cost to a landmark
+#from such a tile is -1
+UNREACHED = 1 << 30
+
+class PathGrid(object):
+    """movement costs of one map level as flat arrays
+
+    the arrays have a border of impassable tiles so the search never has to
+    check the map bounds, tile x, y is at (y + 1) * stride + x + 1
+    """
+    def __init__(self, map_data, z=0, passability=None):
+        self.size = size = map_data["map_size"]
+        self.stride = stride = size + 2
+        self.z = z
+        if passability is None:
+            passability = Passability(map_data)
+        blocked = passability.flat(passability.blocked, z)
+        visitable = passability.flat(passability.visitable, z)
+        terrain = map_data["lower_terrain" if z else "upper_terrain"]
+        if numpy is not None and isinstance(terrain, numpy.ndarray):
+            terrain = terrain.tolist()
+        self.cost = array("H", [0]) * (stride * stride)
+        self.road = array("H", [0]) * (stride * stride)
+        #tiles a path may lead through, visitable tiles can only end one
+        self.passable = bytearray(stride * stride)
+        self.goal = bytearray(stride * stride)
+        for y, line in enumerate(terrain):
+            for x, tile in enumerate(line):
+                node = (y + 1) * stride + x + 1
+                cost = TERRAIN_COSTS.get(tile[0], 0)
+                self.cost[node] = cost
+                self.road[node] = ROAD_COSTS.get(tile[4], 0)
+                if not cost or blocked[y * size + x]:
+                    if visitable[y * size + x]:
+                        self.goal[node] = 1
+                    continue
+                self.goal[node] = 1
+                if not visitable[y * size + x]:
+                    self.passable[node] = 1
+        #the heuristic may never be above the real cost
+        self.min_cost = min([cost for cost in self.cost if cost] +
+                            [cost for cost in self.road if cost] or [100])
+        self.__neighbours = [(dx + dy * stride, dx and dy and dx, dy * stride)
+                             for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                             if dx or dy]
+        self.__components = None
+        self.__column = array("l", range(stride)) * stride
+        self.__row = array("l", [row for row in xrange(stride)
+                                 for column in xrange(stride)])
+        #scores of the last search, valid where stamp is the current search
+        self.__g = array("l", [0]) * (stride * stride)
+        self.__parent = array("l", [0]) * (stride * stride)
+        self.__stamp = array("l", [0]) * (stride * stride)
+        self.__search = 0
+        self.__backwards = False
+        self.expanded = 0
+        #(cost from, cost to) arrays of every landmark
+        self.landmarks = []
+
+    def node(self, x, y):
+        return (y + 1) * self.stride + x + 1
+
+    def tile(self, node):
+        y, x = divmod(node, self.stride)
+        return x - 1, y - 1
+
+    def step_cost(self, node, neighbour):
+        """points spent from node to an adjacent tile"""
+        if self.road[node] and self.road[neighbour]:
+            cost = self.road[node]
+        else:
+            cost = self.cost[node]
+        if abs(neighbour - node) not in (1, self.stride):
+            return cost * DIAGONAL // 100
+        return cost
+
+    def neighbours(self, node):
+        """tiles a path can step to from node and whether it may go on from
+        there, diagonal steps may not squeeze between two blocked tiles"""
+        passable = self.passable
+        goal = self.goal
+        for offset, side_x, side_y in self.__neighbours:
+            neighbour = node + offset
+            if not goal[neighbour]:
+                continue
+            if side_x and not passable[node + side_x] and \
+               not passable[node + side_y]:
+                continue
+            yield neighbour, passable[neighbour]
+
+    def components(self):
+        """component number of every passable tile, 0 elsewhere, paths only
+        exist within a component"""
+        if self.__components is not None:
+            return self.__components
+        labels = array("l", [0]) * len(self.passable)
+        label = 0
+        for start, passable in enumerate(self.passable):
+            if not passable or labels[start]:
+                continue
+            label += 1
+            labels[start] = label
+            todo = [start]
+            while todo:
+                node = todo.pop()
+                for neighbour, through in self.neighbours(node):
+                    if through and not labels[neighbour]:
+                        labels[neighbour] = label
+                        todo.append(neighbour)
+        self.__components = labels
+        return labels
+
+    def reachable(self, start, goal):
+        """cheap test whether find_path can succeed, start and goal are
+        nodes"""
+        if not self.goal[start] or not self.goal[goal]:
+            return False
+        if start == goal or any(neighbour == goal for neighbour, through in
+                                self.neighbours(start)):
+            return True
+        return bool(self.__labels(start) & self.__labels(goal))
+
+    def __labels(self, node):
+        #the components a tile is part of or can be stepped onto from
+        labels = self.components()
+        if self.passable[node]:
+            return set([labels[node]])
+        return set(labels[neighbour]
+                   for neighbour, through in self.neighbours(node) if through)
+
+    def set_tile(self, x, y, passable, goal=None):
+        """change whether paths may lead through a tile and end on it, goal
+        defaults to passable"""
+        node = self.node(x, y)
+        if not self.cost[node]:
+            passable = False
+        goal = passable if goal is None else goal
+        #a tile that is opened can make paths cheaper than the landmarks
+        #know, closing one only makes their bounds less tight
+        if passable and not self.passable[node] or \
+           goal and not self.goal[node]:
+            self.landmarks = []
+        self.passable[node] = bool(passable)
+        self.goal[node] = bool(goal)
+        self.__components = None
+
+    def add_landmarks(self, count=LANDMARKS):
+        """search the costs from and to count tiles spread over the largest
+        component, search() then uses them for a tighter heuristic until
+        set_tile() opens a tile"""
+        labels = self.components()
+        sizes = {}
+        for label in labels:
+            sizes[label] = sizes.get(label, 0) + 1
+        sizes.pop(0, None)
+        if not sizes:
+            return
+        largest = max(sizes, key=sizes.get)
+        size = len(self.passable)
+        #each landmark is the tile farthest from all the others
+        nearest = array("l", [UNREACHED]) * size
+        landmark = labels.index(largest)
+        landmarks = []
+        for i in xrange(count):
+            settled = self.search(landmark)
+            costs = array("l", [UNREACHED]) * size
+            for node in settled:
+                costs[node] = self.__g[node]
+            settled = self.search_back(landmark)
+            back = array("l", [-1]) * size
+            for node in settled:
+                back[node] = self.__g[node]
+            landmarks.append((costs, back))
+            farthest = landmark
+            for node, label in enumerate(labels):
+                if label == largest:
+                    if costs[node] < nearest[node]:
+                        nearest[node] = costs[node]
+                    if nearest[node] > nearest[farthest]:
+                        farthest = node
+            if nearest[farthest] == 0:
+                break
+            landmark = farthest
+        self.landmarks = landmarks
+
+    def find_path(self, start, goal):
+        """cheapest path between two tiles as a list of (x, y) from start to
+        goal and its cost, None if there is none"""
+        start = self.node(*start)
+        goal = self.node(*goal)
+        if not self.reachable(start, goal):
+            return None
+        if start == goal:
+            return [self.tile(start)], 0
+        if not self.search(start, goal):
+            return None
+        return [self.tile(node) for node in self.path_to(goal)], \
+               self.cost_to(goal)
+
+    def search(self, start, goal=-1, area=None, area_id=0, limit=None):
+        """A* from start to goal or Dijkstra from start to everything when
+        goal is -1, returns the nodes reached in the order they were settled
+
+        with area only nodes where area[node] == area_id are searched, tiles
+        that only end paths are settled but never left, also just outside
+        the area, nothing that costs more than limit is settled, path_to()
+        and cost_to() tell about the settled nodes until the next search
+        """
+        self.__search += 1
+        self.__backwards = False
+        search = self.__search
+        g = self.__g
+        parent = self.__parent
+        stamp = self.__stamp
+        cost = self.cost
+        road = self.road
+        passable = self.passable
+        goal_tiles = self.goal
+        neighbours = self.__neighbours
+        column = self.__column
+        row = self.__row
+        min_cost = self.min_cost
+        #every diagonal step is rounded down on its own
+        min_diagonal = min_cost * DIAGONAL // 100
+        if goal >= 0:
+            goal_x = column[goal]
+            goal_y = row[goal]
+            ahead, behind = self.__active_landmarks(start, goal)
+        g[start] = 0
+        parent[start] = -1
+        stamp[start] = search
+        #f, -g so the deeper of two equal nodes goes first, node
+        heap = [(0, 0, start)]
+        settled = []
+        while heap:
+            f, depth, node = heapq.heappop(heap)
+            if -depth != g[node] or stamp[node] != search:
+                continue
+            #a settled node is marked by a negative stamp
+            stamp[node] = -search
+            settled.append(node)
+            if node == goal:
+                break
+            if node != start and not passable[node]:
+                continue
+            node_g = g[node]
+            node_cost = cost[node]
+            node_road = road[node]
+            for offset, side_x, side_y in neighbours:
+                neighbour = node + offset
+                if not goal_tiles[neighbour]:
+                    continue
+                if area is not None and area[neighbour] != area_id and \
+                   passable[neighbour]:
+                    continue
+                if side_x:
+                    if not passable[node + side_x] and \
+                       not passable[node + side_y]:
+                        continue
+                    if node_road and road[neighbour]:
+                        step = node_road * DIAGONAL // 100
+                    else:
+                        step = node_cost * DIAGONAL // 100
+                elif node_road and road[neighbour]:
+                    step = node_road
+                else:
+                    step = node_cost
+                new_g = node_g + step
+                if stamp[neighbour] == -search or \
+                   (stamp[neighbour] == search and g[neighbour] <= new_g):
+                    continue
+                if limit is not None and new_g > limit:
+                    continue
+                stamp[neighbour] = search
+                g[neighbour] = new_g
+                parent[neighbour] = node
+                if goal >= 0:
+                    dx = abs(column[neighbour] - goal_x)
+                    dy = abs(row[neighbour] - goal_y)
+                    if dx < dy:
+                        dx, dy = dy, dx
+                    h = min_cost * (dx - dy) + min_diagonal * dy
+                    for costs, goal_cost in ahead:
+                        if goal_cost - costs[neighbour] > h:
+                            h = goal_cost - costs[neighbour]
+                    for back, goal_cost in behind:
+                        if back[neighbour] - goal_cost > h:
+                            h = back[neighbour] - goal_cost
+                else:
+                    h = 0
+                heapq.heappush(heap, (new_g + h, -new_g, neighbour))
+        self.expanded = len(settled)
+        if goal >= 0 and (not settled or settled[-1] != goal):
+            return []
+        return settled
+
+    def __active_landmarks(self, start, goal):
+        """(costs, cost of goal) of the landmarks that bound the cost from
+        start to goal best, those in front of goal and those behind it"""
+        #cost(node, goal) >= cost(landmark, goal) - cost(landmark, node) and
+        #cost(node, goal) >= cost(node, landmark) - cost(goal, landmark), the
+        #latter only if paths may lead on through goal
+        bounds = []
+        through = self.passable[goal]
+        for number, (costs, back) in enumerate(self.landmarks):
+            if costs[goal] != UNREACHED:
+                bounds.append((costs[goal] - costs[start], number, False))
+            if through and back[goal] >= 0:
+                bounds.append((back[start] - back[goal], number, True))
+        bounds.sort(reverse=True)
+        ahead = []
+        behind = []
+        for bound, number, backwards in bounds[:ACTIVE_LANDMARKS]:
+            if bound <= 0:
+                break
+            costs, back = self.landmarks[number]
+            if backwards:
+                behind.append((back, back[goal]))
+            else:
+                ahead.append((costs, costs[goal]))
+        return ahead, behind
+
+    def search_back(self, goal, area=None, area_id=0):
+        """Dijkstra from goal against the direction of travel, cost_to() then
+        is the cost of the cheapest path from a settled node to goal
+
+        the nodes are settled by the same rules as search() uses, except
+        that tiles which only end paths are never left, not even goal
+        """
+        self.__search += 1
+        self.__backwards = True
+        search = self.__search
+        g = self.__g
+        parent = self.__parent
+        stamp = self.__stamp
+        cost = self.cost
+        road = self.road
+        passable = self.passable
+        goal_tiles = self.goal
+        neighbours = self.__neighbours
+        g[goal] = 0
+        parent[goal] = -1
+        stamp[goal] = search
+        heap = [(0, goal)]
+        settled = []
+        while heap:
+            node_g, node = heapq.heappop(heap)
+            if node_g != g[node] or stamp[node] != search:
+                continue
+            stamp[node] = -search
+            settled.append(node)
+            #paths can only lead through passable tiles
+            if node != goal and not passable[node]:
+                continue
+            node_road = road[node]
+            for offset, side_x, side_y in neighbours:
+                neighbour = node - offset
+                if not goal_tiles[neighbour]:
+                    continue
+                if area is not None and area[neighbour] != area_id and \
+                   passable[neighbour]:
+                    continue
+                if side_x:
+                    #the tiles beside the diagonal are the same both ways
+                    if not passable[neighbour + side_x] and \
+                       not passable[neighbour + side_y]:
+                        continue
+                    if node_road and road[neighbour]:
+                        step = road[neighbour] * DIAGONAL // 100
+                    else:
+                        step = cost[neighbour] * DIAGONAL // 100
+                elif node_road and road[neighbour]:
+                    step = road[neighbour]
+                else:
+                    step = cost[neighbour]
+                new_g = node_g + step
+                if stamp[neighbour] == -search or \
+                   (stamp[neighbour] == search and g[neighbour] <= new_g):
+                    continue
+                stamp[neighbour] = search
+                g[neighbour] = new_g
+                parent[neighbour] = node
+                heapq.heappush(heap, (new_g, neighbour))
+        self.expanded = len(settled)
+        return settled
+
+    def cost_to(self, node):
+        """cost of the cheapest path to a node the last search settled"""
+        assert self.__stamp[node] == -self.__search
+        return self.__g[node]
+
+    def parent_of(self, node):
+        """the node before a settled node on its path, -1 for the start"""
+        assert self.__stamp[node] == -self.__search
+        return self.__parent[node]
+
+    def path_to(self, node):
+        """nodes from the start of the last search to a node it settled, from
+        a node to the goal after search_back()"""
+        assert self.__stamp[node] == -self.__search
+        path = []
+        while node != -1:
+            path.append(node)
+            node = self.__parent[node]
+        if not self.__backwards:
+            path.reverse()
+        return path
+
+class Pathfinder(object):
+    """a PathGrid for every level of a map, with landmarks if their count is
+    given, see PathGrid.add_landmarks()"""
+    def __init__(self, map_data, passability=None, landmarks=0):
+        if passability is None:
+            passability = Passability(map_data)
+        self.grids = [PathGrid(map_data, z, passability)
+                      for z in xrange(passability.levels)]
+        if landmarks:
+            for grid in self.grids:
+                grid.add_landmarks(landmarks)
+
+    def find_path(self, start, goal, z=0):
+        return self.grids[z].find_path(start, goal)
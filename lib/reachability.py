@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import multiprocessing
+from array import array
+from lib.passability import mask_offsets
+
+#hero, random hero and prison
+HERO_CLASSES = (34, 70, 62)
+#from this many starts on the fields are searched in a process pool
+POOL_STARTS = 8
+
+def heroes(map_data):
+    """(tuned object, (x, y, z)) of every hero on the map, the tile is the
+    one the hero stands on"""
+    found = []
+    for obj in map_data["tunedobj"]:
+        template = map_data["objects"][obj["id"]]
+        if template["class"] not in HERO_CLASSES:
+            continue
+        offsets = mask_offsets(template["actions"], 1) or [(0, 0)]
+        dx, dy = offsets[-1]
+        found.append((obj, (obj["x"] + dx, obj["y"] + dy, obj["z"])))
+    return found
+
+def search_field(grid, node, limit):
+    """settled nodes, their costs and predecessors of one Dijkstra"""
+    settled = grid.search(node, -1, limit=limit)
+    return (array("l", settled),
+            array("l", [grid.cost_to(settled_node) for settled_node in settled]),
+            array("l", [grid.parent_of(settled_node)
+                        for settled_node in settled]))
+
+#the grids of a pool worker, set once when the worker starts
+_grids = None
+
+def _start_worker(grids):
+    global _grids
+    _grids = grids
+
+def _search_job(job):
+    z, node, limit = job
+    return search_field(_grids[z], node, limit)
+
+class DistanceFields(object):
+    """distance and predecessor arrays of many starts in one call
+
+    the arrays are flat and indexed like the nodes of the PathGrid of the
+    start's level, -1 marks what is out of reach, the arrays of every start
+    are kept and reused by the next call, so copy what has to outlive it
+
+    the pool works on the grids as they were when it started, close() it
+    after changing them
+    """
+    def __init__(self, grids, processes=None, pool_starts=POOL_STARTS):
+        self.grids = grids
+        self.processes = processes
+        self.pool_starts = pool_starts
+        self.pool = None
+        self.distances = []
+        self.predecessors = []
+        self.__settled = []
+        self.__starts = []
+
+    def compute(self, starts, limits=None):
+        """a (distance, predecessor) pair for every (x, y, z) in starts
+
+        limits is the most movement points spent from a start, one for all
+        or a list, None searches everything that can be reached
+        """
+        if limits is None or isinstance(limits, (int, long)):
+            limits = [limits] * len(starts)
+        jobs = [(z, self.grids[z].node(x, y), limit)
+                for (x, y, z), limit in zip(starts, limits)]
+        if self.processes != 0 and len(jobs) >= self.pool_starts:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes,
+                                                 _start_worker, (self.grids, ))
+            results = self.pool.map(_search_job, jobs)
+        else:
+            results = [search_field(self.grids[z], node, limit)
+                       for z, node, limit in jobs]
+        self.__starts = [job[:2] for job in jobs]
+        for slot, (nodes, costs, parents) in enumerate(results):
+            distance, predecessor = self.__slot(slot)
+            for node, cost, parent in itertools.izip(nodes, costs, parents):
+                distance[node] = cost
+                predecessor[node] = parent
+            self.__settled[slot] = nodes
+        return zip(self.distances, self.predecessors)[:len(jobs)]
+
+    def __slot(self, slot):
+        """the arrays of a start, cleared where the last call filled them"""
+        if slot == len(self.distances):
+            size = len(self.grids[0].passable)
+            self.distances.append(array("l", [-1]) * size)
+            self.predecessors.append(array("l", [-1]) * size)
+            self.__settled.append(())
+        distance = self.distances[slot]
+        predecessor = self.predecessors[slot]
+        for node in self.__settled[slot]:
+            distance[node] = -1
+            predecessor[node] = -1
+        return distance, predecessor
+
+    def reached(self, slot):
+        """(x, y, cost) of every tile the start of a slot reaches"""
+        z = self.__starts[slot][0]
+        grid = self.grids[z]
+        distance = self.distances[slot]
+        return [grid.tile(node) + (distance[node], )
+                for node in self.__settled[slot]]
+
+    def path(self, slot, x, y):
+        """tiles from the start of a slot to x, y, None if out of reach"""
+        grid = self.grids[self.__starts[slot][0]]
+        node = grid.node(x, y)
+        predecessor = self.predecessors[slot]
+        if self.distances[slot][node] < 0:
+            return None
+        path = []
+        while node != -1:
+            path.append(grid.tile(node))
+            node = predecessor[node]
+        path.reverse()
+        return path
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
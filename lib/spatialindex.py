@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+#edge length in tiles of the square chunks objects are filed under
+CHUNK_SIZE = 8
+
+class ChunkIndex(object):
+    """items with a tile bounding box, filed under every chunk the box
+    overlaps so a query only looks at the chunks of the queried rectangle
+
+    boxes are inclusive tile coordinates (x1, y1, x2, y2), queries return
+    the items sorted by the order they were inserted with
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        self.entries = {}
+        self.__sequence = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __chunks(self, x1, y1, x2, y2):
+        size = self.chunk_size
+        for chunk_y in xrange(y1 // size, y2 // size + 1):
+            for chunk_x in xrange(x1 // size, x2 // size + 1):
+                yield chunk_x, chunk_y
+
+    def insert(self, item, x1, y1, x2, y2, order=None):
+        """file item under its box, order defaults to the insertion order,
+        returns the handle remove() takes"""
+        if order is None:
+            order = self.__sequence
+        handle = self.__sequence
+        self.__sequence += 1
+        entry = (order, handle, x1, y1, x2, y2, item)
+        self.entries[handle] = entry
+        for chunk in self.__chunks(x1, y1, x2, y2):
+            self.chunks.setdefault(chunk, []).append(entry)
+        return handle
+
+    def remove(self, handle):
+        entry = self.entries.pop(handle)
+        for chunk in self.__chunks(*entry[2:6]):
+            self.chunks[chunk].remove(entry)
+            if not self.chunks[chunk]:
+                del self.chunks[chunk]
+
+    def box(self, handle):
+        return self.entries[handle][2:6]
+
+    def query_entries(self, x1, y1, x2, y2):
+        """(order, handle, x1, y1, x2, y2, item) of every item whose box
+        overlaps the rectangle, sorted by order"""
+        found = {}
+        chunks = self.chunks
+        for chunk in self.__chunks(x1, y1, x2, y2):
+            for entry in chunks.get(chunk, ()):
+                if entry[2] <= x2 and entry[4] >= x1 and \
+                   entry[3] <= y2 and entry[5] >= y1:
+                    found[entry[1]] = entry
+        return sorted(found.itervalues())
+
+    def query(self, x1, y1, x2, y2):
+        return [entry[6] for entry in self.query_entries(x1, y1, x2, y2)]
+
+    def at(self, x, y):
+        """items covering a single tile, the topmost last"""
+        return self.query(x, y, x, y)
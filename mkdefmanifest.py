@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+    homm3defmanifest
+
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    usage: mkdefmanifest.py [data]
+
+    writes data/frames.txt with the frame count and first frame height of
+    every extracted def, rerun it whenever the data changes
+"""
+
+import os
+import sys
+from lib import defmanifest
+
+def main(args):
+    root = os.path.abspath(args[1] if len(args) > 1 else "data")
+    defs = defmanifest.write(root)
+    print "%d defs with %d frames" % (len(defs), sum(defs.itervalues()))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
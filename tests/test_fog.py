@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import random
+import unittest
+from lib.fog import FogOfWar, reveal_mask
+
+def circle(x, y, radius, size):
+    """the tiles reveal() should explore, worked out tile by tile"""
+    return set((x + dx, y + dy) for dy in xrange(-radius, radius + 1)
+               for dx in xrange(-radius, radius + 1)
+               if dx * dx + dy * dy <= radius * (radius + 1) and
+               0 <= x + dx < size and 0 <= y + dy < size)
+
+class BitsTest(unittest.TestCase):
+    def test_layout(self):
+        fog = FogOfWar(20, 1, players=1)
+        self.assertEqual(fog.stride, 3)
+        fog.reveal(0, 0, 0, 0, 0)
+        fog.reveal(0, 9, 1, 0, 0)
+        fog.reveal(0, 19, 2, 0, 0)
+        #the leftmost tile of a byte is its highest bit
+        self.assertEqual(fog.bits[0][0][:3], bytearray("\x80\x00\x00"))
+        self.assertEqual(fog.bits[0][0][3:6], bytearray("\x00\x40\x00"))
+        self.assertEqual(fog.bits[0][0][6:9], bytearray("\x00\x00\x10"))
+
+    def test_mask(self):
+        self.assertEqual(reveal_mask(0), (0, ))
+        self.assertEqual(reveal_mask(2), (1, 2, 2, 2, 1))
+
+    def test_reveal(self):
+        size = 37
+        fog = FogOfWar(size, 2, players=2)
+        rng = random.Random(0)
+        explored = set()
+        for i in xrange(60):
+            x, y = rng.randrange(-3, size + 3), rng.randrange(-3, size + 3)
+            radius = rng.randrange(8)
+            new = circle(x, y, radius, size) - explored
+            box = fog.reveal(1, x, y, 1, radius)
+            if new:
+                xs = [tile[0] for tile in new]
+                ys = [tile[1] for tile in new]
+                #the box holds every new tile, whole rows of the circle
+                self.assertTrue(box[0] <= min(xs) and box[1] <= min(ys) and
+                                box[2] >= max(xs) and box[3] >= max(ys))
+            else:
+                self.assertEqual(box, None)
+            explored |= new
+        for y in xrange(size):
+            for x in xrange(size):
+                self.assertEqual(fog.is_explored(1, x, y, 1),
+                                 (x, y) in explored, (x, y))
+        #other players and levels stay unexplored
+        self.assertFalse(any(fog.bits[0][1]) or any(fog.bits[1][0]))
+
+    def test_rows(self):
+        size = 37
+        fog = FogOfWar(size, 1, players=1)
+        fog.reveal(0, 10, 12, 0, 6)
+        fog.reveal(0, 30, 30, 0, 3)
+        for x1, y1, x2, y2 in ((0, 0, size - 1, size - 1), (3, 5, 17, 9),
+                               (9, 12, 9, 12), (29, 27, 36, 36)):
+            expected = "".join("s" if fog.is_explored(0, x, y, 0) else "u"
+                               for y in xrange(y1, y2 + 1)
+                               for x in xrange(x1, x2 + 1))
+            self.assertEqual(fog.rows(0, 0, x1, y1, x2, y2, "s", "u"),
+                             expected)
+
+    def test_dirty(self):
+        fog = FogOfWar(16, 1, players=1)
+        self.assertEqual(fog.take_dirty(0, 0), (0, 0, 15, 15))
+        self.assertEqual(fog.take_dirty(0, 0), None)
+        fog.reveal(0, 4, 4, 0, 1)
+        fog.reveal(0, 10, 8, 0, 1)
+        self.assertEqual(fog.take_dirty(0, 0), (3, 3, 11, 9))
+        fog.reveal(0, 4, 4, 0, 1)
+        self.assertEqual(fog.take_dirty(0, 0), None)
+
+if __name__ == '__main__':
+    unittest.main()
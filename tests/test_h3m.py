@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from lib import h3m, h3mwriter, mapgen
+from lib.mapcache import MapCache
+
+#restoration of erathia, which the parser does not read
+ROE = 0x0E
+
+class VersionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "roe.h3m")
+        encoded = h3mwriter.encode(mapgen.generate(36, object_density=0))
+        with open(self.filename, "wb") as h3m_file:
+            h3m_file.write(struct.pack("<I", ROE) + encoded[4:])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_readers(self):
+        with open(self.filename, "rb") as h3m_file:
+            raw = h3m_file.read()
+        self.assertRaises(ValueError, h3m.extract, self.filename)
+        self.assertRaises(ValueError, h3m.extract, self.filename,
+                          buffered=False)
+        self.assertRaises(ValueError, h3m.decode, h3m.BufferReader(raw))
+        self.assertRaises(ValueError, h3m.read_summary, h3m.BufferReader(raw))
+        self.assertRaises(ValueError, h3m.scan_header, self.filename)
+        self.assertRaises(ValueError, list, h3m.iter_tunedobj(self.filename))
+        self.assertRaises(ValueError, h3m.LazyMap, self.filename)
+        cache = MapCache(os.path.join(self.directory, "cache"))
+        self.assertRaises(ValueError, cache.extract, self.filename)
+        self.assertEqual(cache.entries(), [])
+
+    def test_writer(self):
+        map_data = mapgen.generate(36, object_density=0)
+        map_data["version"] = ROE
+        self.assertRaises(ValueError, h3mwriter.encode, map_data)
+
+if __name__ == '__main__':
+    unittest.main()
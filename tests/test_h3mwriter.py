@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from lib import h3m, h3mwriter, mapgen
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.map_data = mapgen.generate(36, seed=3, underworld=True,
+                                        object_density=0.2)
+
+    def test_encode(self):
+        encoded = h3mwriter.encode(self.map_data)
+        decoded = h3m.decode(h3m.BufferReader(encoded))
+        self.assertEqual(decoded, self.map_data)
+        #byte for byte once the map went through the parser
+        self.assertEqual(h3mwriter.encode(decoded), encoded)
+
+    def test_save(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for compress in (True, False):
+                filename = os.path.join(directory, "%d.h3m" % compress)
+                h3mwriter.save(filename, self.map_data, compress)
+                with open(filename, "rb") as h3m_file:
+                    self.assertEqual(h3m_file.read(2) == h3m.GZIP_MAGIC,
+                                     compress)
+                self.assertEqual(h3m.extract(filename), self.map_data)
+                self.assertEqual(h3m.extract(filename, buffered=False),
+                                 self.map_data)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_too_large(self):
+        map_data = mapgen.generate(h3mwriter.MAX_SIZE + 1, object_density=0)
+        self.assertRaises(ValueError, h3mwriter.encode, map_data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from lib import h3m, h3mwriter, mapgen
+from lib.mapcache import CACHE_HEADER, STALE_TEMP, MapCache
+
+class CorruptTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "generated.h3m")
+        h3mwriter.save(self.filename, mapgen.generate(36, seed=0))
+        self.cache = MapCache(os.path.join(self.directory, "cache"))
+        self.expected = self.cache.extract(self.filename)
+        (mtime, size, self.path), = self.cache.entries()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def corrupt(self, offset, data=None):
+        """overwrite the cache file from offset on, cut it there if no data
+        is given"""
+        with open(self.path, "r+b") as cache_file:
+            cache_file.seek(offset)
+            if data is None:
+                cache_file.truncate()
+            else:
+                cache_file.write(data)
+
+    def assertParsedAgain(self, arrays=False):
+        map_data = self.cache.extract(self.filename, arrays)
+        if arrays:
+            map_data["upper_terrain"] = [[tuple(tile) for tile in row] for row
+                                         in map_data["upper_terrain"].tolist()]
+        self.assertEqual(map_data, self.expected)
+        self.assertEqual(self.cache.misses, 2)
+        #the next extract reads the rewritten file
+        self.assertEqual(self.cache.extract(self.filename), self.expected)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_garbage_pickle(self):
+        self.corrupt(CACHE_HEADER.size, "\xff" * 64)
+        self.assertParsedAgain()
+
+    def test_truncated_pickle(self):
+        self.corrupt(CACHE_HEADER.size + 16)
+        self.assertParsedAgain()
+
+    def test_truncated_terrain(self):
+        self.corrupt(os.path.getsize(self.path) - 7)
+        self.assertParsedAgain()
+
+    @unittest.skipIf(h3m.numpy is None, "needs numpy")
+    def test_truncated_memmap(self):
+        self.corrupt(os.path.getsize(self.path) - 7)
+        self.assertParsedAgain(arrays=True)
+
+    def test_random_bytes(self):
+        rand = random.Random(0)
+        for i in xrange(100):
+            size = os.path.getsize(self.path)
+            self.corrupt(rand.randrange(size), chr(rand.randrange(256)) *
+                         rand.randint(1, 4))
+            self.assertEqual(self.cache.extract(self.filename), self.expected)
+        self.assertEqual(self.cache.hits + self.cache.misses, 101)
+
+    def test_stale_temp_files(self):
+        stale = os.path.join(self.cache.directory, "stale.tmp")
+        fresh = os.path.join(self.cache.directory, "fresh.tmp")
+        for path in (stale, fresh):
+            open(path, "wb").close()
+        old = os.path.getmtime(stale) - STALE_TEMP - 1
+        os.utime(stale, (old, old))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertTrue(os.path.exists(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import unittest
+from lib.minimap import BLOCKED, Minimap
+
+SIZE = 8
+GRASS = (2, 0, 0, 0, 0, 0, 0)
+
+class TerrainTest(unittest.TestCase):
+    def setUp(self):
+        map_data = {"map_size": SIZE, "underworld": False,
+                    "upper_terrain": [[GRASS] * SIZE] * SIZE,
+                    "objects": [], "tunedobj": []}
+        self.minimap = Minimap(map_data)
+        self.minimap.take_dirty(0)
+
+    def test_set_terrain(self):
+        self.minimap.set_terrain(3, 2, 0, 8)
+        self.assertEqual(self.minimap.index[0][2 * SIZE + 3], 8)
+        self.assertEqual(self.minimap.take_dirty(0), (3, 2, 3, 2))
+
+    def test_unknown_type_is_rock(self):
+        for terrain_type in (BLOCKED, 255, 1000, -1):
+            self.minimap.set_terrain(1, 1, 0, terrain_type)
+            self.assertEqual(self.minimap.terrain[0][SIZE + 1], BLOCKED - 1)
+            index = self.minimap.index[0][:]
+            self.minimap.rebuild()
+            self.assertEqual(self.minimap.index[0], index)
+
+if __name__ == '__main__':
+    unittest.main()
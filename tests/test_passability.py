@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import unittest
+from lib import passability
+from lib.passability import Passability, mask_offsets
+
+#the masks of a one-tile resource: only the anchor tile is blocked and
+#visitable, the anchor column is the highest bit
+RESOURCE = {"passability": "\xff" * 5 + "\x7f",
+            "actions": "\x00" * 5 + "\x80"}
+#a two tile wide object blocking its anchor and the tile left of it
+WIDE = {"passability": "\xff" * 5 + "\x3f", "actions": "\x00" * 6}
+
+def map_data(objects):
+    return {"map_size": 6, "underworld": False,
+            "objects": [RESOURCE, WIDE],
+            "tunedobj": [{"id": id, "x": x, "y": y, "z": 0}
+                         for id, x, y in objects]}
+
+class MaskTest(unittest.TestCase):
+    def test_resource(self):
+        self.assertEqual(mask_offsets(RESOURCE["passability"], 0), [(0, 0)])
+        self.assertEqual(mask_offsets(RESOURCE["actions"], 1), [(0, 0)])
+
+    def test_lowest_bit_is_leftmost(self):
+        self.assertEqual(mask_offsets(WIDE["passability"], 0),
+                         [(-1, 0), (0, 0)])
+        self.assertEqual(mask_offsets("\xff" * 5 + "\xfe", 0), [(-7, 0)])
+        self.assertEqual(mask_offsets("\xfe" + "\xff" * 5, 0), [(-7, -5)])
+
+class PassabilityTest(unittest.TestCase):
+    def tiles(self, grids):
+        result = Passability(map_data([(0, 2, 1), (1, 5, 4), (1, 0, 3)]))
+        return set((x, y) for y in xrange(6) for x in xrange(6)
+                   if getattr(result, "is_" + grids)(x, y, 0))
+
+    def check(self):
+        self.assertEqual(self.tiles("blocked"),
+                         set([(2, 1), (4, 4), (5, 4), (0, 3)]))
+        self.assertEqual(self.tiles("visitable"), set([(2, 1)]))
+
+    def test_numpy(self):
+        if passability.numpy is None:
+            self.skipTest("numpy is not installed")
+        self.check()
+
+    def test_lists(self):
+        saved = passability.numpy
+        passability.numpy = None
+        try:
+            self.check()
+        finally:
+            passability.numpy = saved
+
+if __name__ == '__main__':
+    unittest.main()
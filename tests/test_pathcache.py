@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import unittest
+from lib import mapgen
+from lib.pathcache import PathCache
+
+SIZE = 40
+GRASS = (2, 0, 0, 0, 0, 0, 0)
+SUBTERRANEAN = (6, 0, 0, 0, 0, 0, 0)
+#entered from below on the third column from the right
+GATE = mapgen.template("avxgate0.def", 103, 0, 0, "\xff" * 5 + "\x1f",
+                       "\x00" * 5 + "\x20")
+RESOURCE = mapgen.template("avtwood0.def", 79, 0, 0, "\xff" * 5 + "\x7f",
+                           "\x00" * 5 + "\x80")
+#gates next to a cluster border on both levels and a resource between them
+OBJECTS = [(0, 18, 10, 0), (0, 18, 30, 1), (1, 24, 20, 0), (1, 16, 16, 1)]
+
+def state(cache):
+    """the graph of a cache without the empty entries its lookups leave"""
+    return (dict((node, targets) for node, targets in cache.edges.iteritems()
+                 if targets), dict(cache.uses), dict(cache.members),
+            dict((key, nodes) for key, nodes in cache.cluster_nodes.iteritems()
+                 if nodes), cache.portals)
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        map_data = {"map_size": SIZE, "underworld": True,
+                    "upper_terrain": [[GRASS] * SIZE] * SIZE,
+                    "lower_terrain": [[SUBTERRANEAN] * SIZE] * SIZE,
+                    "objects": [GATE, RESOURCE],
+                    "tunedobj": [{"id": template, "x": x, "y": y, "z": z}
+                                 for template, x, y, z in OBJECTS]}
+        self.cache = PathCache(map_data)
+
+    def assertRebuilt(self):
+        incremental = state(self.cache)
+        self.cache.rebuild()
+        self.assertEqual(incremental, state(self.cache))
+
+    def around(self, x, y):
+        return [(x + dx, y + dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)]
+
+    def test_portal_tile(self):
+        self.assertEqual(len(self.cache.portals), 2)
+        self.cache.update_tile(16, 10, 0, False, False)
+        self.assertEqual(self.cache.portals, set())
+        self.assertRebuilt()
+        self.cache.update_tile(16, 10, 0, False, True)
+        self.assertEqual(len(self.cache.portals), 2)
+        self.assertRebuilt()
+        self.assertEqual(self.cache.find_path((16, 12, 0), (16, 31, 1))[1],
+                         300)
+
+    def test_around_end_tiles(self):
+        for x, y, z in ((16, 10, 0), (16, 30, 1), (24, 20, 0)):
+            for passable, goal in ((False, None), (True, None),
+                                   (False, True)):
+                for tile in self.around(x, y):
+                    self.cache.update_tile(tile[0], tile[1], z, passable,
+                                           goal)
+                    self.assertRebuilt()
+
+    def test_refined_steps_of_graph_only(self):
+        for start, goal in (((3, 5, 0), (16, 31, 1)),
+                            ((16, 12, 0), (33, 37, 0))):
+            self.assertTrue(self.cache.find_path(start, goal))
+        refined = self.cache._PathCache__refined
+        self.assertTrue(refined)
+        for source, target in refined:
+            self.assertIn(source, self.cache.uses)
+            self.assertIn(target, self.cache.uses)
+
+    def test_refine_without_local_path(self):
+        grid = self.cache.grids[0]
+        route = [(0, grid.node(2, 2)), (0, grid.node(5, 5))]
+        self.assertEqual(len(self.cache.refine(route)), 4)
+        grid.set_tile(5, 5, False, False)
+        self.assertEqual(self.cache.refine(route), None)
+
+if __name__ == '__main__':
+    unittest.main()
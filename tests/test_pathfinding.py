@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import random
+import unittest
+from lib import mapgen
+from lib.pathfinding import PathGrid
+
+GRASS = (2, 0, 0, 0, 0, 0, 0)
+ROCK = (9, 0, 0, 0, 0, 0, 0)
+#a one-tile resource, blocked and visitable on its anchor
+RESOURCE = {"passability": "\xff" * 5 + "\x7f",
+            "actions": "\x00" * 5 + "\x80"}
+
+def map_data(terrain, resources=()):
+    return {"map_size": len(terrain), "underworld": False,
+            "upper_terrain": terrain, "objects": [RESOURCE],
+            "tunedobj": [{"id": 0, "x": x, "y": y, "z": 0}
+                         for x, y in resources]}
+
+class EndTilesTest(unittest.TestCase):
+    def setUp(self):
+        #two resources side by side with rock below them
+        self.grid = PathGrid(map_data([[GRASS, GRASS], [ROCK, ROCK]],
+                                      [(0, 0), (1, 0)]))
+
+    def test_start_is_goal(self):
+        self.assertEqual(self.grid.find_path((0, 0), (0, 0)), ([(0, 0)], 0))
+
+    def test_adjacent_end_tiles(self):
+        self.assertEqual(self.grid.find_path((0, 0), (1, 0)),
+                         ([(0, 0), (1, 0)], 100))
+
+    def test_blocked(self):
+        self.assertEqual(self.grid.find_path((0, 0), (0, 1)), None)
+
+class OptimalityTest(unittest.TestCase):
+    def setUp(self):
+        #roads make the cheapest step 50, diagonals then cost 70 and not 70.5
+        self.grid = PathGrid(mapgen.generate(72, seed=1, road_density=0.2))
+
+    def assertOptimal(self, seed=0, grid=None):
+        grid = grid or self.grid
+        rng = random.Random(seed)
+        #visitable tiles only end paths, which the landmarks have to respect
+        tiles = [(x, y) for y in xrange(grid.size) for x in xrange(grid.size)
+                 if grid.goal[grid.node(x, y)]]
+        for start in rng.sample(tiles, 15):
+            settled = grid.search(grid.node(*start))
+            costs = dict((node, grid.cost_to(node)) for node in settled)
+            for goal in rng.sample(tiles, 30):
+                found = grid.find_path(start, goal)
+                expected = costs.get(grid.node(*goal))
+                if expected is None:
+                    self.assertEqual(found, None)
+                else:
+                    self.assertEqual(found[1], expected, (start, goal))
+
+    def test_costs_equal_dijkstra(self):
+        self.assertOptimal()
+
+    def test_landmarks(self):
+        self.grid.add_landmarks()
+        self.assertTrue(self.grid.landmarks)
+        self.assertOptimal()
+
+    def test_landmarks_to_visitable_tiles(self):
+        #many objects to visit, paths may not lead on through them
+        grid = PathGrid(mapgen.generate(36, seed=1, road_density=0.1,
+                                        object_density=0.15))
+        grid.add_landmarks()
+        self.assertOptimal(grid=grid)
+
+    def test_closed_tiles_keep_landmarks(self):
+        grid = self.grid
+        grid.add_landmarks()
+        rng = random.Random(1)
+        for i in xrange(200):
+            x, y = rng.randrange(72), rng.randrange(72)
+            grid.set_tile(x, y, False)
+        self.assertTrue(grid.landmarks)
+        self.assertOptimal(1)
+
+    def test_opened_tile_drops_landmarks(self):
+        grid = self.grid
+        grid.add_landmarks()
+        grid.set_tile(0, 0, False)
+        grid.set_tile(0, 0, True)
+        self.assertEqual(grid.landmarks, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+    heroes renaissance
+    copyright 2008  - Johannes 'josch' Schauer <j.schauer@email.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import unittest
+from lib import mapgen
+from lib.pathfinding import Pathfinder
+from lib.reachability import DistanceFields
+
+class DistanceFieldsTest(unittest.TestCase):
+    def setUp(self):
+        self.grids = Pathfinder(mapgen.generate(36, seed=2,
+                                                underworld=True)).grids
+        self.starts = []
+        for z in (0, 1):
+            grid = self.grids[z]
+            self.starts.extend((x, y, z) for y in xrange(0, 36, 7)
+                               for x in xrange(0, 36, 5)
+                               if grid.passable[grid.node(x, y)])
+
+    def assertFresh(self, fields, starts, limits):
+        """fields equal to those of a DistanceFields not used before"""
+        expected = DistanceFields(self.grids, 0).compute(starts, limits)
+        self.assertEqual(len(fields), len(expected))
+        #arrays, a failing list comparison would diff every element
+        for (distance, predecessor), (fresh_distance, fresh_predecessor) in \
+                zip(fields, expected):
+            self.assertEqual(distance, fresh_distance)
+            self.assertEqual(predecessor, fresh_predecessor)
+
+    def test_slot_reuse(self):
+        fields = DistanceFields(self.grids, 0)
+        first = fields.compute(self.starts[:4])
+        arrays = [(id(distance), id(predecessor))
+                  for distance, predecessor in first]
+        #other starts with a limit leave less reached than the first call
+        starts = self.starts[4:7]
+        second = fields.compute(starts, [300, 0, 1000])
+        self.assertEqual([(id(distance), id(predecessor))
+                          for distance, predecessor in second], arrays[:3])
+        self.assertFresh(second, starts, [300, 0, 1000])
+        x, y, z = starts[1]
+        self.assertEqual(fields.reached(1), [(x, y, 0)])
+
+    def test_paths(self):
+        fields = DistanceFields(self.grids, 0)
+        fields.compute(self.starts[:2], 500)
+        for slot, (x, y, z) in enumerate(self.starts[:2]):
+            grid = self.grids[z]
+            for tile_x, tile_y, cost in fields.reached(slot):
+                self.assertTrue(0 <= cost <= 500)
+                path = fields.path(slot, tile_x, tile_y)
+                self.assertEqual(path[0], (x, y))
+                self.assertEqual(path[-1], (tile_x, tile_y))
+                self.assertEqual(sum(grid.step_cost(grid.node(*first),
+                                                    grid.node(*second))
+                                     for first, second in zip(path, path[1:])),
+                                 cost)
+
+    def test_pool(self):
+        fields = DistanceFields(self.grids, 2, pool_starts=1)
+        try:
+            self.assertFresh(fields.compute(self.starts[:6], 700),
+                             self.starts[:6], 700)
+        finally:
+            fields.close()
+
+if __name__ == '__main__':
+    unittest.main()